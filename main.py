@@ -9,36 +9,25 @@ from datetime import datetime, timedelta
 import threading
 import time
 import hashlib
+import hmac
+import base64
 import uuid
-import subprocess
 import sys
-
-# تثبيت المكتبات المطلوبة للعمل على Replit
-def install_requirements():
-    """تثبيت المكتبات المطلوبة"""
-    packages = ['python-telegram-bot', 'nest-asyncio', 'requests']
-    for package in packages:
-        try:
-            subprocess.check_call([sys.executable, "-m", "pip", "install", package], 
-                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        except:
-            pass
-
-# تثبيت المكتبات
-install_requirements()
-
-# استيراد nest_asyncio لحل مشاكل event loop
-try:
-    import nest_asyncio
-    nest_asyncio.apply()
-except ImportError:
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "nest_asyncio"])
-    import nest_asyncio
-    nest_asyncio.apply()
-
-# استيراد telegram بعد التثبيت
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+import signal
+import queue
+import struct
+import itertools
+import bisect
+import heapq
+import math
+import weakref
+import site
+from importlib import metadata
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# بداية قياس زمن الإقلاع (بعد مكتبات Python القياسية الخفيفة)
+IMPORT_STARTED = time.perf_counter()
 
 # إعداد السجلات المتقدم
 logging.basicConfig(
@@ -51,10 +40,221 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# فحص المكتبات قبل الإقلاع: ختم مخزن يتجاوز الفحص ما لم تتغير البيئة، ولا تثبيت تلقائي أبداً
+PREFLIGHT_STAMP_PATH = os.getenv("PREFLIGHT_STAMP_PATH", ".preflight_stamp.json")
+REQUIREMENTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "requirements.txt")
+# مكتبات غيابها يعطل ميزة واحدة فقط (numpy لإعادة تقييم السجل)
+OPTIONAL_DISTRIBUTIONS = {'numpy'}
+
+def read_requirements(path=None):
+    """قائمة (اسم التوزيعة، الإصدار المثبت أو None) من requirements.txt"""
+    requirements = []
+    try:
+        with open(path or REQUIREMENTS_PATH, encoding='utf-8') as handle:
+            for line in handle:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    name, _, version = line.partition('==')
+                    requirements.append((name.strip(), version.strip() or None))
+    except FileNotFoundError:
+        pass
+    return requirements
+
+def preflight():
+    """التحقق من المكتبات المثبتة مقابل requirements.txt؛ يعيد 'cached' أو 'checked'
+
+    مفتاح الختم يجمع مفسر Python والمتطلبات وأزمنة تعديل مجلدات site-packages، وأي
+    تثبيت أو إزالة يغير زمن تعديل المجلد فيُعاد الفحص. النقص يوقف الإقلاع برسالة واضحة.
+    """
+    requirements = read_requirements()
+    site_dirs = [path for path in site.getsitepackages() + [site.getusersitepackages()] if os.path.isdir(path)]
+    key = hashlib.sha256(json.dumps([
+        sys.executable, sys.version, requirements, [(path, os.stat(path).st_mtime_ns) for path in site_dirs]
+    ]).encode()).hexdigest()
+    try:
+        with open(PREFLIGHT_STAMP_PATH, encoding='utf-8') as handle:
+            if json.load(handle).get('key') == key:
+                return 'cached'
+    except (OSError, ValueError):
+        pass
+
+    problems = []
+    installed = {}
+    for name, version in requirements:
+        try:
+            installed[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            installed[name] = None
+        if installed[name] is None or (version and installed[name] != version):
+            found = installed[name] or 'غير مثبتة'
+            if name in OPTIONAL_DISTRIBUTIONS:
+                logger.warning(f"⚠️ المكتبة الاختيارية {name}: {found}")
+            else:
+                problems.append(f"{name}=={version}" if version else name)
+    if problems:
+        logger.error(f"❌ مكتبات مفقودة أو بإصدار مختلف: {', '.join(problems)}. شغّل: pip install -r requirements.txt")
+        raise SystemExit(1)
+
+    try:
+        with open(PREFLIGHT_STAMP_PATH, 'w', encoding='utf-8') as handle:
+            json.dump({'key': key, 'installed': installed, 'checked_at': time.time()}, handle)
+    except OSError as e:
+        logger.warning(f"⚠️ تعذر حفظ ختم الفحص: {e}")
+    return 'checked'
+
+class StartupProfile:
+    """تفصيل زمن الإقلاع: كل مرحلة تُقاس من نهاية المرحلة السابقة"""
+
+    def __init__(self, started=None):
+        self.started = started or time.perf_counter()
+        self._last = self.started
+        self.stages = {}
+        self.preflight = None
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self._last) * 1000
+        self._last = now
+
+    def total_ms(self):
+        return (self._last - self.started) * 1000
+
+    def report(self):
+        breakdown = ' • '.join(f"{stage} {elapsed:.0f}ms" for stage, elapsed in self.stages.items())
+        logger.info(f"⏱️ زمن الإقلاع {self.total_ms():.0f}ms (الفحص: {self.preflight}): {breakdown}")
+
+    def stats(self):
+        return {
+            **{stage: round(elapsed, 1) for stage, elapsed in self.stages.items()},
+            'total_ms': round(self.total_ms(), 1), 'preflight': self.preflight
+        }
+
+STARTUP_PROFILE = StartupProfile(IMPORT_STARTED)
+
+if __name__ == '__main__':
+    STARTUP_PROFILE.preflight = preflight()
+    STARTUP_PROFILE.mark('preflight')
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+
+STARTUP_PROFILE.mark('imports')
+
 # إعدادات البوت
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "8003913696:AAFzWOmJIBA5lGA3ezQV1_DcLMcCbIZo86s")
 CHANNEL_ID = os.getenv("TELEGRAM_CHANNEL_ID", "@your_channel_username")
 
+# جدولة منشورات القناة: تعمل فقط عند تحديد القناة صراحة
+CHANNEL_POSTS_ENABLED = "TELEGRAM_CHANNEL_ID" in os.environ
+QUOTE_INTERVAL_HOURS = float(os.getenv("QUOTE_INTERVAL_HOURS", "6"))
+SCHEDULER_JITTER_SECONDS = float(os.getenv("SCHEDULER_JITTER_SECONDS", "60"))
+
+# وضع استقبال التحديثات: polling أو webhook عبر خادم HTTP مدمج
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# السر ثابت لكل نسخ البوت نفسه حتى تقبل كل النسخ خلف موزع الحمل الطلبات نفسها
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:64]
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_KEEPALIVE_SECONDS = float(os.getenv("WEBHOOK_KEEPALIVE_SECONDS", "75"))
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "1") == "1"
+
+# الإيقاف الآمن: مهلة تصريف التحديثات الجارية بعد SIGTERM (أقل من مهلة المنصة قبل SIGKILL)،
+# والاحتفاظ بالتحديثات المعلقة عند إعادة التشغيل حتى لا تضيع الإجابات أثناء التحديث المتدرج
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+POLLING_DROP_PENDING = os.getenv("POLLING_DROP_PENDING", "0") == "1"
+
+# وضع العمال المتعددين: عملية استقبال واحدة توزع التحديثات على WORKER_PROCESSES عملية
+# بتجزئة متسقة لمعرف المستخدم (0 = عملية واحدة)
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+WORKER_SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR", "/tmp/mental_health_bot")
+WORKER_VNODES = int(os.getenv("WORKER_VNODES", "64"))
+WORKER_RESTART_SECONDS = float(os.getenv("WORKER_RESTART_SECONDS", "1"))
+# فترة التقاط العامل 0 لما سجله العمال الآخرون في قاعدة البيانات (بث جديد أو ملغى)
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "5"))
+
+# إعدادات قاعدة البيانات
+DB_PATH = os.getenv("MENTAL_HEALTH_DB_PATH", "advanced_mental_health.db")
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "4"))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "256"))
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", "4096"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+# محاولات بدء معاملة الكتابة عند انشغال الملف بعملية أخرى (بعد انقضاء busy_timeout)
+DB_BUSY_RETRIES = int(os.getenv("DB_BUSY_RETRIES", "4"))
+
+# إعدادات التسجيل المؤجل للتفاعلات
+INTERACTION_FLUSH_MS = int(os.getenv("INTERACTION_FLUSH_MS", "1000"))
+INTERACTION_FLUSH_MAX = int(os.getenv("INTERACTION_FLUSH_MAX", "500"))
+INTERACTION_BUFFER_CAP = int(os.getenv("INTERACTION_BUFFER_CAP", "100000"))
+
+# إعدادات مخزن الجلسات
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+SESSION_HOT_CAP = int(os.getenv("SESSION_HOT_CAP", "10000"))
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+SESSION_SWEEP_SECONDS = int(os.getenv("SESSION_SWEEP_SECONDS", "600"))
+
+# وضع الاختبارات عديم الحالة: التقدم يُحمل داخل callback_data موقعاً بـ HMAC
+STATELESS_ASSESSMENTS = os.getenv("STATELESS_ASSESSMENTS", "0") == "1"
+CALLBACK_SIGNING_KEY = os.getenv("CALLBACK_SIGNING_KEY", "")
+
+# حجم الدفعة عند إعادة تقييم السجل المخزن (python main.py --rescore)
+RESCORE_CHUNK_SIZE = int(os.getenv("RESCORE_CHUNK_SIZE", "50000"))
+
+# البحث النصي في قاعدة المعرفة: عدد النتائج وأدنى درجة BM25 للرد بمحتوى
+SEARCH_RESULTS_LIMIT = int(os.getenv("SEARCH_RESULTS_LIMIT", "3"))
+SEARCH_MIN_SCORE = float(os.getenv("SEARCH_MIN_SCORE", "1.0"))
+
+# أدنى ثقة لتوجيه رسالة نصية إلى خدمة محددة
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.5"))
+
+# مسارا معالجة التحديثات: المسار العادي، ومسار محجوز لإشارات الأزمات لا ينتظر خلف الزحام.
+# تحديثات المستخدم الواحد تُعالج دائماً بالترتيب، والتزامن بين المستخدمين المختلفين
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+CRISIS_LANE_CONCURRENCY = int(os.getenv("CRISIS_LANE_CONCURRENCY", "4"))
+UPDATE_ADMISSION_LIMIT = int(os.getenv("UPDATE_ADMISSION_LIMIT", "1024"))
+CRISIS_CONTACT_TEXT = os.getenv(
+    "CRISIS_CONTACT_TEXT",
+    "تواصل الآن مع خدمات الطوارئ في بلدك أو توجه إلى أقرب مستشفى، أو اتصل بشخص تثق به ليكون معك."
+)
+
+# تذكيرات المتابعة بإعادة الاختبارات: معدل الإرسال في الثانية وحجم الدفعة ومحاولات الإعادة
+FOLLOW_UP_SEND_RATE = int(os.getenv("FOLLOW_UP_SEND_RATE", "20"))
+FOLLOW_UP_BATCH_SIZE = int(os.getenv("FOLLOW_UP_BATCH_SIZE", "500"))
+FOLLOW_UP_RETRY_SECONDS = int(os.getenv("FOLLOW_UP_RETRY_SECONDS", "3600"))
+FOLLOW_UP_MAX_ATTEMPTS = int(os.getenv("FOLLOW_UP_MAX_ATTEMPTS", "3"))
+
+# طابور الإرسال الصادر: سقف عام أقل قليلاً من حد تيليجرام (~30 رسالة/ث) ليترك هامشاً للردود التفاعلية،
+# وسقف لكل محادثة خاصة (رسالة/ث) ولكل مجموعة أو قناة (20 رسالة/دقيقة)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+SEND_MAX_INFLIGHT = int(os.getenv("SEND_MAX_INFLIGHT", "64"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+SEND_BREAKER_THRESHOLD = int(os.getenv("SEND_BREAKER_THRESHOLD", "5"))
+SEND_BREAKER_COOLDOWN = float(os.getenv("SEND_BREAKER_COOLDOWN", "30"))
+SEND_CHAT_BUCKET_CAP = int(os.getenv("SEND_CHAT_BUCKET_CAP", "100000"))
+SEND_DRAIN_SECONDS = float(os.getenv("SEND_DRAIN_SECONDS", "5"))
+
+# البث الجماعي: حجم صفحة المعرفات، وأقصى رسائل معلقة في خط الإرسال، وفاصل حفظ نقطة الاستئناف
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "1000"))
+BROADCAST_WINDOW = int(os.getenv("BROADCAST_WINDOW", "200"))
+BROADCAST_CHECKPOINT_SECONDS = float(os.getenv("BROADCAST_CHECKPOINT_SECONDS", "2"))
+
+# حجم ذاكرة الشاشات المعاملة (LRU)
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "4096"))
+
+# تخطي التعديلات المكررة وتجميع الضغطات المزدوجة
+EDIT_TRACK_CAP = int(os.getenv("EDIT_TRACK_CAP", "50000"))
+CALLBACK_DEDUP_SECONDS = float(os.getenv("CALLBACK_DEDUP_SECONDS", "1.5"))
+
+# معرفات المشرفين المسموح لهم بأوامر الإدارة (مفصولة بفواصل)
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x.strip().isdigit()}
+
 # قاعدة المعرفة الإسلامية والفلسفية المتقدمة
 KNOWLEDGE_DATABASE = {
     'depression': {
@@ -358,7 +558,43 @@ PSYCHOLOGICAL_ASSESSMENTS = {
             "التحرك أو التحدث ببطء شديد أو العكس",
             "أفكار إيذاء النفس أو الموت"
         ],
-        'options': [("مطلقاً", 0), ("عدة أيام", 1), ("أكثر من نصف الأيام", 2), ("تقريباً كل يوم", 3)]
+        'options': [("مطلقاً", 0), ("عدة أيام", 1), ("أكثر من نصف الأيام", 2), ("تقريباً كل يوم", 3)],
+        # أي درجة أكبر من صفر في هذا البند (أفكار إيذاء النفس) إشارة أزمة
+        'crisis_item': 8,
+        # نطاقات الشدة: الحد الأعلى للدرجة في كل نطاق بترتيب تصاعدي،
+        # وfollow_up_days موعد تذكير إعادة الاختبار بعد النتيجة
+        'bands': [
+            {
+                'max_score': 4, 'severity': 'طبيعي', 'description': 'لا توجد علامات اكتئاب', 'color': '🟢',
+                'follow_up_days': 28,
+                'interpretation': 'نتيجة ممتازة! لا توجد علامات للاكتئاب. استمر في العناية بصحتك النفسية.',
+                'recommendations': '• حافظ على نمط حياة صحي\n• مارس الرياضة بانتظام\n• حافظ على علاقات اجتماعية إيجابية'
+            },
+            {
+                'max_score': 9, 'severity': 'خفيف', 'description': 'اكتئاب خفيف', 'color': '🟡',
+                'follow_up_days': 28,
+                'interpretation': 'قد تواجه بعض أعراض الاكتئاب الخفيف. يمكن التحسن بالرعاية الذاتية والدعم.',
+                'recommendations': '• اهتم بالنوم الكافي\n• مارس أنشطة تجلب السعادة\n• تحدث مع أشخاص تثق بهم'
+            },
+            {
+                'max_score': 14, 'severity': 'متوسط', 'description': 'اكتئاب متوسط', 'color': '🟠',
+                'follow_up_days': 14,
+                'interpretation': 'توجد أعراض اكتئاب متوسطة تتطلب انتباهاً. فكر في طلب المساعدة المهنية.',
+                'recommendations': '• فكر في العلاج النفسي\n• تجنب الكحول والمواد المضرة\n• حافظ على روتين يومي منتظم'
+            },
+            {
+                'max_score': 19, 'severity': 'متوسط إلى شديد', 'description': 'اكتئاب متوسط إلى شديد', 'color': '🔴',
+                'follow_up_days': 14,
+                'interpretation': 'أعراض اكتئاب كبيرة تؤثر على حياتك. ننصح بقوة بطلب المساعدة المتخصصة.',
+                'recommendations': '• اطلب المساعدة المهنية فوراً\n• تواصل مع خط المساعدة النفسية\n• لا تتردد في طلب الدعم'
+            },
+            {
+                'max_score': 27, 'severity': 'شديد', 'description': 'اكتئاب شديد', 'color': '🔴',
+                'follow_up_days': 7,
+                'interpretation': 'أعراض اكتئاب شديدة تتطلب تدخلاً عاجلاً. يرجى طلب المساعدة الطبية فوراً.',
+                'recommendations': '• اتصل بخدمات الطوارئ النفسية\n• تواصل مع طبيب نفسي\n• تجنب البقاء وحيداً'
+            }
+        ]
     },
     'gad7': {
         'name': 'مقياس القلق العام GAD-7',
@@ -372,7 +608,33 @@ PSYCHOLOGICAL_ASSESSMENTS = {
             "الانزعاج أو الغضب بسهولة",
             "الشعور بالخوف كما لو أن شيئاً فظيعاً قد يحدث"
         ],
-        'options': [("مطلقاً", 0), ("عدة أيام", 1), ("أكثر من نصف الأيام", 2), ("تقريباً كل يوم", 3)]
+        'options': [("مطلقاً", 0), ("عدة أيام", 1), ("أكثر من نصف الأيام", 2), ("تقريباً كل يوم", 3)],
+        'bands': [
+            {
+                'max_score': 4, 'severity': 'طبيعي', 'description': 'لا توجد علامات قلق', 'color': '🟢',
+                'follow_up_days': 28,
+                'interpretation': 'نتيجة ممتازة! لا توجد علامات للقلق المفرط. استمر في ممارساتك الصحية.',
+                'recommendations': '• استمر في ممارسة تقنيات الاسترخاء\n• حافظ على التوازن في الحياة\n• مارس الأنشطة الممتعة'
+            },
+            {
+                'max_score': 9, 'severity': 'خفيف', 'description': 'قلق خفيف', 'color': '🟡',
+                'follow_up_days': 28,
+                'interpretation': 'قد تواجه بعض القلق الخفيف. تقنيات الاسترخاء يمكن أن تساعد.',
+                'recommendations': '• تعلم تقنيات التنفس العميق\n• مارس التأمل أو اليوغا\n• قلل من الكافيين'
+            },
+            {
+                'max_score': 14, 'severity': 'متوسط', 'description': 'قلق متوسط', 'color': '🟠',
+                'follow_up_days': 14,
+                'interpretation': 'توجد أعراض قلق متوسطة. فكر في تعلم استراتيجيات إدارة القلق.',
+                'recommendations': '• فكر في العلاج المعرفي السلوكي\n• مارس الرياضة بانتظام\n• تجنب المواقف المثيرة للقلق'
+            },
+            {
+                'max_score': 21, 'severity': 'شديد', 'description': 'قلق شديد', 'color': '🔴',
+                'follow_up_days': 7,
+                'interpretation': 'أعراض قلق شديدة تؤثر على حياتك اليومية. ننصح بطلب المساعدة المتخصصة.',
+                'recommendations': '• اطلب المساعدة المهنية\n• فكر في العلاج الدوائي تحت إشراف طبي\n• اطلب الدعم من الأهل والأصدقاء'
+            }
+        ]
     },
     'mbti': {
         'name': 'تحليل الشخصية مايرز-بريغز (MBTI)',
@@ -495,90 +757,1205 @@ SUPPORT_RESOURCES = {
     ]
 }
 
-class AdvancedMentalHealthDatabase:
-    """قاعدة بيانات متقدمة للصحة النفسية"""
+# وسوم موارد الدعم المناسبة لكل عامل خطر أو عامل وقائي يُنتجه التقييم النفسي
+ANALYSIS_FACTOR_TAGS = {
+    'وجود تاريخ طبي قد يؤثر على الحالة النفسية': ['patience', 'relief', 'suffering', 'meaning'],
+    'ضعف في الدعم الاجتماعي': ['heart', 'peace', 'meaning', 'purpose'],
+    'وجود سلوكيات إدمانية محتملة': ['control', 'choice', 'patience'],
+    'مستوى توتر عالي': ['stress', 'anxiety', 'relief', 'peace', 'control'],
+    'دعم اجتماعي وأسري قوي': ['wisdom', 'purpose']
+}
 
-    def __init__(self):
-        self.db_path = 'advanced_mental_health.db'
+# الكلمات المفتاحية لكل نية في الرسائل النصية (تُطبَّع قبل بناء الأتمتة)
+INTENT_KEYWORDS = {
+    'phq9': [
+        'اكتئاب', 'مكتئب', 'حزين', 'حزن', 'يأس', 'يائس', 'محبط', 'إحباط', 'زهقان', 'ضيقة', 'مخنوق',
+        'لا أستمتع', 'فقدت الاهتمام', 'لا رغبة', 'تعبان نفسياً', 'أبكي', 'بكاء', 'وحيد', 'فاقد الأمل',
+        'depressed', 'depression', 'sad'
+    ],
+    'gad7': [
+        'قلق', 'توتر', 'متوتر', 'خوف', 'خائف', 'أخاف', 'مخاوف', 'هلع', 'رهاب', 'عصبية', 'وسواس', 'أرق', 'لا أستطيع النوم',
+        'ضربات القلب', 'أفكار كثيرة', 'anxiety', 'anxious', 'panic', 'stress'
+    ],
+    'mbti': [
+        'شخصيتي', 'الشخصية', 'نمط شخصية', 'نمطي', 'انطوائي', 'اجتماعي', 'انبساطي', 'mbti',
+        'مايرز', 'من أنا', 'أعرف نفسي', 'طباعي', 'personality', 'introvert', 'extrovert'
+    ],
+    'psych_evaluation': [
+        'تقييم شامل', 'تقييم نفسي', 'فحص نفسي', 'حالتي النفسية', 'إدمان', 'مدمن', 'مخدرات', 'تدخين',
+        'علاقاتي', 'عائلتي', 'أسرتي', 'تاريخ مرضي', 'أدوية', 'addiction', 'evaluation'
+    ],
+    'knowledge': [
+        'آية', 'قرآن', 'حديث', 'دعاء', 'ذكر', 'تفسير', 'حكمة', 'فلسفة', 'فيلسوف', 'الرواقية',
+        'معنى الحياة', 'معنى', 'صبر', 'طمأنينة', 'سكينة', 'quran', 'hadith', 'wisdom'
+    ]
+}
+
+# الرد والزر المباشر لكل نية: (النص، نص الزر، بيانات الزر)
+INTENT_FLOWS = {
+    'phq9': ("يبدو أنك تمر بمشاعر حزن أو إحباط. مقياس PHQ-9 يساعدك على فهم ما تشعر به بدقة.",
+             "😔 ابدأ مقياس الاكتئاب PHQ-9", "assessment:phq9"),
+    'gad7': ("يبدو أن القلق أو التوتر يشغلك. مقياس GAD-7 يساعدك على تقييم مستوى القلق.",
+             "😰 ابدأ مقياس القلق GAD-7", "assessment:gad7"),
+    'mbti': ("تريد أن تعرف نفسك أكثر؟ اختبار MBTI يكشف نمط شخصيتك من 16 نمطاً.",
+             "🧠 ابدأ تحليل الشخصية MBTI", "start_mbti"),
+    'psych_evaluation': ("التقييم النفسي الشامل يغطي التاريخ الطبي والبيئة الاجتماعية والسلوكيات والحالة النفسية.",
+                         "🔍 ابدأ التقييم النفسي الشامل", "start_psychological_evaluation")
+}
+
+# عبارات تدل على خطر إيذاء النفس في الرسائل النصية
+CRISIS_KEYWORDS = [
+    'انتحار', 'انتحر', 'أنتحر', 'اقتل نفسي', 'أقتل نفسي', 'أؤذي نفسي', 'إيذاء نفسي', 'أذية نفسي',
+    'أريد أن أموت', 'اريد الموت', 'أتمنى الموت', 'لا أريد العيش', 'لا أريد أن أعيش', 'أنهي حياتي',
+    'انهاء حياتي', 'لا فائدة من حياتي', 'suicide', 'suicidal', 'kill myself', 'end my life', 'self harm'
+]
+
+# مدونة مصنفة لقياس دقة وسرعة تصنيف النوايا (python main.py --benchmark-intents)
+INTENT_CORPUS = [
+    ("أشعر بالحزن طوال الوقت ولا أستمتع بأي شيء", 'phq9'),
+    ("أنا مكتئب منذ أسابيع", 'phq9'),
+    ("نفسيتي تعبانة وحزين ومش قادر أكمل", 'phq9'),
+    ("فقدت الاهتمام بكل شيء وأبكي كثيراً", 'phq9'),
+    ("أحس بيأس شديد", 'phq9'),
+    ("زهقان ومخنوق من كل شي", 'phq9'),
+    ("i feel so sad and depressed", 'phq9'),
+    ("حياتي محبطة وأشعر أني وحيد", 'phq9'),
+    ("عندي قلق دائم من المستقبل", 'gad7'),
+    ("أنا متوتر جداً قبل الامتحان", 'gad7'),
+    ("تأتيني نوبات هلع وضربات القلب تتسارع", 'gad7'),
+    ("لا أستطيع النوم من كثرة التفكير", 'gad7'),
+    ("خائف من كل شيء", 'gad7'),
+    ("i have anxiety and panic attacks", 'gad7'),
+    ("عندي وسواس وأفكار كثيرة", 'gad7'),
+    ("أخاف من الامتحانات", 'gad7'),
+    ("أعاني من الأرق كل ليلة", 'gad7'),
+    ("أريد أن أعرف نمط شخصيتي", 'mbti'),
+    ("هل أنا انطوائي أم اجتماعي؟", 'mbti'),
+    ("اختبار mbti", 'mbti'),
+    ("أريد أن أعرف نفسي أكثر", 'mbti'),
+    ("what is my personality type", 'mbti'),
+    ("ما هي طباعي", 'mbti'),
+    ("أحتاج تقييم نفسي شامل لحالتي", 'psych_evaluation'),
+    ("عندي مشكلة إدمان", 'psych_evaluation'),
+    ("أتعاطى مخدرات وأريد المساعدة", 'psych_evaluation'),
+    ("مشاكل مع عائلتي تؤثر علي", 'psych_evaluation'),
+    ("أريد فحص نفسي", 'psych_evaluation'),
+    ("أريد آية تريح قلبي", 'knowledge'),
+    ("أعطني حديثاً عن الصبر", 'knowledge'),
+    ("دعاء لتفريج الهم", 'knowledge'),
+    ("ما هي الحكمة الرواقية", 'knowledge'),
+    ("أبحث عن معنى الحياة", 'knowledge'),
+    ("أريد شيئاً من القرآن", 'knowledge'),
+    ("كيف أجد السكينة والطمأنينة", 'knowledge'),
+    ("مرحبا", None),
+    ("السلام عليكم", None),
+    ("شكراً لك", None),
+    ("كيف حالك", None),
+    ("الحمد لله بخير", None),
+    ("ok", None),
+    ("من صنع هذا البوت؟", None)
+]
+
+# ترحيلات مخطط قاعدة البيانات: (الإصدار، الوصف، التعليمات) تطبق بالترتيب مرة واحدة
+def _follow_up_backfill_statement():
+    """نقل آخر تقييم حديث لكل مستخدم ومقياس إلى جدول التذكيرات بموعد حسب شدته"""
+    cases = ' '.join(
+        f"WHEN a.assessment_type = '{key}' AND a.severity = '{band['severity']}' THEN {band['follow_up_days']}"
+        for key, spec in PSYCHOLOGICAL_ASSESSMENTS.items() for band in spec.get('bands', ())
+    )
+    return f'''
+        INSERT OR IGNORE INTO follow_up_reminders (user_id, assessment_type, severity, due_at)
+        SELECT a.user_id, a.assessment_type, a.severity,
+               CAST(strftime('%s', a.timestamp, 'utc') AS REAL) + 86400 * (CASE {cases} END)
+        FROM assessments a
+        WHERE a.id = (SELECT MAX(id) FROM assessments b
+                      WHERE b.user_id = a.user_id AND b.assessment_type = a.assessment_type)
+          AND a.timestamp >= datetime('now', '-90 days')
+          AND (CASE {cases} END) IS NOT NULL
+        '''
+
+SCHEMA_MIGRATIONS = [
+    (1, 'الجداول الأساسية', [
+        # جدول المستخدمين المتقدم
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            age INTEGER,
+            gender TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            total_assessments INTEGER DEFAULT 0,
+            risk_level TEXT DEFAULT 'unknown',
+            bio TEXT,
+            last_interaction TIMESTAMP,
+            preferred_language TEXT DEFAULT 'ar'
+        )
+        ''',
+        # جدول التقييمات
+        '''
+        CREATE TABLE IF NOT EXISTS assessments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            session_id TEXT,
+            assessment_type TEXT,
+            questions_answers TEXT,
+            total_score INTEGER,
+            subscale_scores TEXT,
+            risk_level TEXT,
+            severity TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            recommendations TEXT,
+            islamic_guidance TEXT,
+            follow_up_needed BOOLEAN,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+        # جدول تحليل MBTI
+        '''
+        CREATE TABLE IF NOT EXISTS mbti_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            session_id TEXT,
+            personality_type TEXT,
+            dimension_scores TEXT,
+            detailed_analysis TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+        # جدول التقييم النفسي الشامل
+        '''
+        CREATE TABLE IF NOT EXISTS psychological_evaluations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            session_id TEXT,
+            evaluation_data TEXT,
+            analysis_results TEXT,
+            support_resources TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+    ]),
+    (2, 'فهارس سجل المستخدم والتقارير', [
+        'CREATE INDEX IF NOT EXISTS idx_assessments_user_time ON assessments (user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_assessments_type_time ON assessments (assessment_type, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_assessments_session ON assessments (session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_mbti_user_time ON mbti_results (user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_mbti_session ON mbti_results (session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_evaluations_user_time ON psychological_evaluations (user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_evaluations_session ON psychological_evaluations (session_id)',
+        'ANALYZE'
+    ]),
+    (3, 'جلسات الاختبارات الجارية', [
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            payload BLOB,
+            updated_at REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at)'
+    ]),
+    (4, 'سجل إشارات الأزمات', [
+        '''
+        CREATE TABLE IF NOT EXISTS crisis_flags (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            source TEXT,
+            detail TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            handled INTEGER DEFAULT 0
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_crisis_flags_handled_time ON crisis_flags (handled, created_at)'
+    ]),
+    (5, 'حالة كيس الاقتباسات', [
+        '''
+        CREATE TABLE IF NOT EXISTS quote_bags (
+            name TEXT PRIMARY KEY,
+            fingerprint TEXT,
+            bag BLOB,
+            cursor INTEGER,
+            updated_at REAL
+        )
+        '''
+    ]),
+    (6, 'مخزن المهام المجدولة', [
+        '''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            name TEXT PRIMARY KEY,
+            kind TEXT,
+            interval_seconds REAL,
+            payload TEXT,
+            next_run REAL,
+            last_run REAL,
+            last_status TEXT,
+            run_count INTEGER DEFAULT 0,
+            enabled INTEGER DEFAULT 1,
+            updated_at REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_next ON scheduled_jobs (enabled, next_run)'
+    ]),
+    (7, 'تذكيرات المتابعة', [
+        '''
+        CREATE TABLE IF NOT EXISTS follow_up_reminders (
+            user_id INTEGER,
+            assessment_type TEXT,
+            severity TEXT,
+            due_at REAL,
+            attempts INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, assessment_type)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_follow_up_due ON follow_up_reminders (due_at)',
+        _follow_up_backfill_statement()
+    ]),
+    (8, 'البث الجماعي وتعليم المستخدمين الحاظرين', [
+        'ALTER TABLE users ADD COLUMN blocked_at REAL',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT,
+            parse_mode TEXT,
+            status TEXT,
+            last_user_id INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            created_by INTEGER,
+            created_at REAL,
+            updated_at REAL
+        )
+        '''
+    ])
+]
+
+class AdvancedMentalHealthDatabase:
+    """قاعدة بيانات متقدمة للصحة النفسية
+
+    خيط كتابة واحد يحتفظ باتصال دائم ويجمع الكتابات المنتظرة في معاملة واحدة،
+    وخيوط قراءة لكل منها اتصال دائم، مع دوال قابلة للانتظار لا تحجب حلقة الأحداث.
+    """
+
+    # استعلامات ثابتة يعيد sqlite3 استخدام تعليماتها المجهزة لكل اتصال
+    SQL_UPSERT_USER = '''
+    INSERT OR REPLACE INTO users
+    (user_id, username, first_name, last_interaction)
+    VALUES (?, ?, ?, ?)
+    '''
+    # أي تفاعل جديد يعني أن المستخدم لم يعد حاظراً للبوت
+    SQL_TOUCH_USER = 'UPDATE users SET last_interaction = ?, blocked_at = NULL WHERE user_id = ?'
+    SQL_MARK_BLOCKED = 'UPDATE users SET blocked_at = ? WHERE user_id = ?'
+    SQL_INSERT_MBTI = '''
+    INSERT INTO mbti_results
+    (user_id, session_id, personality_type, dimension_scores, detailed_analysis)
+    VALUES (?, ?, ?, ?, ?)
+    '''
+    SQL_INSERT_EVALUATION = '''
+    INSERT INTO psychological_evaluations
+    (user_id, session_id, evaluation_data, analysis_results, support_resources)
+    VALUES (?, ?, ?, ?, ?)
+    '''
+    SQL_INSERT_ASSESSMENT = '''
+    INSERT INTO assessments
+    (user_id, assessment_type, questions_answers, total_score, severity, timestamp, follow_up_needed)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    '''
+    SQL_UPSERT_FOLLOW_UP = '''
+    INSERT INTO follow_up_reminders (user_id, assessment_type, severity, due_at, attempts)
+    VALUES (?, ?, ?, ?, 0)
+    ON CONFLICT (user_id, assessment_type) DO UPDATE SET
+        severity = excluded.severity, due_at = excluded.due_at, attempts = 0
+    '''
+    SQL_INSERT_CRISIS_FLAG = 'INSERT INTO crisis_flags (user_id, source, detail, created_at) VALUES (?, ?, ?, ?)'
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or DB_PATH
+        self._write_queue = queue.Queue()
+        self._local = threading.local()
+        self._reader_conns = []
+        self._reader_lock = threading.Lock()
+        self._read_pool = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix='db-reader')
+        self._urgent_conn = None
+        self._urgent_lock = threading.Lock()
+        self._closed = False
         self.init_database()
+        self._writer = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        """فتح اتصال دائم بالإعدادات الموحدة"""
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=256
+        )
+        conn.execute('PRAGMA busy_timeout = 5000')
+        # NORMAL آمن مع WAL ويتجنب fsync عند كل معاملة
+        conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+        return conn
 
     def init_database(self):
-        """إنشاء قاعدة البيانات المتقدمة"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            # جدول المستخدمين المتقدم
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                age INTEGER,
-                gender TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                total_assessments INTEGER DEFAULT 0,
-                risk_level TEXT DEFAULT 'unknown',
-                bio TEXT,
-                last_interaction TIMESTAMP,
-                preferred_language TEXT DEFAULT 'ar'
-            )
-            ''')
+        """إنشاء قاعدة البيانات المتقدمة وتطبيق ترحيلات المخطط المعلقة"""
+        try:
+            conn = self._connect()
 
-            # جدول التقييمات
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS assessments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                session_id TEXT,
-                assessment_type TEXT,
-                questions_answers TEXT,
-                total_score INTEGER,
-                subscale_scores TEXT,
-                risk_level TEXT,
-                severity TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                recommendations TEXT,
-                islamic_guidance TEXT,
-                follow_up_needed BOOLEAN,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-            ''')
+            # حجم الصفحة يجب ضبطه قبل إنشاء أي جدول وقبل التحويل إلى WAL
+            conn.execute(f'PRAGMA page_size = {DB_PAGE_SIZE}')
+            journal_mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
 
-            # جدول تحليل MBTI
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mbti_results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                session_id TEXT,
-                personality_type TEXT,
-                dimension_scores TEXT,
-                detailed_analysis TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
             ''')
+            current_version = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
 
-            # جدول التقييم النفسي الشامل
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS psychological_evaluations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                session_id TEXT,
-                evaluation_data TEXT,
-                analysis_results TEXT,
-                support_resources TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-            ''')
+            for version, description, statements in SCHEMA_MIGRATIONS:
+                if version <= current_version:
+                    continue
+                self._begin_immediate(conn)
+                try:
+                    # إعادة القراءة داخل المعاملة: عملية أخرى قد تكون طبقت الترحيل منذ القراءة الأولى
+                    current_version = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+                    if version <= current_version:
+                        conn.execute('ROLLBACK')
+                        continue
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(
+                        'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                        (version, description)
+                    )
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                current_version = version
+                logger.info(f"🗄️ تم تطبيق ترحيل المخطط {version}: {description}")
 
-            conn.commit()
             conn.close()
-            logger.info("🗄️ قاعدة البيانات المتقدمة تم إنشاؤها بنجاح")
+            logger.info(f"🗄️ قاعدة البيانات المتقدمة جاهزة (المخطط {current_version}، وضع السجل {journal_mode})")
         except Exception as e:
             logger.error(f"❌ خطأ في إنشاء قاعدة البيانات: {e}")
 
+    def _writer_loop(self):
+        """حلقة خيط الكتابة: تجميع المهام المنتظرة وتنفيذها في معاملة واحدة"""
+        conn = self._connect()
+        running = True
+        while running:
+            job = self._write_queue.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < DB_WRITE_BATCH:
+                try:
+                    job = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    running = False
+                    break
+                batch.append(job)
+            self._run_write_batch(conn, batch)
+        try:
+            conn.execute('PRAGMA optimize')
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر تحسين إحصائيات قاعدة البيانات: {e}")
+        conn.close()
+
+    @staticmethod
+    def _begin_immediate(conn):
+        """BEGIN IMMEDIATE مع إعادة المحاولة بتراجع متزايد عند انشغال الملف بكاتب من عملية أخرى"""
+        for attempt in range(DB_BUSY_RETRIES):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                message = str(e)
+                if ('locked' not in message and 'busy' not in message) or attempt == DB_BUSY_RETRIES - 1:
+                    raise
+                logger.warning(f"⚠️ قاعدة البيانات مشغولة، إعادة المحاولة ({attempt + 1}/{DB_BUSY_RETRIES})")
+                time.sleep(min(2.0, 0.1 * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    def _run_write_batch(self, conn, batch):
+        """تنفيذ دفعة كتابات بنقطة حفظ لكل مهمة حتى لا تُفشل مهمةٌ بقية الدفعة"""
+        outcomes = []
+        try:
+            self._begin_immediate(conn)
+            for fn, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute('SAVEPOINT job')
+                try:
+                    outcomes.append((future, fn(conn), None))
+                    conn.execute('RELEASE job')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO job')
+                    conn.execute('RELEASE job')
+                    outcomes.append((future, None, e))
+            conn.execute('COMMIT')
+        except Exception as e:
+            logger.error(f"❌ خطأ في تنفيذ دفعة الكتابة: {e}")
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            # كل مهمة لم تُحسم بعد تفشل بالخطأ نفسه، بما فيها مهام لم يبدأ تنفيذها
+            for fn, future in batch:
+                if future.done():
+                    continue
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def submit_write(self, fn) -> Future:
+        """جدولة دالة كتابة تستقبل الاتصال وتعيد Future"""
+        future = Future()
+        if self._closed:
+            future.set_exception(RuntimeError("قاعدة البيانات مغلقة"))
+            return future
+        self._write_queue.put((fn, future))
+        return future
+
+    async def write(self, fn):
+        """تنفيذ دالة كتابة في خيط الكتابة وانتظار نتيجتها"""
+        return await asyncio.wrap_future(self.submit_write(fn))
+
+    async def execute(self, sql, params=()):
+        """تنفيذ استعلام كتابة واحد"""
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, rows):
+        """تنفيذ استعلام كتابة على عدة صفوف في المعاملة نفسها"""
+        rows = list(rows)
+        return await self.write(lambda conn: conn.executemany(sql, rows).rowcount)
+
+    def _reader(self):
+        """اتصال القراءة الدائم الخاص بالخيط الحالي"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _fetch(self, sql, params, one):
+        cursor = self._reader().execute(sql, params)
+        return cursor.fetchone() if one else cursor.fetchall()
+
+    async def fetchall(self, sql, params=()):
+        """قراءة جميع الصفوف من خيوط القراءة"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_pool, self._fetch, sql, params, False)
+
+    async def fetchone(self, sql, params=()):
+        """قراءة صف واحد من خيوط القراءة"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_pool, self._fetch, sql, params, True)
+
+    async def save_user(self, user_id, username, first_name):
+        """حفظ أو تحديث بيانات المستخدم"""
+        return await self.execute(self.SQL_UPSERT_USER, (user_id, username, first_name, datetime.now()))
+
+    async def touch_user(self, user_id):
+        """تحديث آخر تفاعل للمستخدم"""
+        return await self.execute(self.SQL_TOUCH_USER, (datetime.now(), user_id))
+
+    async def mark_users_blocked(self, user_ids):
+        """تعليم المستخدمين الذين حظروا البوت لاستبعادهم من البث"""
+        now = time.time()
+        return await self.executemany(self.SQL_MARK_BLOCKED, ((now, user_id) for user_id in user_ids))
+
+    async def save_mbti_result(self, user_id, session_id, analysis):
+        """حفظ نتيجة MBTI"""
+        return await self.execute(self.SQL_INSERT_MBTI, (
+            user_id, session_id, analysis['personality_type'],
+            json.dumps(analysis['dimension_scores']),
+            json.dumps(analysis['details'])
+        ))
+
+    async def save_psychological_evaluation(self, user_id, session_id, results):
+        """حفظ نتيجة التقييم النفسي الشامل"""
+        return await self.execute(self.SQL_INSERT_EVALUATION, (
+            user_id, session_id,
+            json.dumps(results['responses']),
+            json.dumps(results['analysis']),
+            json.dumps({
+                'religious': results['religious_support'],
+                'philosophical': results['philosophical_support']
+            })
+        ))
+
+    async def save_assessment(self, user_id, assessment_type, answers, total_score, severity, follow_up_at=None):
+        """حفظ نتيجة اختبار نفسي؛ follow_up_at يستبدل موعد تذكير المتابعة في المعاملة نفسها"""
+        row = (
+            user_id, assessment_type, json.dumps(answers),
+            total_score, severity, datetime.now(), follow_up_at is not None
+        )
+
+        def write(conn):
+            conn.execute(self.SQL_INSERT_ASSESSMENT, row)
+            if follow_up_at is not None:
+                conn.execute(self.SQL_UPSERT_FOLLOW_UP, (user_id, assessment_type, severity, follow_up_at))
+
+        return await self.write(write)
+
+    def _write_urgent(self, sql, params):
+        """كتابة فورية باتصال مستقل تتجاوز طابور خيط الكتابة ودفعاته"""
+        with self._urgent_lock:
+            if self._closed:
+                raise RuntimeError("قاعدة البيانات مغلقة")
+            if self._urgent_conn is None:
+                self._urgent_conn = self._connect()
+            return self._urgent_conn.execute(sql, params).lastrowid
+
+    async def save_crisis_flag(self, user_id, source, detail):
+        """حفظ إشارة أزمة فوراً دون انتظار دفعة الكتابة التالية"""
+        return await asyncio.to_thread(
+            self._write_urgent, self.SQL_INSERT_CRISIS_FLAG, (user_id, source, detail, datetime.now())
+        )
+
+    def close(self):
+        """إيقاف خيط الكتابة بعد تفريغ المهام المنتظرة وإغلاق جميع الاتصالات"""
+        if self._closed:
+            return
+        self._closed = True
+        self._write_queue.put(None)
+        self._writer.join()
+        with self._urgent_lock:
+            if self._urgent_conn is not None:
+                self._urgent_conn.close()
+                self._urgent_conn = None
+        self._read_pool.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+        logger.info("🗄️ تم إغلاق اتصالات قاعدة البيانات")
+
+class InteractionLogBuffer:
+    """مخزن كتابة مؤجلة لتفاعلات المستخدمين
+
+    يدمج تحديثات آخر تفاعل لكل مستخدم في الذاكرة ويكتبها كمعاملة واحدة متعددة
+    الصفوف كل INTERACTION_FLUSH_MS أو عند بلوغ INTERACTION_FLUSH_MAX سجلاً.
+    """
+
+    def __init__(self, db, flush_interval_ms=None, flush_max_records=None, max_pending=None):
+        self.db = db
+        self.flush_interval = (flush_interval_ms or INTERACTION_FLUSH_MS) / 1000.0
+        self.flush_max_records = flush_max_records or INTERACTION_FLUSH_MAX
+        self.max_pending = max_pending or INTERACTION_BUFFER_CAP
+        self._pending = {}
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+        self.counters = {
+            'touches': 0,
+            'merged': 0,
+            'dropped': 0,
+            'flushes': 0,
+            'failed_flushes': 0,
+            'flushed_records': 0,
+            'last_flush_size': 0,
+            'max_flush_size': 0,
+            'last_flush_latency_ms': 0.0,
+            'max_flush_latency_ms': 0.0
+        }
+
+    def start(self):
+        """تشغيل مهمة التفريغ الدوري داخل حلقة الأحداث الحالية"""
+        if self._task is None or self._task.done():
+            self._closing = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def touch(self, user_id, when=None):
+        """تسجيل تفاعل مستخدم في الذاكرة دون أي كتابة فورية"""
+        self.counters['touches'] += 1
+        if user_id in self._pending:
+            self.counters['merged'] += 1
+        elif len(self._pending) >= self.max_pending:
+            self.counters['dropped'] += 1
+            return
+        self._pending[user_id] = when or datetime.now()
+        if len(self._pending) >= self.flush_max_records and self._wakeup:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """كتابة جميع التفاعلات المدمجة في معاملة واحدة"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows = [(when, user_id) for user_id, when in pending.items()]
+        started = time.perf_counter()
+        try:
+            await self.db.executemany(self.db.SQL_TOUCH_USER, rows)
+        except Exception as e:
+            self.counters['failed_flushes'] += 1
+            logger.error(f"❌ خطأ في تفريغ سجل التفاعلات: {e}")
+            # إعادة السجلات غير المكتوبة ما لم يصل المستخدم بتفاعل أحدث
+            for user_id, when in pending.items():
+                if user_id not in self._pending and len(self._pending) < self.max_pending:
+                    self._pending[user_id] = when
+                elif user_id not in self._pending:
+                    self.counters['dropped'] += 1
+            return 0
+
+        latency_ms = (time.perf_counter() - started) * 1000
+        self.counters['flushes'] += 1
+        self.counters['flushed_records'] += len(rows)
+        self.counters['last_flush_size'] = len(rows)
+        self.counters['max_flush_size'] = max(self.counters['max_flush_size'], len(rows))
+        self.counters['last_flush_latency_ms'] = round(latency_ms, 3)
+        self.counters['max_flush_latency_ms'] = max(self.counters['max_flush_latency_ms'], round(latency_ms, 3))
+        return len(rows)
+
+    async def close(self):
+        """إيقاف التفريغ الدوري وكتابة ما تبقى في المخزن"""
+        self._closing = True
+        if self._task and not self._task.done():
+            self._wakeup.set()
+            await self._task
+        await self.flush()
+
+    def stats(self):
+        """إحصائيات المخزن الحالية"""
+        return {**self.counters, 'pending': len(self._pending)}
+
+# ترتيب الأبعاد والفئات والمقاييس كما تُرمَّز في حالة الجلسة
+MBTI_DIMENSION_ORDER = tuple(MBTI_ASSESSMENT['dimensions'])
+MBTI_LETTERS = ''.join(MBTI_DIMENSION_ORDER)
+PSYCH_CATEGORY_ORDER = tuple(PSYCHOLOGICAL_ASSESSMENTS['psychological_evaluation']['categories'])
+# كل مقياس معرف بنطاقات شدة هو اختبار فحص؛ يُضاف المقياس الجديد في آخر الجدول
+SCREENING_INSTRUMENTS = tuple(key for key, spec in PSYCHOLOGICAL_ASSESSMENTS.items() if 'bands' in spec)
+
+# ترتيب أسئلة MBTI المسطح (فهرس البعد، فهرس السؤال) كما في الوضع عديم الحالة
+MBTI_FLAT_QUESTIONS = tuple(
+    (dimension_index, question_index)
+    for dimension_index, dimension in enumerate(MBTI_DIMENSION_ORDER)
+    for question_index in range(len(MBTI_ASSESSMENT['dimensions'][dimension]['questions']))
+)
+
+class ScreeningScale:
+    """مقياس فحص مجدول: أوزان الخيارات ونقاط القطع وجداول التفسير تُبنى مرة واحدة
+
+    الشدة تُحدد بالبحث الثنائي في الحدود العليا للنطاقات بدل سلسلة شروط لكل مقياس.
+    """
+
+    __slots__ = ('key', 'item_count', 'weights', 'max_score', 'cutpoints', 'bands', 'by_severity', 'crisis_item')
+
+    def __init__(self, key, spec):
+        self.key = key
+        self.item_count = len(spec['questions'])
+        self.weights = frozenset(weight for _, weight in spec['options'])
+        self.max_score = self.item_count * max(self.weights)
+        self.bands = tuple(spec['bands'])
+        self.cutpoints = [band['max_score'] for band in self.bands]
+        if self.cutpoints != sorted(self.cutpoints) or self.cutpoints[-1] < self.max_score:
+            raise ValueError(f"نقاط قطع غير صالحة للمقياس {key}")
+        self.by_severity = {band['severity']: band for band in self.bands}
+        self.crisis_item = spec.get('crisis_item')
+
+    def is_crisis_answer(self, question_index, score):
+        """هل هذه الإجابة إشارة أزمة (درجة موجبة في بند الأزمة)؟"""
+        return question_index == self.crisis_item and score > 0
+
+    def has_crisis_answer(self, answers):
+        """هل تتضمن الإجابات المكتملة إشارة أزمة؟"""
+        return self.crisis_item is not None and len(answers) > self.crisis_item and answers[self.crisis_item] > 0
+
+    def band(self, total_score):
+        """نطاق الشدة الذي تقع فيه الدرجة"""
+        return self.bands[bisect.bisect_left(self.cutpoints, total_score)]
+
+    def score(self, answers):
+        """الدرجة الإجمالية ونطاقها؛ ترفض الأوزان غير المعرفة في المقياس"""
+        if any(answer not in self.weights for answer in answers):
+            raise ValueError(f"إجابة غير صالحة للمقياس {self.key}")
+        total_score = sum(answers)
+        return total_score, self.band(total_score)
+
+SCREENING_SCALES = {key: ScreeningScale(key, PSYCHOLOGICAL_ASSESSMENTS[key]) for key in SCREENING_INSTRUMENTS}
+
+class MBTISessionState:
+    """حالة اختبار MBTI الجاري؛ كل إجابة بايت واحد هو موضع الحرف في MBTI_LETTERS"""
+
+    __slots__ = ('session_uuid', 'dimension_index', 'question_index', 'answers')
+
+    def __init__(self, session_uuid=None, dimension_index=0, question_index=0, answers=b''):
+        self.session_uuid = session_uuid or uuid.uuid4().bytes
+        self.dimension_index = dimension_index
+        self.question_index = question_index
+        self.answers = bytearray(answers)
+
+    @property
+    def session_id(self):
+        return str(uuid.UUID(bytes=self.session_uuid))
+
+    @property
+    def dimension(self):
+        return MBTI_DIMENSION_ORDER[self.dimension_index]
+
+    def record(self, letter):
+        self.answers.append(MBTI_LETTERS.index(letter))
+
+    def responses(self):
+        """الإجابات بالصيغة التي يتوقعها analyze_mbti"""
+        responses = {}
+        for code in self.answers:
+            responses.setdefault(MBTI_DIMENSION_ORDER[code // 2], []).append(MBTI_LETTERS[code])
+        return responses
+
+    def pack(self):
+        return struct.pack('<16sBBB', self.session_uuid, self.dimension_index,
+                           self.question_index, len(self.answers)) + bytes(self.answers)
+
+    @classmethod
+    def unpack(cls, buffer, offset):
+        session_uuid, dimension_index, question_index, count = struct.unpack_from('<16sBBB', buffer, offset)
+        offset += 19
+        state = cls(session_uuid, dimension_index, question_index, buffer[offset:offset + count])
+        return state, offset + count
+
+class PsychEvaluationState:
+    """حالة التقييم النفسي الشامل؛ كل إجابة بايت: الفئة في النصف الأعلى والخيار في الأدنى
+
+    موارد الدعم المختارة تُخزن كفهارس 16 بت في SUPPORT_RESOURCES.
+    """
+
+    __slots__ = ('session_uuid', 'category_index', 'question_index', 'answers', 'religious', 'philosophical')
+
+    def __init__(self, session_uuid=None, category_index=0, question_index=0, answers=b'',
+                 religious=(), philosophical=()):
+        self.session_uuid = session_uuid or uuid.uuid4().bytes
+        self.category_index = category_index
+        self.question_index = question_index
+        self.answers = bytearray(answers)
+        self.religious = tuple(religious)
+        self.philosophical = tuple(philosophical)
+
+    @property
+    def session_id(self):
+        return str(uuid.UUID(bytes=self.session_uuid))
+
+    @property
+    def category(self):
+        return PSYCH_CATEGORY_ORDER[self.category_index]
+
+    def answered(self):
+        return len(self.answers)
+
+    def record(self, value):
+        """تسجيل فهرس الخيار (أو قيمة المقياس) ضمن الفئة الحالية"""
+        self.answers.append(self.category_index << 4 | value)
+
+    def responses(self):
+        """الإجابات بالصيغة التي يتوقعها analyze_psychological_evaluation"""
+        responses = {}
+        for code in self.answers:
+            category = PSYCH_CATEGORY_ORDER[code >> 4]
+            answers = responses.setdefault(category, [])
+            question = PSYCHOLOGICAL_QUESTIONS[category][len(answers)]
+            value = code & 0x0F
+            answers.append(str(value) if question['type'] == 'scale' else question['options'][value])
+        return responses
+
+    def pack(self):
+        return (struct.pack('<16sBBB', self.session_uuid, self.category_index,
+                            self.question_index, len(self.answers)) + bytes(self.answers)
+                + self._pack_indexes(self.religious) + self._pack_indexes(self.philosophical))
+
+    @staticmethod
+    def _pack_indexes(indexes):
+        return struct.pack(f'<B{len(indexes)}H', len(indexes), *indexes)
+
+    @staticmethod
+    def _unpack_indexes(buffer, offset):
+        count = buffer[offset]
+        return struct.unpack_from(f'<{count}H', buffer, offset + 1), offset + 1 + count * 2
+
+    @classmethod
+    def unpack(cls, buffer, offset):
+        session_uuid, category_index, question_index, count = struct.unpack_from('<16sBBB', buffer, offset)
+        offset += 19
+        answers = buffer[offset:offset + count]
+        offset += count
+        religious, offset = cls._unpack_indexes(buffer, offset)
+        philosophical, offset = cls._unpack_indexes(buffer, offset)
+        state = cls(session_uuid, category_index, question_index, answers, religious, philosophical)
+        return state, offset
+
+class ScreeningSessionState:
+    """حالة اختبار فحص جاري (PHQ-9، GAD-7، ...)؛ الدرجات بايت لكل سؤال"""
+
+    __slots__ = ('instrument_index', 'question_index', 'answers', 'started_at')
+
+    def __init__(self, instrument, question_index=0, answers=b'', started_at=None):
+        self.instrument_index = instrument if isinstance(instrument, int) else SCREENING_INSTRUMENTS.index(instrument)
+        self.question_index = question_index
+        self.answers = bytearray(answers)
+        self.started_at = int(started_at or time.time())
+
+    @property
+    def instrument(self):
+        return SCREENING_INSTRUMENTS[self.instrument_index]
+
+    def pack(self):
+        return struct.pack('<BBIB', self.instrument_index, self.question_index,
+                           self.started_at, len(self.answers)) + bytes(self.answers)
+
+    @classmethod
+    def unpack(cls, buffer, offset):
+        instrument_index, question_index, started_at, count = struct.unpack_from('<BBIB', buffer, offset)
+        offset += 7
+        state = cls(instrument_index, question_index, buffer[offset:offset + count], started_at)
+        return state, offset + count
+
+class UserSession:
+    """جلسة المستخدم: حالة اختيارية لكل مسار مع ترميز ثنائي مضغوط"""
+
+    __slots__ = ('mbti', 'psych', 'screening', '__weakref__')
+
+    FORMAT_VERSION = 1
+    _PARTS = (('mbti', MBTISessionState), ('psych', PsychEvaluationState), ('screening', ScreeningSessionState))
+
+    def __init__(self, mbti=None, psych=None, screening=None):
+        self.mbti = mbti
+        self.psych = psych
+        self.screening = screening
+
+    def __bool__(self):
+        return self.mbti is not None or self.psych is not None or self.screening is not None
+
+    def to_bytes(self):
+        flags = 0
+        body = b''
+        for bit, (name, _) in enumerate(self._PARTS):
+            part = getattr(self, name)
+            if part is not None:
+                flags |= 1 << bit
+                body += part.pack()
+        return struct.pack('<BB', self.FORMAT_VERSION, flags) + body
+
+    @classmethod
+    def from_bytes(cls, payload):
+        buffer = bytes(payload)
+        version, flags = struct.unpack_from('<BB', buffer, 0)
+        session = cls()
+        if version != cls.FORMAT_VERSION:
+            return session
+        offset = 2
+        for bit, (name, part_cls) in enumerate(cls._PARTS):
+            if flags & (1 << bit):
+                part, offset = part_cls.unpack(buffer, offset)
+                setattr(session, name, part)
+        return session
+
+class StatelessProgressCodec:
+    """ترميز تقدم الاختبار وإجاباته داخل callback_data بتوقيع HMAC مرتبط بالمستخدم
+
+    الصيغة: نوع الاختبار (بايت) + عدد الإجابات (بايت) + الإجابات معبأة بالبتات
+    + أول 8 بايتات من HMAC-SHA256، مرمزة base64 بدون حشو (أقل من 24 حرفاً).
+    """
+
+    MAC_SIZE = 8
+    # النوع: (عدد الأسئلة، عدد البتات لكل إجابة)
+    KINDS = {
+        **{key: (scale.item_count, max(scale.weights).bit_length()) for key, scale in SCREENING_SCALES.items()},
+        'mbti': (len(MBTI_FLAT_QUESTIONS), 1)
+    }
+    KIND_ORDER = tuple(KINDS)
+
+    def __init__(self, key=None):
+        self.key = key or hashlib.sha256(b'callback-progress:' + TOKEN.encode()).digest()
+
+    def _mac(self, user_id, body):
+        return hmac.new(self.key, struct.pack('<q', user_id) + body, hashlib.sha256).digest()[:self.MAC_SIZE]
+
+    def encode(self, user_id, kind, answers):
+        total, bits = self.KINDS[kind]
+        packed = 0
+        for position, answer in enumerate(answers):
+            packed |= answer << (position * bits)
+        body = bytes((self.KIND_ORDER.index(kind), len(answers))) + packed.to_bytes((total * bits + 7) // 8, 'little')
+        return base64.urlsafe_b64encode(body + self._mac(user_id, body)).rstrip(b'=').decode()
+
+    def decode(self, user_id, token):
+        """فك الترميز والتحقق من التوقيع؛ يعيد (النوع، الإجابات) أو None"""
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except (ValueError, TypeError):
+            return None
+        body, mac = raw[:-self.MAC_SIZE], raw[-self.MAC_SIZE:]
+        if len(body) < 2 or not hmac.compare_digest(mac, self._mac(user_id, body)):
+            return None
+        kind_index, count = body[0], body[1]
+        if kind_index >= len(self.KIND_ORDER):
+            return None
+        kind = self.KIND_ORDER[kind_index]
+        total, bits = self.KINDS[kind]
+        if count > total or len(body) != 2 + (total * bits + 7) // 8:
+            return None
+        packed = int.from_bytes(body[2:], 'little')
+        mask = (1 << bits) - 1
+        return kind, [(packed >> (position * bits)) & mask for position in range(count)]
+
+class MemorySessionBackend:
+    """مخزن جلسات في ذاكرة العملية فقط"""
+
+    def __init__(self):
+        self._rows = {}
+
+    async def load(self, user_id):
+        return self._rows.get(user_id)
+
+    async def save(self, user_id, payload, updated_at):
+        self._rows[user_id] = (payload, updated_at)
+
+    async def delete(self, user_id):
+        self._rows.pop(user_id, None)
+
+    async def purge_expired(self, cutoff):
+        expired = [user_id for user_id, (_, updated_at) in self._rows.items() if updated_at < cutoff]
+        for user_id in expired:
+            del self._rows[user_id]
+        return len(expired)
+
+class SQLiteSessionBackend:
+    """مخزن جلسات دائم في جدول sessions"""
+
+    SQL_LOAD = 'SELECT payload, updated_at FROM sessions WHERE user_id = ?'
+    SQL_SAVE = 'INSERT OR REPLACE INTO sessions (user_id, payload, updated_at) VALUES (?, ?, ?)'
+    SQL_DELETE = 'DELETE FROM sessions WHERE user_id = ?'
+    SQL_PURGE = 'DELETE FROM sessions WHERE updated_at < ?'
+
+    def __init__(self, db):
+        self.db = db
+
+    async def load(self, user_id):
+        return await self.db.fetchone(self.SQL_LOAD, (user_id,))
+
+    async def save(self, user_id, payload, updated_at):
+        await self.db.execute(self.SQL_SAVE, (user_id, payload, updated_at))
+
+    async def delete(self, user_id):
+        await self.db.execute(self.SQL_DELETE, (user_id,))
+
+    async def purge_expired(self, cutoff):
+        return await self.db.execute(self.SQL_PURGE, (cutoff,))
+
+class SessionStore:
+    """مخزن جلسات الاختبارات الجارية مع طبقة ساخنة LRU محدودة الحجم
+
+    تُحفظ حالة المستخدم في المخزن الدائم بعد كل تعديل، لذا يمكن إخراجها من
+    الذاكرة في أي وقت واستئنافها بعد إعادة التشغيل. الجلسات المهجورة تُحذف بعد
+    انتهاء مدة الصلاحية من الذاكرة والمخزن معاً.
+    """
+
+    # حالة محفوظة مجهولة: الحفظ التالي يكتب الجلسة أو يحذفها دون مقارنة
+    UNSAVED = object()
+
+    def __init__(self, backend, max_hot=None, ttl_seconds=None):
+        self.backend = backend
+        self.max_hot = max_hot or SESSION_HOT_CAP
+        self.ttl_seconds = ttl_seconds or SESSION_TTL_SECONDS
+        self._hot = OrderedDict()
+        # جلسات أُخرجت من الطبقة الساخنة وما زال معالج يحملها؛ تُستعاد بدل نسخة المخزن القديمة
+        self._evicted = weakref.WeakValueDictionary()
+        self._loading = {}
+        self._sweeper = None
+        self.counters = {'hits': 0, 'loads': 0, 'resumed': 0, 'evicted': 0, 'revived': 0, 'expired': 0, 'saves': 0}
+
+    def serialize(self, session):
+        return session.to_bytes()
+
+    def deserialize(self, payload):
+        return UserSession.from_bytes(payload)
+
+    async def get(self, user_id):
+        """جلب جلسة المستخدم من الطبقة الساخنة أو المخزن الدائم أو إنشاء جلسة فارغة"""
+        now = time.time()
+        entry = self._hot.get(user_id)
+        if entry is not None and now - entry[1] <= self.ttl_seconds:
+            self._hot.move_to_end(user_id)
+            entry[1] = now
+            self.counters['hits'] += 1
+            return entry[0]
+
+        session = self._revive(user_id, now)
+        if session is not None:
+            return session
+
+        # منع تحميل الجلسة نفسها أكثر من مرة عند تزامن التحديثات
+        pending = self._loading.get(user_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._loading[user_id] = future
+        try:
+            session, payload = UserSession(), None
+            row = await self.backend.load(user_id)
+            self.counters['loads'] += 1
+            if row and now - row[1] <= self.ttl_seconds:
+                payload = row[0]
+                session = self.deserialize(payload)
+                self.counters['resumed'] += 1
+            self._admit(user_id, [session, now, payload])
+            future.set_result(session)
+            return session
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._loading[user_id]
+
+    def _admit(self, user_id, entry):
+        self._hot[user_id] = entry
+        self._hot.move_to_end(user_id)
+        while len(self._hot) > self.max_hot:
+            evicted_id, evicted = self._hot.popitem(last=False)
+            self._evicted[evicted_id] = evicted[0]
+            self.counters['evicted'] += 1
+
+    def _revive(self, user_id, now):
+        """إعادة جلسة مُخرجة ما زالت في يد معالج إلى الطبقة الساخنة"""
+        session = self._evicted.pop(user_id, None)
+        if session is not None:
+            self._admit(user_id, [session, now, self.UNSAVED])
+            self.counters['revived'] += 1
+        return session
+
+    async def save(self, user_id):
+        """حفظ جلسة المستخدم في المخزن الدائم إذا تغيرت منذ آخر حفظ"""
+        entry = self._hot.get(user_id)
+        if entry is None:
+            if self._revive(user_id, time.time()) is None:
+                return
+            entry = self._hot[user_id]
+        session = entry[0]
+        payload = self.serialize(session) if session else None
+        if payload == entry[2]:
+            return
+        if payload is None:
+            await self.backend.delete(user_id)
+        else:
+            await self.backend.save(user_id, payload, time.time())
+        entry[2] = payload
+        self.counters['saves'] += 1
+
+    async def save_all(self):
+        """حفظ جميع الجلسات الموجودة في الطبقة الساخنة"""
+        for user_id in list(self._hot):
+            try:
+                await self.save(user_id)
+            except Exception as e:
+                logger.error(f"❌ خطأ في حفظ جلسة المستخدم {user_id}: {e}")
+
+    async def discard(self, user_id):
+        """حذف جلسة المستخدم من الذاكرة والمخزن"""
+        self._hot.pop(user_id, None)
+        self._evicted.pop(user_id, None)
+        await self.backend.delete(user_id)
+
+    async def sweep(self):
+        """إخراج الجلسات المهجورة من الذاكرة وحذفها من المخزن"""
+        cutoff = time.time() - self.ttl_seconds
+        expired = [user_id for user_id, entry in self._hot.items() if entry[1] < cutoff]
+        for user_id in expired:
+            del self._hot[user_id]
+        purged = await self.backend.purge_expired(cutoff)
+        self.counters['expired'] += len(expired)
+        return purged
+
+    def start(self):
+        """تشغيل مهمة التنظيف الدوري"""
+        async def run_sweeper():
+            while True:
+                await asyncio.sleep(SESSION_SWEEP_SECONDS)
+                try:
+                    purged = await self.sweep()
+                    if purged:
+                        logger.info(f"🧹 تم حذف {purged} جلسة مهجورة")
+                except Exception as e:
+                    logger.error(f"❌ خطأ في تنظيف الجلسات: {e}")
+
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(run_sweeper())
+
+    async def close(self):
+        """إيقاف التنظيف الدوري وحفظ الجلسات المتبقية"""
+        if self._sweeper and not self._sweeper.done():
+            self._sweeper.cancel()
+        await self.save_all()
+
+    def stats(self):
+        return {**self.counters, 'hot': len(self._hot), 'max_hot': self.max_hot}
+
+class SupportResourceIndex:
+    """فهرس مقلوب من الوسوم إلى موارد الدعم يُبنى مرة واحدة
+
+    عوامل التقييم تتحول إلى وسوم عبر ANALYSIS_FACTOR_TAGS، ثم تُجمع الصلة من قوائم
+    الوسوم المطابقة فقط، ويُختار الأعلى بكومة محدودة بدل ترتيب جميع الموارد.
+    """
+
+    def __init__(self, resources, factor_tags):
+        self.resources = resources
+        self.factor_tags = {factor: frozenset(tags) for factor, tags in factor_tags.items()}
+        self.postings = {}
+        self.positions = {}
+        for kind, entries in resources.items():
+            postings = self.postings[kind] = {}
+            for position, resource in enumerate(entries):
+                for tag in set(resource['tags']):
+                    postings.setdefault(tag, []).append(position)
+            self.positions[kind] = {resource['title']: position for position, resource in enumerate(entries)}
+
+    def analysis_tags(self, analysis_results):
+        """وسوم الاستعلام المستخرجة من عوامل الخطر والعوامل الوقائية"""
+        tags = set()
+        for factor in itertools.chain(analysis_results.get('risk_factors', ()),
+                                      analysis_results.get('protective_factors', ())):
+            tags.update(self.factor_tags.get(factor, ()))
+        return tags
+
+    def top(self, kind, analysis_results, limit=3):
+        """أعلى الموارد صلة؛ الصلة عدد وسوم المورد المطابقة، والتعادل بترتيب الموارد"""
+        postings = self.postings.get(kind, {})
+        relevance = {}
+        for tag in self.analysis_tags(analysis_results):
+            for position in postings.get(tag, ()):
+                relevance[position] = relevance.get(position, 0) + 1
+
+        best = heapq.nlargest(limit, relevance.items(), key=lambda item: (item[1], -item[0]))
+        entries = self.resources[kind]
+        return [{**entries[position], 'relevance_score': score} for position, score in best]
+
+    def position(self, kind, resource):
+        """موضع المورد في SUPPORT_RESOURCES أو None"""
+        return self.positions[kind].get(resource['title'])
+
 class PsychologicalAnalysisService:
     """خدمة التحليل النفسي المتكاملة"""
 
@@ -691,123 +2068,1953 @@ class PsychologicalAnalysisService:
     @staticmethod
     def get_religious_support(analysis_results: dict) -> list:
         """الحصول على الدعم الديني المناسب"""
-        relevant_resources = []
+        return SUPPORT_INDEX.top('religious', analysis_results)
+
+    @staticmethod
+    def get_philosophical_support(analysis_results: dict) -> list:
+        """الحصول على الدعم الفلسفي المناسب"""
+        return SUPPORT_INDEX.top('philosophical', analysis_results)
+
+SUPPORT_INDEX = SupportResourceIndex(SUPPORT_RESOURCES, ANALYSIS_FACTOR_TAGS)
+
+# تطبيع النص العربي: إزالة التشكيل والتطويل وعلامات المصحف وتوحيد أشكال الحروف
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061A\u064B-\u065F\u0670\u0640\u06D6-\u06ED]')
+ARABIC_LETTER_FORMS = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه'})
+ARABIC_TOKEN = re.compile(r'\w+')
+ARABIC_PREFIXES = ('وبال', 'وال', 'بال', 'كال', 'فال', 'لل', 'ال', 'و', 'ب', 'ل', 'ف')
+ARABIC_SUFFIXES = ('هما', 'كما', 'ات', 'ان', 'ون', 'ين', 'ها', 'هم', 'كم', 'نا', 'يه', 'ه', 'ي')
+ARABIC_STOPWORDS = frozenset({
+    'من', 'في', 'علي', 'الي', 'عن', 'ان', 'او', 'ما', 'لا', 'لم', 'لن', 'هو', 'هي', 'هذا', 'هذه',
+    'ذلك', 'التي', 'الذي', 'كل', 'قد', 'مع', 'ثم', 'بل', 'كان', 'انا', 'انت', 'نحن', 'هم', 'اذا', 'لي', 'به'
+})
+
+def normalize_arabic(text):
+    """إزالة التشكيل وتوحيد الألف والياء والتاء المربوطة"""
+    return ARABIC_DIACRITICS.sub('', text).translate(ARABIC_LETTER_FORMS).lower()
+
+def arabic_stem(token):
+    """تجذيع خفيف: حذف سابقة ولاحقة شائعتين مع إبقاء ثلاثة أحرف على الأقل"""
+    for prefix in ARABIC_PREFIXES:
+        if token.startswith(prefix) and len(token) - len(prefix) >= 3:
+            token = token[len(prefix):]
+            break
+    for suffix in ARABIC_SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            token = token[:-len(suffix)]
+            break
+    return token
+
+def arabic_terms(text):
+    """مصطلحات الفهرسة والبحث لنص عربي"""
+    return [
+        arabic_stem(token) for token in ARABIC_TOKEN.findall(normalize_arabic(text))
+        if token not in ARABIC_STOPWORDS and len(token) > 1
+    ]
+
+class ArabicSearchIndex:
+    """فهرس نصي كامل في الذاكرة بترتيب BM25 وإعادة فهرسة تزايدية
+
+    كل مستند يُفهرس بمعرف خارجي؛ إضافته مرة أخرى تستبدل نسخته السابقة. معامل
+    طول المستند يُعاد حسابه مرة واحدة عند أول بحث بعد أي تغيير.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings = {}
+        self.doc_ids = {}
+        self.docs = []
+        self.doc_terms = []
+        self.doc_lengths = []
+        self.free_slots = []
+        self.total_length = 0
+        self._norms = None
+        self.counters = {'queries': 0, 'reindexed': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add(self, doc_id, text, payload):
+        """فهرسة مستند أو استبدال نسخته السابقة"""
+        if doc_id in self.doc_ids:
+            self.remove(doc_id)
+            self.counters['reindexed'] += 1
+
+        terms = {}
+        for term in arabic_terms(text):
+            terms[term] = terms.get(term, 0) + 1
+        length = sum(terms.values())
+
+        slot = self.free_slots.pop() if self.free_slots else len(self.docs)
+        if slot == len(self.docs):
+            self.docs.append(None)
+            self.doc_terms.append(None)
+            self.doc_lengths.append(0)
+        self.docs[slot] = payload
+        self.doc_terms[slot] = terms
+        self.doc_lengths[slot] = length
+        self.doc_ids[doc_id] = slot
+        self.total_length += length
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[slot] = frequency
+        self._norms = None
+
+    def remove(self, doc_id):
+        """حذف مستند من الفهرس"""
+        slot = self.doc_ids.pop(doc_id, None)
+        if slot is None:
+            return
+        for term in self.doc_terms[slot]:
+            posting = self.postings[term]
+            del posting[slot]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= self.doc_lengths[slot]
+        self.docs[slot] = None
+        self.doc_terms[slot] = None
+        self.doc_lengths[slot] = 0
+        self.free_slots.append(slot)
+        self._norms = None
+
+    def _length_norms(self):
+        if self._norms is None:
+            average = self.total_length / len(self.doc_ids) if self.doc_ids else 1.0
+            self._norms = [self.K1 * (1 - self.B + self.B * length / average) for length in self.doc_lengths]
+        return self._norms
+
+    def search(self, query, limit=3, min_score=0.0):
+        """أفضل المستندات لنص الاستعلام: قائمة (الدرجة، المحتوى)"""
+        started = time.perf_counter()
+        norms = self._length_norms()
+        doc_count = len(self.doc_ids)
+        scores = {}
+        for term in set(arabic_terms(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for slot, frequency in posting.items():
+                scores[slot] = scores.get(slot, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norms[slot])
+
+        best = heapq.nlargest(limit, ((score, slot) for slot, score in scores.items() if score >= min_score))
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.counters['queries'] += 1
+        self.counters['total_ms'] += elapsed_ms
+        self.counters['max_ms'] = max(self.counters['max_ms'], elapsed_ms)
+        return [(score, self.docs[slot]) for score, slot in best]
+
+    def stats(self):
+        queries = self.counters['queries']
+        return {
+            **self.counters,
+            'avg_ms': round(self.counters['total_ms'] / queries, 4) if queries else 0.0,
+            'documents': len(self.doc_ids),
+            'terms': len(self.postings)
+        }
 
-        for resource in SUPPORT_RESOURCES['religious']:
-            # تحديد مدى الصلة بناءً على النتائج
-            relevance = 0
-            for tag in resource['tags']:
-                if tag in str(analysis_results).lower():
-                    relevance += 1
+def index_knowledge_base(index):
+    """فهرسة الآيات والأحاديث والتفاسير والأقوال الفلسفية وموارد الدعم"""
+    for topic, entry in KNOWLEDGE_DATABASE.items():
+        quran = entry.get('quran')
+        if quran:
+            index.add(('quran', topic), f"{quran['ayah']} {quran['tafseer']}", {
+                'icon': '📖', 'text': quran['ayah'], 'note': quran['tafseer'], 'source': quran['reference']
+            })
+        hadith = entry.get('hadith')
+        if hadith:
+            index.add(('hadith', topic), f"{hadith['text']} {hadith['meaning']}", {
+                'icon': '🕌', 'text': hadith['text'], 'note': hadith['meaning'], 'source': hadith['source']
+            })
+        for name, saying in entry.get('philosophers', {}).items():
+            index.add(('philosophy', topic, name), saying, {
+                'icon': '💭', 'text': saying, 'note': '', 'source': ''
+            })
 
-            if relevance > 0:
-                relevant_resources.append({
-                    **resource,
-                    'relevance_score': relevance
-                })
+    for kind, resources in SUPPORT_RESOURCES.items():
+        for resource in resources:
+            index.add(('resource', kind, resource['title']), f"{resource['title']} {resource['content']}", {
+                'icon': '🕌' if kind == 'religious' else '💭', 'text': f"**{resource['title']}**\n{resource['content']}",
+                'note': '', 'source': resource['source']
+            })
+    return index
+
+class BatchRescorer:
+    """إعادة حساب الدرجات والشدة وأنماط MBTI لكامل السجل المخزن دفعة بعد دفعة
+
+    كل دفعة تُحمَّل بترقيم المفتاح الأساسي، ويُحلل JSON كل صف على حدة فلا يُفسد صفٌ تالفٌ
+    بقية الدفعة، ثم تُحسب في مصفوفات NumPy، وتُكتب الصفوف المتغيرة فقط في معاملة واحدة عبر خيط الكتابة.
+    """
+
+    SQL_SELECT_ASSESSMENTS = '''
+    SELECT id, assessment_type, questions_answers, total_score, severity
+    FROM assessments WHERE id > ? ORDER BY id LIMIT ?
+    '''
+    SQL_UPDATE_ASSESSMENT = 'UPDATE assessments SET total_score = ?, severity = ? WHERE id = ?'
+    SQL_SELECT_MBTI = '''
+    SELECT id, personality_type, dimension_scores
+    FROM mbti_results WHERE id > ? ORDER BY id LIMIT ?
+    '''
+    SQL_UPDATE_MBTI = 'UPDATE mbti_results SET personality_type = ?, detailed_analysis = ? WHERE id = ?'
+
+    def __init__(self, db, chunk_size=None):
+        self.db = db
+        self.chunk_size = chunk_size or RESCORE_CHUNK_SIZE
+        self.counters = {'assessments_scanned': 0, 'assessments_updated': 0, 'assessments_invalid': 0,
+                         'mbti_scanned': 0, 'mbti_updated': 0, 'mbti_invalid': 0}
+
+        # النمط لكل رمز من 4 بتات: البت 1 يعني الحرف الثاني من زوج البعد
+        self.mbti_type_names = [
+            ''.join(MBTI_LETTERS[2 * d + ((code >> (3 - d)) & 1)] for d in range(4)) for code in range(16)
+        ]
+        self.mbti_details_json = {
+            name: json.dumps(MBTI_TYPES.get(name, {}))
+            for name in self.mbti_type_names
+        }
 
-        # ترتيب حسب الصلة
-        relevant_resources.sort(key=lambda x: x['relevance_score'], reverse=True)
-        return relevant_resources[:3]
+    @staticmethod
+    def _load_json_column(values):
+        """تحليل عمود JSON صفاً صفاً؛ الصف التالف أو الفارغ يصبح None ليُحتسب غير صالح"""
+        parsed = []
+        for value in values:
+            try:
+                parsed.append(json.loads(value) if value else None)
+            except (TypeError, ValueError):
+                parsed.append(None)
+        return parsed
+
+    def _score_assessment_chunk(self, rows):
+        """حساب الدرجات والشدة لدفعة من الاختبارات؛ يعيد صفوف التحديث للمتغير منها فقط"""
+        import numpy as np
+
+        answers_column = self._load_json_column(row[2] for row in rows)
+        updates = []
+        for assessment_type, scale in SCREENING_SCALES.items():
+            positions = [i for i, row in enumerate(rows) if row[1] == assessment_type]
+            if not positions:
+                continue
+
+            column = [answers_column[i] for i in positions]
+            valid = np.ones(len(positions), dtype=bool)
+            try:
+                raw = np.array(column)
+            except (TypeError, ValueError):
+                raw = None
+            if raw is not None and raw.dtype.kind in 'iu' and raw.shape == (len(positions), scale.item_count):
+                # الحالة الشائعة: جميع الصفوف مكتملة بأعداد صحيحة فتُستخدم المصفوفة مباشرة
+                matrix = raw.astype(np.int64)
+            else:
+                # صف ناقص أو زائد أو بقيم غير صحيحة أو خارج المدى يُعلَّم غير صالح بدل الحشو بالأصفار
+                matrix = np.zeros((len(positions), scale.item_count), dtype=np.int64)
+                for r, answers in enumerate(column):
+                    if (not isinstance(answers, list) or len(answers) != scale.item_count
+                            or not all(type(answer) is int for answer in answers)):
+                        valid[r] = False
+                        continue
+                    try:
+                        matrix[r] = answers
+                    except OverflowError:
+                        valid[r] = False
+
+            valid &= np.isin(matrix, list(scale.weights)).all(axis=1)
+            matrix[~valid] = 0
+            totals = matrix.sum(axis=1)
+            band_indexes = np.searchsorted(np.asarray(scale.cutpoints), totals, side='left')
+            severities = np.asarray([band['severity'] for band in scale.bands], dtype=object)[band_indexes]
+
+            stored_totals = np.asarray([rows[i][3] if rows[i][3] is not None else -1 for i in positions])
+            stored_severities = np.asarray([rows[i][4] for i in positions], dtype=object)
+            changed = valid & ((totals != stored_totals) | (severities != stored_severities))
+
+            self.counters['assessments_invalid'] += int((~valid).sum())
+            for r in np.flatnonzero(changed):
+                updates.append((int(totals[r]), severities[r], rows[positions[r]][0]))
+        return updates
+
+    def _score_mbti_chunk(self, rows):
+        """حساب أنماط MBTI لدفعة من النتائج؛ يعيد صفوف التحديث للمتغير منها فقط"""
+        import numpy as np
+
+        scores_column = self._load_json_column(row[2] for row in rows)
+        matrix = np.zeros((len(rows), len(MBTI_LETTERS)), dtype=np.int32)
+        valid = np.ones(len(rows), dtype=bool)
+        for i, scores in enumerate(scores_column):
+            if not isinstance(scores, dict):
+                valid[i] = False
+                continue
+            try:
+                matrix[i] = [scores.get(letter, 0) for letter in MBTI_LETTERS]
+            except (TypeError, ValueError, OverflowError):
+                valid[i] = False
+
+        # الحرف الأول من كل زوج يفوز فقط عند التفوق الصريح كما في analyze_mbti
+        second_letter = matrix[:, 0::2] <= matrix[:, 1::2]
+        codes = second_letter.astype(np.int8) @ np.array([8, 4, 2, 1], dtype=np.int8)
+        types = np.asarray(self.mbti_type_names, dtype=object)[codes]
+        stored_types = np.asarray([row[1] for row in rows], dtype=object)
+        changed = valid & (types != stored_types)
+
+        self.counters['mbti_invalid'] += int((~valid).sum())
+        return [(types[i], self.mbti_details_json[types[i]], rows[i][0]) for i in np.flatnonzero(changed)]
+
+    async def _rescore_table(self, select_sql, update_sql, score_chunk, prefix):
+        last_id = 0
+        while True:
+            rows = await self.db.fetchall(select_sql, (last_id, self.chunk_size))
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = await asyncio.to_thread(score_chunk, rows)
+            if updates:
+                await self.db.executemany(update_sql, updates)
+            self.counters[f'{prefix}_scanned'] += len(rows)
+            self.counters[f'{prefix}_updated'] += len(updates)
+
+    async def rescore_all(self):
+        """إعادة تقييم جميع الاختبارات ونتائج MBTI المخزنة"""
+        started = time.perf_counter()
+        await self._rescore_table(self.SQL_SELECT_ASSESSMENTS, self.SQL_UPDATE_ASSESSMENT,
+                                  self._score_assessment_chunk, 'assessments')
+        await self._rescore_table(self.SQL_SELECT_MBTI, self.SQL_UPDATE_MBTI,
+                                  self._score_mbti_chunk, 'mbti')
+        return {**self.counters, 'elapsed_seconds': round(time.perf_counter() - started, 3)}
+
+async def rescore_history():
+    """تشغيل إعادة التقييم الكاملة على قاعدة البيانات ثم الإغلاق"""
+    db = AdvancedMentalHealthDatabase()
+    try:
+        result = await BatchRescorer(db).rescore_all()
+        logger.info(f"✅ اكتملت إعادة التقييم: {result}")
+    except ImportError:
+        logger.error("❌ إعادة التقييم تتطلب مكتبة numpy (pip install numpy)")
+    finally:
+        await asyncio.to_thread(db.close)
+
+class AhoCorasickAutomaton:
+    """أتمتة Aho-Corasick مبنية مسبقاً: مطابقة جميع الكلمات المفتاحية في مرور واحد على النص"""
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for pattern, value in patterns:
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state] += (value,)
+
+        # روابط الفشل بالعرض أولاً، ودمج مخرجات حالة الفشل في كل حالة
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for char, next_state in self.goto[state].items():
+                pending.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0) if state else 0
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def matches(self, text):
+        """جميع القيم المطابقة في النص بترتيب ظهورها"""
+        goto, fail, output = self.goto, self.fail, self.output
+        found = []
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.extend(output[state])
+        return found
+
+class IntentRouter:
+    """تصنيف نية الرسائل النصية: كلمات مفتاحية بأتمتة Aho-Corasick ثم مقارنة ثلاثيات الحروف
+
+    وزن الكلمة المفتاحية طولها بعد التطبيع فتغلب العبارات الأدق. إذا لم تطابق أي كلمة
+    تُقارن ثلاثيات حروف الرسالة بثلاثيات كلمات كل نية، بوزن عكسي لعدد النوايا المشتركة.
+    """
+
+    def __init__(self, keywords=None, min_confidence=None):
+        keywords = keywords or INTENT_KEYWORDS
+        self.min_confidence = INTENT_MIN_CONFIDENCE if min_confidence is None else min_confidence
+        patterns = []
+        trigram_intents = {}
+        for intent, phrases in keywords.items():
+            for phrase in phrases:
+                normalized = normalize_arabic(phrase)
+                patterns.append((normalized, (intent, len(normalized))))
+                for trigram in self._trigrams(normalized):
+                    trigram_intents.setdefault(trigram, set()).add(intent)
+        self.automaton = AhoCorasickAutomaton(patterns)
+        self.trigram_weights = {
+            trigram: tuple((intent, 1.0 / len(intents)) for intent in intents)
+            for trigram, intents in trigram_intents.items()
+        }
+        self.counters = {'classified': 0, 'keyword_hits': 0, 'ngram_hits': 0, 'unmatched': 0}
 
     @staticmethod
-    def get_philosophical_support(analysis_results: dict) -> list:
-        """الحصول على الدعم الفلسفي المناسب"""
-        relevant_resources = []
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2) if ' ' not in text[i:i + 3]}
+
+    def _scores(self, normalized):
+        scores = {}
+        for intent, weight in self.automaton.matches(normalized):
+            scores[intent] = scores.get(intent, 0) + weight
+        if scores:
+            return scores, 'keyword_hits'
+        for trigram in self._trigrams(normalized):
+            for intent, weight in self.trigram_weights.get(trigram, ()):
+                scores[intent] = scores.get(intent, 0) + weight
+        return scores, 'ngram_hits'
+
+    def classify(self, text):
+        """النية الأرجح وثقتها، أو (None، 0) إذا لم تتجاوز الحد الأدنى"""
+        self.counters['classified'] += 1
+        scores, source = self._scores(normalize_arabic(text))
+        if scores:
+            intent, best = max(scores.items(), key=lambda item: item[1])
+            confidence = best / sum(scores.values())
+            # ثلاثيات الحروف أضعف دليلاً فتحتاج أكثر من ثلاثية مطابقة
+            if confidence >= self.min_confidence and (source == 'keyword_hits' or best >= 2):
+                self.counters[source] += 1
+                return intent, confidence
+        self.counters['unmatched'] += 1
+        return None, 0.0
+
+    def stats(self):
+        return {**self.counters, 'states': len(self.automaton.goto)}
+
+def run_intent_benchmark(iterations=2000):
+    """قياس دقة تصنيف النوايا على المدونة المصنفة وزمن التصنيف لكل رسالة"""
+    router = IntentRouter()
+    errors = []
+    for text, expected in INTENT_CORPUS:
+        predicted, _ = router.classify(text)
+        if predicted != expected:
+            errors.append((text, expected, predicted))
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for text, _ in INTENT_CORPUS:
+            router.classify(text)
+    per_message_us = (time.perf_counter() - started) / (iterations * len(INTENT_CORPUS)) * 1e6
+
+    accuracy = 1 - len(errors) / len(INTENT_CORPUS)
+    logger.info(f"✅ دقة تصنيف النوايا: {accuracy:.1%} على {len(INTENT_CORPUS)} رسالة، {per_message_us:.1f}µs لكل رسالة")
+    for text, expected, predicted in errors:
+        logger.warning(f"⚠️ تصنيف خاطئ: {text!r} المتوقع={expected} الناتج={predicted}")
+    return accuracy, per_message_us
+
+class CrisisDetector:
+    """كشف إشارات الأزمات عند دخول التحديث قبل جدولته
+
+    الرسائل النصية تُطابق بعبارات CRISIS_KEYWORDS عبر أتمتة Aho-Corasick، وأزرار
+    الاختبارات تُفحص إجابتها على بند الأزمة في المقياس (البند 9 في PHQ-9) في الوضعين.
+    """
+
+    def __init__(self, router, progress_codec, keywords=None):
+        self.router = router
+        self.progress_codec = progress_codec
+        self.automaton = AhoCorasickAutomaton(
+            (normalize_arabic(phrase), phrase) for phrase in (keywords or CRISIS_KEYWORDS)
+        )
+        self.counters = {'checked': 0, 'text_signals': 0, 'answer_signals': 0}
+
+    def detect_text(self, text):
+        """أول عبارة أزمة في النص أو None"""
+        matches = self.automaton.matches(normalize_arabic(text or ''))
+        return matches[0] if matches else None
+
+    def _detect_answer(self, query):
+        parsed = self.router.parse(query.data)
+        if parsed is None:
+            return None
+        _, name, args = parsed
+        if name == 'answer':
+            instrument, question_index, score = args
+        elif name == 's':
+            decoded = self.progress_codec.decode(query.from_user.id, args[0])
+            if decoded is None or decoded[0] not in SCREENING_SCALES or not decoded[1]:
+                return None
+            instrument, answers = decoded
+            question_index, score = len(answers) - 1, answers[-1]
+        else:
+            return None
+        scale = SCREENING_SCALES.get(instrument)
+        if scale is not None and scale.is_crisis_answer(question_index, score):
+            return f"{instrument}:item{question_index + 1}={score}"
+        return None
+
+    def detect(self, update):
+        """(المصدر، التفاصيل) لإشارة أزمة في التحديث أو None"""
+        self.counters['checked'] += 1
+        message = getattr(update, 'message', None)
+        if message is not None and message.text:
+            phrase = self.detect_text(message.text)
+            if phrase:
+                self.counters['text_signals'] += 1
+                return 'text', phrase
+            return None
+        query = getattr(update, 'callback_query', None)
+        if query is not None and query.data:
+            detail = self._detect_answer(query)
+            if detail:
+                self.counters['answer_signals'] += 1
+                return 'assessment', detail
+        return None
+
+    def stats(self):
+        return dict(self.counters)
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """معالج تحديثات متزامن بمسارين مع ترتيب صارم لتحديثات كل مستخدم
+
+    كل مستخدم له قفل بالمفتاح يُنشأ عند الحاجة ويُحذف عند فراغه، فتُعالج إجاباته
+    بترتيب وصولها بينما يتقدم المستخدمون الآخرون بالتوازي. المسار العادي بتزامن
+    UPDATE_CONCURRENCY ومسار الأزمات محجوز؛ المقعد في المسار لا يُحجز إلا بعد قفل
+    المستخدم حتى لا يشغل المنتظرون خلف تحديثاتهم السابقة مقاعد غيرهم. مكان التحديث في
+    طابور مستخدمه يُحجز قبل أي انتظار، وإشارة الأزمة تُحفظ في مهمة مستقلة فور وصولها.
+    التصنيف يسبق حد القبول العام، فلا يخضع له إلا المسار العادي ولا تنتظر الأزمات خلفه.
+    """
+
+    def __init__(self, detector, on_crisis, normal_limit=None, crisis_limit=None, admission_limit=None):
+        super().__init__(admission_limit or UPDATE_ADMISSION_LIMIT)
+        self.detector = detector
+        self.on_crisis = on_crisis
+        self.lanes = {
+            'normal': asyncio.Semaphore(normal_limit or UPDATE_CONCURRENCY),
+            'crisis': asyncio.Semaphore(crisis_limit or CRISIS_LANE_CONCURRENCY)
+        }
+        self.lane_stats = {
+            lane: {'processed': 0, 'waiting': 0, 'total_wait_ms': 0.0, 'max_wait_ms': 0.0}
+            for lane in self.lanes
+        }
+        # user_id -> [القفل، عدد التحديثات التي تحمله أو تنتظره]
+        self._user_locks = {}
+        self.serialized = 0
+        self._active = 0
+        self._handlers = set()
+        self._flag_writes = set()
+        self._abandoning = False
+        self.abandoned = set()
 
-        for resource in SUPPORT_RESOURCES['philosophical']:
-            relevance = 0
-            for tag in resource['tags']:
-                if tag in str(analysis_results).lower():
-                    relevance += 1
+    async def initialize(self):
+        pass
 
-            if relevance > 0:
-                relevant_resources.append({
-                    **resource,
-                    'relevance_score': relevance
-                })
+    async def shutdown(self):
+        pass
 
-        relevant_resources.sort(key=lambda x: x['relevance_score'], reverse=True)
-        return relevant_resources[:3]
+    @staticmethod
+    def _ordering_key(update):
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat is not None else None
+
+    async def process_update(self, update, coroutine):
+        """تصنيف التحديث قبل حد القبول العام بدل انتظاره في طابور القبول الموحد"""
+        await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        self._active += 1
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self._active -= 1
+
+    def _persist_crisis(self, update, crisis_signal):
+        """حفظ إشارة الأزمة في مهمة مستقلة لا تؤخر حجز مكان التحديث في طابور مستخدمه"""
+        self._active += 1
+        task = asyncio.ensure_future(self.on_crisis(update, *crisis_signal))
+        self._flag_writes.add(task)
+        task.add_done_callback(self._crisis_persisted)
+
+    def _crisis_persisted(self, task):
+        self._flag_writes.discard(task)
+        self._active -= 1
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"❌ خطأ في حفظ إشارة الأزمة: {task.exception()}")
+
+    async def _process(self, update, coroutine):
+        # لا انتظار قبل حجز القفل: أي await هنا يسمح لتحديث لاحق من المستخدم نفسه بالسبق
+        crisis_signal = self.detector.detect(update)
+        if crisis_signal:
+            self._persist_crisis(update, crisis_signal)
+
+        key = self._ordering_key(update)
+        if key is None:
+            await self._admit('crisis' if crisis_signal else 'normal', update, coroutine)
+            return
+
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.serialized += 1
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._admit('crisis' if crisis_signal else 'normal', update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    async def _admit(self, lane, update, coroutine):
+        """حد القبول العام للمسار العادي فقط؛ مسار الأزمات يدخل مباشرة"""
+        if lane == 'crisis':
+            await self._run_in_lane(lane, update, coroutine)
+            return
+        async with self._semaphore:
+            await self._run_in_lane(lane, update, coroutine)
+
+    async def _run_in_lane(self, lane, update, coroutine):
+        stats = self.lane_stats[lane]
+        entered = time.perf_counter()
+        stats['waiting'] += 1
+        async with self.lanes[lane]:
+            stats['waiting'] -= 1
+            if self._abandoning:
+                coroutine.close()
+                self._abandon(update)
+                return
+            wait_ms = (time.perf_counter() - entered) * 1000
+            stats['processed'] += 1
+            stats['total_wait_ms'] += wait_ms
+            stats['max_wait_ms'] = max(stats['max_wait_ms'], wait_ms)
+            handler = asyncio.ensure_future(coroutine)
+            self._handlers.add(handler)
+            try:
+                await handler
+            except asyncio.CancelledError:
+                # إلغاء بعد انتهاء مهلة التصريف يُبتلع حتى يكمل التطبيق إيقافه
+                if not (self._abandoning and handler.cancelled()):
+                    raise
+                self._abandon(update)
+            finally:
+                self._handlers.discard(handler)
+
+    def _abandon(self, update):
+        self.abandoned.add(getattr(update, 'update_id', None))
+
+    async def drain(self, timeout, abort=None):
+        """انتظار التحديثات الجارية والمنتظرة حتى المهلة ثم إلغاء ما تبقى؛ يعيد عدد الملغاة"""
+        deadline = time.monotonic() + timeout
+        while self._active and time.monotonic() < deadline and not (abort and abort.is_set()):
+            await asyncio.sleep(0.05)
+        if not self._active:
+            return 0
+        self._abandoning = True
+        for handler in list(self._handlers):
+            handler.cancel()
+        while self._active:
+            await asyncio.sleep(0.01)
+        logger.warning(f"⚠️ انتهت مهلة التصريف؛ أُلغي {len(self.abandoned)} تحديث")
+        return len(self.abandoned)
+
+    def stats(self):
+        return {
+            **{
+                lane: {**stats, 'avg_wait_ms': round(stats['total_wait_ms'] / stats['processed'], 3) if stats['processed'] else 0.0}
+                for lane, stats in self.lane_stats.items()
+            },
+            'active_users': len(self._user_locks),
+            'serialized_updates': self.serialized,
+            'in_flight': self._active
+        }
 
-class AdvancedMentalHealthBot:
-    """بوت الصحة النفسية المتقدم والشامل"""
+def compile_quote_pool():
+    """بناء قائمة الاقتباسات المنسقة من قاعدة المعرفة وموارد الدعم"""
+    all_quotes = []
+    for category in KNOWLEDGE_DATABASE.values():
+        for resource_type in category.values():
+            if isinstance(resource_type, dict):
+                for quote_source in resource_type.values():
+                    if isinstance(quote_source, dict):
+                        if 'text' in quote_source:
+                            all_quotes.append(f"*{quote_source['text']}* - {quote_source['source']}")
+                        elif 'ayah' in quote_source:
+                            all_quotes.append(f"*{quote_source['ayah']}* - {quote_source['reference']}\n{quote_source['tafseer']}")
+                    elif isinstance(quote_source, str):
+                        all_quotes.append(f"*{quote_source}*")
+
+    # إضافة موارد الدعم
+    for resource in SUPPORT_RESOURCES['religious']:
+        all_quotes.append(f"*{resource['title']}*\n{resource['content'][:200]}...")
+
+    for resource in SUPPORT_RESOURCES['philosophical']:
+        all_quotes.append(f"*{resource['title']}*\n{resource['content'][:200]}...")
+
+    return all_quotes
+
+class QuotePool:
+    """مجموعة اقتباسات مبنية مسبقاً مع كيس خلط محفوظ: لا تكرار قبل استنفاد المجموعة
+
+    الكيس يُخزن كبصمات 8 بايت للاقتباسات بترتيب السحب مع موضع المؤشر، فيستمر بعد
+    إعادة التشغيل، وعند تغير المحتوى تبقى الاقتباسات غير المسحوبة وتُخلط الجديدة معها.
+    """
+
+    DIGEST_SIZE = 8
+    FALLBACK_QUOTE = "🌟 *حكمة اليوم:* الحياة رحلة، استمتع بكل خطوة فيها"
+    SQL_LOAD = 'SELECT fingerprint, bag, cursor FROM quote_bags WHERE name = ?'
+    SQL_SAVE = 'INSERT OR REPLACE INTO quote_bags (name, fingerprint, bag, cursor, updated_at) VALUES (?, ?, ?, ?, ?)'
+
+    def __init__(self, db, name='channel', compiler=compile_quote_pool):
+        self.db = db
+        self.name = name
+        self.compiler = compiler
+        self.quotes = []
+        self.by_digest = {}
+        self.fingerprint = None
+        self.bag = []
+        self.cursor = 0
+        self._dirty = False
+        self._random = random.SystemRandom()
+        self.counters = {'draws': 0, 'reshuffles': 0, 'recompiles': 0}
+        self._compile()
+
+    def _digest(self, quote):
+        return hashlib.blake2b(quote.encode('utf-8'), digest_size=self.DIGEST_SIZE).digest()
+
+    def _compile(self):
+        """إعادة بناء المجموعة؛ يعيد True إذا تغير المحتوى"""
+        quotes = self.compiler()
+        fingerprint = hashlib.sha256('\x00'.join(quotes).encode('utf-8')).hexdigest()
+        if fingerprint == self.fingerprint:
+            return False
+        self.quotes = quotes
+        self.by_digest = {self._digest(quote): index for index, quote in enumerate(quotes)}
+        self.fingerprint = fingerprint
+        self.counters['recompiles'] += 1
+        return True
+
+    def _reshuffle(self, last_drawn=None):
+        bag = list(self.by_digest)
+        self._random.shuffle(bag)
+        # لا يتكرر آخر اقتباس عند بداية الدورة الجديدة
+        if len(bag) > 1 and bag[0] == last_drawn:
+            swap = self._random.randrange(1, len(bag))
+            bag[0], bag[swap] = bag[swap], bag[0]
+        self.bag = bag
+        self.cursor = 0
+        self._dirty = True
+        self.counters['reshuffles'] += 1
+
+    def _merge(self, stored_bag, cursor):
+        """مواءمة كيس محفوظ مع المحتوى الحالي: حذف المفقود وخلط الجديد مع ما لم يُسحب"""
+        drawn = [digest for digest in stored_bag[:cursor] if digest in self.by_digest]
+        remaining = [digest for digest in stored_bag[cursor:] if digest in self.by_digest]
+        known = set(stored_bag)
+        new = [digest for digest in self.by_digest if digest not in known]
+        for digest in new:
+            remaining.insert(self._random.randrange(len(remaining) + 1), digest)
+        self.bag = drawn + remaining
+        self.cursor = len(drawn)
+        self._dirty = bool(new) or len(self.bag) != len(stored_bag)
+
+    async def load(self):
+        """استعادة الكيس والمؤشر المحفوظين"""
+        row = await self.db.fetchone(self.SQL_LOAD, (self.name,))
+        if row is None:
+            self._reshuffle()
+            return
+        fingerprint, blob, cursor = row
+        size = self.DIGEST_SIZE
+        stored_bag = [bytes(blob[i:i + size]) for i in range(0, len(blob or b''), size)]
+        if fingerprint == self.fingerprint:
+            self.bag, self.cursor = stored_bag, cursor
+        else:
+            self._merge(stored_bag, cursor)
+            self._dirty = True
+
+    def refresh(self):
+        """إعادة بناء المجموعة عند تغير المحتوى فقط مع الحفاظ على تقدم الكيس"""
+        if self._compile():
+            self._merge(self.bag, self.cursor)
+            self._dirty = True
+
+    def draw(self):
+        """الاقتباس التالي من الكيس"""
+        if not self.quotes:
+            return self.FALLBACK_QUOTE
+        if self.cursor >= len(self.bag):
+            self._reshuffle(self.bag[-1] if self.bag else None)
+        digest = self.bag[self.cursor]
+        self.cursor += 1
+        self._dirty = True
+        self.counters['draws'] += 1
+        return self.quotes[self.by_digest[digest]]
+
+    async def save(self):
+        """حفظ الكيس والمؤشر إذا تغيرا"""
+        if not self._dirty:
+            return
+        self._dirty = False
+        await self.db.execute(self.SQL_SAVE, (
+            self.name, self.fingerprint, b''.join(self.bag), self.cursor, time.time()
+        ))
+
+    def stats(self):
+        return {**self.counters, 'size': len(self.quotes), 'cursor': self.cursor, 'bag': len(self.bag)}
+
+class TokenBucket:
+    """دلو رموز بمعدل ثابت وسعة صغيرة حتى يبقى الإرسال منتظماً عند السقف دون دفعات"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity=1.0, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """الثواني المتبقية حتى يتاح رمز"""
+        self._refill(now)
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def idle(self, now):
+        """دلو ممتلئ غير محظور لا يحمل حالة يجب حفظها"""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+class OutboundMessage:
+    """طلب إرسال في الطابور: استدعاء Bot API ومحادثته وأولويته ومستقبل نتيجته"""
+
+    __slots__ = ('method', 'chat_id', 'kwargs', 'priority', 'future', 'attempts')
+
+    def __init__(self, method, chat_id, kwargs, priority, future):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+
+class OutboundQueue:
+    """طابور الإرسال الصادر المركزي: دلو عام ودلاء لكل محادثة وفئات أولوية
+
+    المرسل الواحد يسحب أعلى طلب أولوية تتاح محادثته، والطلبات التي تنتظر دلو محادثتها
+    تُؤجل دون أن تحجز من خلفها. RetryAfter يوقف الإرسال كله المدة المطلوبة، لأن حد الإغراق
+    لدى تيليجرام يشمل البوت لا المحادثة وحدها، ثم يعيد الطلب، وأخطاء الشبكة المتتالية تفتح قاطع الدائرة فيتوقف الإرسال حتى تنجح محاولة اختبار.
+    """
+
+    PRIORITY_INTERACTIVE = 0
+    PRIORITY_NOTIFY = 1
+    PRIORITY_BULK = 2
+
+    def __init__(self, global_rate=None, chat_rate=None, group_rate=None):
+        self.global_rate = global_rate or SEND_GLOBAL_RATE
+        self.chat_rate = chat_rate or SEND_CHAT_RATE
+        self.group_rate = group_rate or SEND_GROUP_RATE
+        self.bot = None
+        self._global = TokenBucket(self.global_rate)
+        self._chat_buckets = {}
+        self._ready = []
+        self._deferred = []
+        # مهمة الإرسال الجارية -> رسالتها، لإفشال رسائل المهام الملغاة عند الإغلاق
+        self._inflight = {}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self.counters = {
+            'sent': 0, 'failed': 0, 'retry_after': 0, 'network_errors': 0,
+            'retries': 0, 'breaker_trips': 0, 'deferred': 0
+        }
 
-    def __init__(self):
-        self.db = AdvancedMentalHealthDatabase()
-        self.analysis_service = PsychologicalAnalysisService()
-        self.user_sessions = {}
-        self.scheduler_task = None
+    def start(self, application):
+        self.bot = application.bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch())
+
+    async def send(self, method, chat_id, priority=PRIORITY_BULK, **kwargs):
+        """إدراج استدعاء Bot API في الطابور وانتظار نتيجته؛ يرفع الخطأ النهائي إن فشل"""
+        message = OutboundMessage(method, chat_id, kwargs, priority, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._ready, (priority, next(self._seq), message))
+        self._wakeup.set()
+        return await message.future
+
+    async def send_message(self, chat_id, text, priority=PRIORITY_BULK, **kwargs):
+        return await self.send('send_message', chat_id, priority, text=text, **kwargs)
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= SEND_CHAT_BUCKET_CAP:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle(now)}
+            # المعرفات السالبة وأسماء @ مجموعات أو قنوات بحد أبطأ
+            group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if group else self.chat_rate, now=now)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next_wait(self, now):
+        """مدة انتظار المرسل، أو 0 إذا أمكن الإرسال الآن، أو None حتى يصل طلب"""
+        if now < self._open_until:
+            return self._open_until - now
+        if self._probing or len(self._inflight) >= SEND_MAX_INFLIGHT:
+            return None
+        if not self._ready:
+            return self._deferred[0][0] - now if self._deferred else None
+        return self._global.wait_time(now)
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            while self._deferred and self._deferred[0][0] <= now:
+                _, priority, seq, message = heapq.heappop(self._deferred)
+                heapq.heappush(self._ready, (priority, seq, message))
+
+            wait = self._next_wait(now)
+            if wait is not None and wait <= 0:
+                priority, seq, message = heapq.heappop(self._ready)
+                if message.future.done():
+                    continue
+                bucket = self._chat_bucket(message.chat_id, now)
+                chat_wait = bucket.wait_time(now)
+                if chat_wait > 0:
+                    heapq.heappush(self._deferred, (now + chat_wait, priority, seq, message))
+                    self.counters['deferred'] += 1
+                    continue
+                bucket.take(now)
+                self._global.take(now)
+                # بعد انتهاء مهلة القاطع يمر طلب اختبار واحد فقط
+                probe = self._failures >= SEND_BREAKER_THRESHOLD
+                if probe:
+                    self._probing = True
+                task = asyncio.create_task(self._deliver(message, seq, bucket, probe))
+                self._inflight[task] = message
+                task.add_done_callback(self._delivered)
+                continue
 
-    async def schedule_daily_quotes(self):
-        """جدولة إرسال الاقتباسات اليومية"""
-        async def send_scheduled_quote():
             try:
-                # هنا يتم جلب اقتباس عشوائي من قاعدة المعرفة
-                quote = self.get_random_quote()
-                if quote:
-                    bot = Bot(token=TOKEN)
-                    await bot.send_message(chat_id=CHANNEL_ID, text=quote, parse_mode='Markdown')
-                    logger.info(f"✅ تم إرسال اقتباس يومي إلى القناة: {CHANNEL_ID}")
-                else:
-                    logger.warning("⚠️ لم يتم العثور على اقتباس لإرساله للقناة.")
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _delivered(self, task):
+        self._inflight.pop(task, None)
+
+    def _requeue(self, message, seq, delay):
+        message.attempts += 1
+        self.counters['retries'] += 1
+        heapq.heappush(self._deferred, (time.monotonic() + delay, message.priority, seq, message))
+
+    def _fail(self, message, error):
+        self.counters['failed'] += 1
+        if not message.future.done():
+            message.future.set_exception(error)
+
+    async def _deliver(self, message, seq, bucket, probe=False):
+        try:
+            result = await getattr(self.bot, message.method)(chat_id=message.chat_id, **message.kwargs)
+        except RetryAfter as e:
+            self.counters['retry_after'] += 1
+            delay = float(e.retry_after)
+            blocked_until = time.monotonic() + delay
+            bucket.blocked_until = blocked_until
+            self._global.blocked_until = max(self._global.blocked_until, blocked_until)
+            logger.warning(f"⚠️ RetryAfter للمحادثة {message.chat_id}: إيقاف الإرسال {delay} ثانية")
+            if message.attempts < SEND_MAX_RETRIES:
+                self._requeue(message, seq, delay)
+            else:
+                self._fail(message, e)
+        except BadRequest as e:
+            self._fail(message, e)
+        except NetworkError as e:
+            self.counters['network_errors'] += 1
+            self._failures += 1
+            if self._failures >= SEND_BREAKER_THRESHOLD and time.monotonic() >= self._open_until:
+                self._open_until = time.monotonic() + SEND_BREAKER_COOLDOWN
+                self.counters['breaker_trips'] += 1
+                logger.error(f"❌ فتح قاطع الإرسال لمدة {SEND_BREAKER_COOLDOWN} ثانية بعد {self._failures} أخطاء شبكة: {e}")
+            if message.attempts < SEND_MAX_RETRIES:
+                self._requeue(message, seq, min(30.0, 0.5 * 2 ** message.attempts))
+            else:
+                self._fail(message, e)
+        except Exception as e:
+            self._fail(message, e)
+        else:
+            self._failures = 0
+            self.counters['sent'] += 1
+            if not message.future.done():
+                message.future.set_result(result)
+        finally:
+            # طلب الاختبار وحده يرفع علم الاختبار؛ نجاح طلب سابق له لا يفتح الباب لغيره
+            if probe:
+                self._probing = False
+            self._wakeup.set()
+
+    def pending(self):
+        return len(self._ready) + len(self._deferred) + len(self._inflight)
+
+    async def close(self, timeout=None):
+        """انتظار تفريغ الطابور حتى المهلة ثم إيقاف المرسل وإفشال ما تبقى"""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + (SEND_DRAIN_SECONDS if timeout is None else timeout)
+        while self.pending() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        inflight = list(self._inflight.items())
+        for task, _ in inflight:
+            task.cancel()
+        await asyncio.gather(*(task for task, _ in inflight), return_exceptions=True)
+        leftovers = [message for _, message in inflight if not message.future.done()]
+        leftovers += [entry[-1] for entry in self._ready + self._deferred]
+        self._ready.clear()
+        self._deferred.clear()
+        for message in leftovers:
+            self._fail(message, RuntimeError("أُغلق طابور الإرسال قبل إرسال الرسالة"))
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            **self.counters,
+            'queued': len(self._ready),
+            'waiting': len(self._deferred),
+            'inflight': len(self._inflight),
+            'chat_buckets': len(self._chat_buckets),
+            'breaker': 'open' if now < self._open_until else ('half_open' if self._failures >= SEND_BREAKER_THRESHOLD else 'closed'),
+            'global_rate': self.global_rate
+        }
+
+class JobScheduler:
+    """مجدول مهام دورية بمخزن SQLite ومؤقت واحد لجميع المهام
+
+    المهام في كومة مرتبة بوقت التشغيل التالي ينتظرها مؤقت واحد. قبل التنفيذ يُحجز
+    الموعد التالي بتحديث مشروط على next_run، فلا تُنفذ المهمة مرتين بعد انقطاع أو
+    من عمليتين، والمواعيد الفائتة أثناء التوقف تُعوَّض بتشغيل واحد فقط.
+    """
+
+    SQL_LOAD = '''
+    SELECT name, kind, interval_seconds, payload, next_run, last_run, last_status, run_count
+    FROM scheduled_jobs WHERE enabled = 1
+    '''
+    SQL_LOAD_ONE = SQL_LOAD + ' AND name = ?'
+    SQL_ENSURE = '''
+    INSERT OR IGNORE INTO scheduled_jobs (name, kind, interval_seconds, payload, next_run, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    SQL_CLAIM = 'UPDATE scheduled_jobs SET next_run = ?, updated_at = ? WHERE name = ? AND next_run = ?'
+    SQL_FINISH = '''
+    UPDATE scheduled_jobs SET last_run = ?, last_status = ?, run_count = run_count + 1, updated_at = ?
+    WHERE name = ?
+    '''
+
+    def __init__(self, db, jitter_seconds=None):
+        self.db = db
+        self.jitter = SCHEDULER_JITTER_SECONDS if jitter_seconds is None else jitter_seconds
+        self.handlers = {}
+        self.jobs = {}
+        self.application = None
+        self._heap = []
+        self._wakeup = None
+        self._task = None
+        self._current = None
+        self.counters = {'runs': 0, 'failures': 0, 'catch_ups': 0, 'skipped_slots': 0, 'lost_claims': 0}
+
+    def register(self, kind, handler):
+        """تسجيل معالج نوع مهمة: async handler(application, job)"""
+        self.handlers[kind] = handler
+
+    @staticmethod
+    def _job_from_row(row):
+        name, kind, interval_seconds, payload, next_run, last_run, last_status, run_count = row
+        return {
+            'name': name, 'kind': kind, 'interval_seconds': interval_seconds,
+            'payload': json.loads(payload) if payload else {}, 'next_run': next_run,
+            'last_run': last_run, 'last_status': last_status, 'run_count': run_count, 'version': 0
+        }
+
+    def _schedule(self, job):
+        """إدخال المهمة في الكومة بموعدها مع إزاحة عشوائية؛ الإدخالات السابقة تصبح ملغاة"""
+        job['version'] += 1
+        fire_at = job['next_run'] + random.uniform(0, self.jitter)
+        heapq.heappush(self._heap, (fire_at, job['name'], job['version']))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def ensure_job(self, name, kind, interval_seconds, first_run, payload=None):
+        """إنشاء المهمة إن لم تكن موجودة؛ المهمة الموجودة تحتفظ بمواعيدها المحفوظة"""
+        await self.db.execute(self.SQL_ENSURE, (
+            name, kind, interval_seconds, json.dumps(payload or {}), first_run, time.time()
+        ))
+        row = await self.db.fetchone(self.SQL_LOAD_ONE, (name,))
+        if row is not None:
+            job = self._job_from_row(row)
+            job['version'] = self.jobs[name]['version'] if name in self.jobs else 0
+            self.jobs[name] = job
+            self._schedule(job)
+
+    async def start(self, application):
+        """تحميل المهام المحفوظة وتشغيل المؤقت"""
+        self.application = application
+        self._wakeup = asyncio.Event()
+        for row in await self.db.fetchall(self.SQL_LOAD):
+            job = self._job_from_row(row)
+            self.jobs[job['name']] = job
+            self._schedule(job)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                if not self._heap:
+                    await self._wakeup.wait()
+                    self._wakeup.clear()
+                    continue
+                fire_at, name, version = self._heap[0]
+                delay = fire_at - time.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+                    continue
+                heapq.heappop(self._heap)
+                job = self.jobs.get(name)
+                if job is not None and job['version'] == version:
+                    # التنفيذ محمي من إلغاء المؤقت حتى يكتمل المنشور وتُسجل حالته عند الإيقاف
+                    self._current = asyncio.create_task(self._execute(job))
+                    await asyncio.shield(self._current)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"❌ خطأ في إرسال الاقتباس الدوري: {e}")
+                logger.error(f"❌ خطأ في المجدول: {e}")
+                await asyncio.sleep(1)
+
+    async def _execute(self, job):
+        now = time.time()
+        due = job['next_run']
+        interval = job['interval_seconds']
+        next_run = due + interval
+        if next_run <= now:
+            # مواعيد فائتة أثناء التوقف: تشغيل تعويضي واحد ثم أول موعد قادم
+            skipped = int((now - next_run) // interval) + 1
+            next_run += skipped * interval
+            self.counters['catch_ups'] += 1
+            self.counters['skipped_slots'] += skipped
+
+        claimed = await self.db.execute(self.SQL_CLAIM, (next_run, now, job['name'], due))
+        if not claimed:
+            # عملية أخرى حجزت هذا الموعد؛ إعادة تحميل المهمة من المخزن
+            self.counters['lost_claims'] += 1
+            row = await self.db.fetchone(self.SQL_LOAD_ONE, (job['name'],))
+            if row is not None:
+                job.update({key: value for key, value in self._job_from_row(row).items() if key != 'version'})
+                self._schedule(job)
+            return
+
+        job['next_run'] = next_run
+        self._schedule(job)
+
+        handler = self.handlers.get(job['kind'])
+        try:
+            if handler is None:
+                raise LookupError(f"لا يوجد معالج لنوع المهمة {job['kind']}")
+            await handler(self.application, job)
+            status = 'ok'
+            self.counters['runs'] += 1
+        except Exception as e:
+            status = f'error: {e}'
+            self.counters['failures'] += 1
+            logger.error(f"❌ خطأ في تنفيذ المهمة المجدولة {job['name']}: {e}")
+
+        job['last_run'] = now
+        job['last_status'] = status
+        job['run_count'] = (job['run_count'] or 0) + 1
+        await self.db.execute(self.SQL_FINISH, (now, status, time.time(), job['name']))
+
+    async def close(self, timeout=None):
+        """إيقاف المؤقت بعد انتظار المهمة الجارية حتى المهلة"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._current and not self._current.done():
+            done, _ = await asyncio.wait((self._current,), timeout=SHUTDOWN_DRAIN_SECONDS if timeout is None else timeout)
+            if not done:
+                self._current.cancel()
+
+    def status(self):
+        """الموعد التالي وآخر تشغيل وحالته لكل مهمة"""
+        def iso(timestamp):
+            return datetime.fromtimestamp(timestamp).isoformat(timespec='seconds') if timestamp else None
+        return {
+            name: {
+                'kind': job['kind'], 'next_run': iso(job['next_run']), 'last_run': iso(job['last_run']),
+                'last_status': job['last_status'], 'run_count': job['run_count']
+            }
+            for name, job in self.jobs.items()
+        }
 
-        async def run_scheduler():
-            while True:
+    def stats(self):
+        return {**self.counters, 'jobs': len(self.jobs), 'pending_timers': len(self._heap), 'status': self.status()}
+
+class FollowUpReminderEngine:
+    """محرك تذكيرات المتابعة: الجدول المفهرس بالموعد هو الكومة، والذاكرة لا تحمل إلا الدفعة الجارية
+
+    ينام المحرك حتى أقرب موعد (استعلام MIN على الفهرس) أو حتى يُجدول تذكير أقرب،
+    ثم يرسل المستحق على دفعات بمعدل محدود. لا شيء يُحمّل عند الإقلاع.
+    """
+
+    SQL_NEXT_DUE = 'SELECT MIN(due_at) FROM follow_up_reminders'
+    SQL_DUE = '''
+    SELECT user_id, assessment_type, severity, due_at, attempts
+    FROM follow_up_reminders WHERE due_at <= ? ORDER BY due_at LIMIT ?
+    '''
+    # الحذف والتأجيل مشروطان بالموعد حتى لا يلغيا تذكيراً جديداً جُدول أثناء الإرسال
+    SQL_DONE = 'DELETE FROM follow_up_reminders WHERE user_id = ? AND assessment_type = ? AND due_at = ?'
+    SQL_RETRY = '''
+    UPDATE follow_up_reminders SET due_at = ?, attempts = attempts + 1
+    WHERE user_id = ? AND assessment_type = ? AND due_at = ?
+    '''
+    SQL_CANCEL_USER = 'DELETE FROM follow_up_reminders WHERE user_id = ?'
+
+    def __init__(self, db, sender, send_rate=None, batch_size=None):
+        self.db = db
+        self.sender = sender
+        self.send_rate = send_rate or FOLLOW_UP_SEND_RATE
+        self.batch_size = batch_size or FOLLOW_UP_BATCH_SIZE
+        self._next_due = None
+        self._wakeup = None
+        self._task = None
+        self._poll_seconds = None
+        self._stopping = False
+        self.counters = {'sent': 0, 'retried': 0, 'dropped': 0, 'blocked': 0, 'batches': 0, 'wakeups': 0}
+
+    @staticmethod
+    def due_at(assessment_type, severity, now=None):
+        """موعد التذكير لنتيجة مقياس حسب نطاق شدتها، أو None للمقاييس دون متابعة"""
+        scale = SCREENING_SCALES.get(assessment_type)
+        band = scale.by_severity.get(severity) if scale else None
+        if not band or 'follow_up_days' not in band:
+            return None
+        return (now or time.time()) + band['follow_up_days'] * 86400
+
+    def notify(self, due_at):
+        """إيقاظ المحرك إن جُدول تذكير أقرب من الموعد الذي ينتظره"""
+        if self._wakeup is not None and (self._next_due is None or due_at < self._next_due):
+            self._wakeup.set()
+
+    def start(self, poll_seconds=None):
+        """بدء الانتظار؛ لا يقرأ إلا أقرب موعد عند أول دورة
+
+        عند تعدد العمال لا يصل notify من العمليات الأخرى، فيُعاد قراءة أقرب موعد كل poll_seconds.
+        """
+        self._poll_seconds = poll_seconds
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                row = await self.db.fetchone(self.SQL_NEXT_DUE)
+                self._next_due = row[0] if row else None
+                delay = None if self._next_due is None else self._next_due - time.time()
+                if self._poll_seconds:
+                    delay = self._poll_seconds if delay is None else min(delay, self._poll_seconds)
+                if delay is None or delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+                    continue
+                self.counters['wakeups'] += 1
+                await self._drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ خطأ في محرك تذكيرات المتابعة: {e}")
+                await asyncio.sleep(5)
+
+    async def _drain(self):
+        """إرسال كل التذكيرات المستحقة على دفعات بمعدل send_rate في الثانية؛ السقف الفعلي يفرضه طابور الإرسال"""
+        while True:
+            now = time.time()
+            rows = await self.db.fetchall(self.SQL_DUE, (now, self.batch_size))
+            if not rows:
+                return
+            self.counters['batches'] += 1
+            for start in range(0, len(rows), self.send_rate):
+                if self._stopping:
+                    return
+                window = rows[start:start + self.send_rate]
+                started = time.monotonic()
+                outcomes = await asyncio.gather(*(self._send(row) for row in window))
+                done = [key for key, retry in outcomes if retry is None]
+                retries = [(retry, *key) for key, retry in outcomes if retry is not None]
+                if done:
+                    await self.db.executemany(self.SQL_DONE, done)
+                if retries:
+                    await self.db.executemany(self.SQL_RETRY, retries)
+                await asyncio.sleep(max(0.0, 1.0 - (time.monotonic() - started)))
+
+    async def _send(self, row):
+        """إرسال تذكير واحد؛ يعيد مفتاح الصف وموعد الإعادة أو None عند الانتهاء منه"""
+        user_id, assessment_type, severity, due_at, attempts = row
+        key = (user_id, assessment_type, due_at)
+        try:
+            await self.sender(user_id, assessment_type, severity)
+            self.counters['sent'] += 1
+            return key, None
+        except Forbidden:
+            # المستخدم حظر البوت
+            self.counters['blocked'] += 1
+            return key, None
+        except Exception as e:
+            if attempts + 1 >= FOLLOW_UP_MAX_ATTEMPTS:
+                self.counters['dropped'] += 1
+                logger.warning(f"⚠️ إسقاط تذكير المتابعة للمستخدم {user_id} بعد {attempts + 1} محاولات: {e}")
+                return key, None
+            self.counters['retried'] += 1
+            return key, time.time() + FOLLOW_UP_RETRY_SECONDS
+
+    async def cancel_user(self, user_id):
+        """إلغاء جميع تذكيرات المستخدم"""
+        return await self.db.execute(self.SQL_CANCEL_USER, (user_id,))
+
+    async def close(self, timeout=None):
+        """إيقاف المحرك بعد إكمال نافذة الإرسال الجارية؛ التذكيرات تبقى في الجدول للتشغيل التالي"""
+        self._stopping = True
+        if self._task and not self._task.done():
+            self._wakeup.set()
+            done, _ = await asyncio.wait((self._task,), timeout=SHUTDOWN_DRAIN_SECONDS if timeout is None else timeout)
+            if not done:
+                self._task.cancel()
                 try:
-                    now = datetime.now()
-                    next_run = now + timedelta(hours=6)
-                    next_run = next_run.replace(minute=0, second=0, microsecond=0)
-                    wait_seconds = (next_run - now).total_seconds()
-                    await asyncio.sleep(wait_seconds)
-                    await send_scheduled_quote()
-                except Exception as e:
-                    logger.error(f"❌ خطأ في جدولة الرسائل: {e}")
-                    await asyncio.sleep(3600)  # انتظار ساعة في حالة الخطأ
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+
+    def stats(self):
+        next_due = datetime.fromtimestamp(self._next_due).isoformat(timespec='seconds') if self._next_due else None
+        return {**self.counters, 'next_due': next_due}
+
+class BroadcastEngine:
+    """بث رسالة إلى جميع المستخدمين عبر طابور الإرسال مع استئناف بعد الانقطاع
+
+    المعرفات تُقرأ صفحةً صفحة بترقيم المفاتيح (user_id > آخر معرف) دون تحميل الجدول،
+    وتبقى نافذة من الرسائل المعلقة حتى يعمل الطابور عند سقفه باستمرار. نقطة الاستئناف
+    هي أكبر معرف اكتملت كل الرسائل قبله، فلا يُعاد بعد الاستئناف إلا ما كان معلقاً.
+    """
+
+    SQL_CREATE = '''
+    INSERT INTO broadcasts (text, parse_mode, status, total, created_by, created_at, updated_at)
+    VALUES (?, ?, 'running', ?, ?, ?, ?)
+    '''
+    SQL_COUNT_RECIPIENTS = 'SELECT COUNT(*) FROM users WHERE blocked_at IS NULL'
+    SQL_PAGE = 'SELECT user_id FROM users WHERE user_id > ? AND blocked_at IS NULL ORDER BY user_id LIMIT ?'
+    SQL_LOAD = '''
+    SELECT id, text, parse_mode, status, last_user_id, total, sent, failed, blocked
+    FROM broadcasts WHERE id = ?
+    '''
+    SQL_RUNNING = "SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id"
+    SQL_RECENT = '''
+    SELECT id, status, total, sent, failed, blocked, created_at, updated_at
+    FROM broadcasts ORDER BY id DESC LIMIT ?
+    '''
+    SQL_STATUS = 'SELECT status FROM broadcasts WHERE id = ?'
+    # الإلغاء من عامل آخر لا تمحوه نقطة حفظ لاحقة من العامل المنفذ
+    SQL_CHECKPOINT = '''
+    UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ?,
+        status = CASE WHEN status = 'cancelled' THEN status ELSE ? END, updated_at = ?
+    WHERE id = ?
+    '''
+    SQL_SET_STATUS = 'UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ?'
+
+    def __init__(self, db, outbox):
+        self.db = db
+        self.outbox = outbox
+        self.active = {}
+        self._tasks = {}
+        # المنفذ وحده يطلق البث؛ في وضع العمال هو العامل 0 ويلتقط ما سجله الآخرون بالاستطلاع
+        self._launcher = False
+        self._watcher = None
+
+    async def create(self, text, parse_mode=None, created_by=None):
+        """إنشاء بث جديد وبدؤه إن كانت هذه العملية منفذ البث؛ يعيد معرفه"""
+        total = (await self.db.fetchone(self.SQL_COUNT_RECIPIENTS))[0]
+        now = time.time()
+        broadcast_id = await self.db.write(lambda conn: conn.execute(
+            self.SQL_CREATE, (text, parse_mode, total, created_by, now, now)
+        ).lastrowid)
+        if self._launcher:
+            await self._launch(broadcast_id)
+        return broadcast_id
+
+    async def start(self, poll_seconds=None):
+        """جعل هذه العملية منفذ البث: استئناف المنقطع، واستطلاع قاعدة البيانات عند تعدد العمال"""
+        self._launcher = True
+        await self.resume_pending()
+        if poll_seconds:
+            self._watcher = asyncio.create_task(self._watch(poll_seconds))
+
+    async def _watch(self, poll_seconds):
+        """إطلاق البث المسجل من عمال آخرين وإيقاف ما ألغوه"""
+        while True:
+            await asyncio.sleep(poll_seconds)
+            try:
+                for (broadcast_id,) in await self.db.fetchall(self.SQL_RUNNING):
+                    if broadcast_id not in self._tasks:
+                        await self._launch(broadcast_id)
+                        logger.info(f"✅ بدء البث {broadcast_id} المسجل من عامل آخر")
+                for broadcast_id, task in list(self._tasks.items()):
+                    row = await self.db.fetchone(self.SQL_STATUS, (broadcast_id,))
+                    if row and row[0] == 'cancelled' and broadcast_id in self.active:
+                        self.active[broadcast_id]['status'] = 'cancelled'
+                        task.cancel()
+            except Exception as e:
+                logger.error(f"❌ خطأ في استطلاع البث: {e}")
+
+    async def resume_pending(self):
+        """استئناف البث المنقطع عند الإقلاع"""
+        for (broadcast_id,) in await self.db.fetchall(self.SQL_RUNNING):
+            await self._launch(broadcast_id)
+            logger.info(f"✅ استئناف البث {broadcast_id}")
+
+    async def _launch(self, broadcast_id):
+        row = await self.db.fetchone(self.SQL_LOAD, (broadcast_id,))
+        if row is None or broadcast_id in self._tasks:
+            return
+        _, text, parse_mode, status, last_user_id, total, sent, failed, blocked = row
+        progress = {
+            'id': broadcast_id, 'text': text, 'parse_mode': parse_mode, 'status': status,
+            'last_user_id': last_user_id, 'total': total, 'sent': sent, 'failed': failed, 'blocked': blocked,
+            'resumed_from': sent + failed + blocked, 'started': time.monotonic()
+        }
+        self.active[broadcast_id] = progress
+        task = asyncio.create_task(self._run(progress))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _pages(self, after_user_id):
+        while True:
+            rows = await self.db.fetchall(self.SQL_PAGE, (after_user_id, BROADCAST_PAGE_SIZE))
+            if not rows:
+                return
+            for (user_id,) in rows:
+                yield user_id
+            after_user_id = rows[-1][0]
 
-        # تشغيل الجدولة في مهمة خلفية
-        if not self.scheduler_task or self.scheduler_task.done():
-            self.scheduler_task = asyncio.create_task(run_scheduler())
+    async def _send_one(self, progress, user_id):
+        try:
+            await self.outbox.send_message(
+                user_id, progress['text'], priority=OutboundQueue.PRIORITY_BULK, parse_mode=progress['parse_mode']
+            )
+            return 'sent'
+        except Forbidden:
+            return 'blocked'
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر إرسال البث {progress['id']} للمستخدم {user_id}: {e}")
+            return 'failed'
+
+    async def _checkpoint(self, progress, blocked_ids, status='running'):
+        if blocked_ids:
+            await self.db.mark_users_blocked(blocked_ids)
+            blocked_ids.clear()
+        await self.db.execute(self.SQL_CHECKPOINT, (
+            progress['last_user_id'], progress['sent'], progress['failed'], progress['blocked'],
+            status, time.time(), progress['id']
+        ))
+
+    async def _run(self, progress):
+        window = deque()
+        blocked_ids = []
+        last_checkpoint = time.monotonic()
+
+        async def settle(wait_for_oldest):
+            # تقدم نقطة الاستئناف فقط على الرسائل المكتملة من بداية النافذة
+            nonlocal last_checkpoint
+            if wait_for_oldest:
+                await asyncio.wait((window[0][1],))
+            while window and window[0][1].done():
+                user_id, task = window.popleft()
+                outcome = task.result()
+                progress[outcome] += 1
+                progress['last_user_id'] = user_id
+                if outcome == 'blocked':
+                    blocked_ids.append(user_id)
+            if time.monotonic() - last_checkpoint >= BROADCAST_CHECKPOINT_SECONDS:
+                await self._checkpoint(progress, blocked_ids)
+                last_checkpoint = time.monotonic()
 
-    def get_random_quote(self):
-        """الحصول على اقتباس عشوائي من قاعدة المعرفة"""
-        all_quotes = []
-        for category in KNOWLEDGE_DATABASE.values():
-            for resource_type in category.values():
-                if isinstance(resource_type, dict):
-                    for quote_source in resource_type.values():
-                        if isinstance(quote_source, dict):
-                            if 'text' in quote_source:
-                                all_quotes.append(f"*{quote_source['text']}* - {quote_source['source']}")
-                            elif 'ayah' in quote_source:
-                                all_quotes.append(f"*{quote_source['ayah']}* - {quote_source['reference']}\n{quote_source['tafseer']}")
-                        elif isinstance(quote_source, str):
-                            all_quotes.append(f"*{quote_source}*")
-
-        # إضافة موارد الدعم
-        for resource in SUPPORT_RESOURCES['religious']:
-            all_quotes.append(f"*{resource['title']}*\n{resource['content'][:200]}...")
-
-        for resource in SUPPORT_RESOURCES['philosophical']:
-            all_quotes.append(f"*{resource['title']}*\n{resource['content'][:200]}...")
-
-        if all_quotes:
-            return random.choice(all_quotes)
+        try:
+            async for user_id in self._pages(progress['last_user_id']):
+                while len(window) >= BROADCAST_WINDOW:
+                    await settle(True)
+                window.append((user_id, asyncio.create_task(self._send_one(progress, user_id))))
+                await settle(False)
+            while window:
+                await settle(True)
+            progress['status'] = 'done'
+            await self._checkpoint(progress, blocked_ids, 'done')
+            logger.info(
+                f"✅ اكتمل البث {progress['id']}: {progress['sent']} مرسلة، "
+                f"{progress['blocked']} حاظرة، {progress['failed']} فاشلة"
+            )
+        except asyncio.CancelledError:
+            # إيقاف أو إلغاء: حفظ ما اكتمل فقط؛ الحالة تحدد هل يُستأنف عند الإقلاع
+            for _, task in window:
+                task.cancel()
+            await self._checkpoint(progress, blocked_ids, progress['status'])
+            raise
+        except Exception as e:
+            logger.error(f"❌ خطأ في البث {progress['id']}: {e}")
+            await self._checkpoint(progress, blocked_ids)
+        finally:
+            self.active.pop(progress['id'], None)
+
+    async def cancel(self, broadcast_id):
+        """إلغاء بث جارٍ نهائياً"""
+        task = self._tasks.get(broadcast_id)
+        if task is None:
+            return bool(await self.db.execute(self.SQL_SET_STATUS, ('cancelled', time.time(), broadcast_id)))
+        self.active[broadcast_id]['status'] = 'cancelled'
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def close(self):
+        """إيقاف البث الجاري مع حفظ نقطة الاستئناف؛ يُستأنف في التشغيل التالي"""
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def progress(self):
+        """تقدم كل بث جارٍ مع المعدل والوقت المتبقي المتوقع"""
+        report = []
+        for progress in self.active.values():
+            done = progress['sent'] + progress['failed'] + progress['blocked']
+            elapsed = time.monotonic() - progress['started']
+            rate = (done - progress['resumed_from']) / elapsed if elapsed > 0 else 0.0
+            remaining = max(0, progress['total'] - done)
+            report.append({
+                'id': progress['id'], 'done': done, 'total': progress['total'],
+                'sent': progress['sent'], 'blocked': progress['blocked'], 'failed': progress['failed'],
+                'percent': round(100 * done / progress['total'], 1) if progress['total'] else 100.0,
+                'rate_per_second': round(rate, 1),
+                'eta_seconds': round(remaining / rate) if rate > 0 else None
+            })
+        return report
+
+    async def recent(self, limit=5):
+        return await self.db.fetchall(self.SQL_RECENT, (limit,))
+
+    def stats(self):
+        return {'active': self.progress()}
+
+class RenderCache:
+    """ذاكرة الشاشات المعروضة: الثابتة تُبنى مرة واحدة عند الإقلاع، والمعاملة في LRU محدود
+
+    القيمة المخزنة غالباً (النص، InlineKeyboardMarkup)؛ كلاهما غير قابل للتعديل
+    فيمكن مشاركتهما بين جميع المستخدمين.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize or RENDER_CACHE_SIZE
+        self._static = {}
+        self._lru = OrderedDict()
+        self.counters = {'static_hits': 0, 'hits': 0, 'misses': 0}
+
+    def precompute(self, key, builder):
+        """بناء شاشة ثابتة وتخزينها دون حد"""
+        self._static[key] = builder()
+
+    def __contains__(self, key):
+        return key in self._static or key in self._lru
+
+    def screen(self, key):
+        """شاشة ثابتة مبنية مسبقاً"""
+        self.counters['static_hits'] += 1
+        return self._static[key]
+
+    def cached(self, key, builder):
+        """شاشة معاملة: من الذاكرة الثابتة أو LRU، أو تُبنى وتُخزن"""
+        value = self._static.get(key)
+        if value is not None:
+            self.counters['static_hits'] += 1
+            return value
+        value = self._lru.get(key)
+        if value is not None:
+            self._lru.move_to_end(key)
+            self.counters['hits'] += 1
+            return value
+        self.counters['misses'] += 1
+        value = builder()
+        self._lru[key] = value
+        if len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+        return value
+
+    def stats(self):
+        return {**self.counters, 'static': len(self._static), 'lru': len(self._lru)}
+
+class MessageEditGuard:
+    """منع استدعاءات Bot API عديمة الأثر
+
+    يحفظ بصمة آخر محتوى عُرض في كل رسالة فيتخطى التعديل المطابق، ويجمع الضغطات
+    المكررة على نفس الزر ونفس محتوى الرسالة خلال نافذة قصيرة. البصمة محلية للعملية،
+    لذا لا يُتخطى التعديل إلا إذا طابقت أزرار الرسالة الواردة مع الاستدعاء الأزرار الجديدة.
+    """
+
+    def __init__(self, capacity=None, dedup_window=None):
+        self.capacity = capacity or EDIT_TRACK_CAP
+        self.dedup_window = CALLBACK_DEDUP_SECONDS if dedup_window is None else dedup_window
+        self._digests = OrderedDict()
+        self._recent_callbacks = OrderedDict()
+        self.counters = {'edits': 0, 'skipped_unchanged': 0, 'not_modified_errors': 0, 'duplicate_callbacks': 0}
+
+    @staticmethod
+    def _message_key(query):
+        message = query.message
+        if message is not None:
+            return message.chat_id, message.message_id
+        return query.inline_message_id
+
+    @staticmethod
+    def _digest(text, reply_markup):
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16)
+        if reply_markup is not None:
+            digest.update(reply_markup.to_json().encode('utf-8'))
+        return digest.digest()
+
+    @staticmethod
+    def _shows_markup(query, reply_markup):
+        """هل تعرض الرسالة كما وصلت مع الاستدعاء هذه الأزرار؟ (الرسائل المضمنة لا تصل بمحتواها)"""
+        message = query.message
+        if message is None:
+            return True
+        return message.reply_markup == reply_markup
+
+    def _remember(self, key, digest):
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        if len(self._digests) > self.capacity:
+            self._digests.popitem(last=False)
+
+    async def edit_message_text(self, query, text, reply_markup=None, **kwargs):
+        """تعديل الرسالة فقط إذا تغير النص أو الأزرار"""
+        key = self._message_key(query)
+        digest = self._digest(text, reply_markup)
+        if key is not None and self._digests.get(key) == digest and self._shows_markup(query, reply_markup):
+            self.counters['skipped_unchanged'] += 1
+            return None
+
+        try:
+            result = await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                self._digests.pop(key, None)
+                raise
+            self.counters['not_modified_errors'] += 1
+            result = None
+        except Exception:
+            # مهلة أو خطأ شبكة: ربما طُبق التعديل وربما لا، فالبصمة المحفوظة لم تعد موثوقة
+            self._digests.pop(key, None)
+            raise
         else:
-            return "🌟 *حكمة اليوم:* الحياة رحلة، استمتع بكل خطوة فيها"
+            self.counters['edits'] += 1
+
+        if key is not None:
+            self._remember(key, digest)
+        return result
+
+    def is_duplicate_callback(self, query):
+        """هل هذه ضغطة مكررة لنفس الزر على نفس محتوى الرسالة خلال نافذة التجميع؟"""
+        if self.dedup_window <= 0:
+            return False
+        message_text = query.message.text if query.message is not None else None
+        key = (query.from_user.id, self._message_key(query), query.data, message_text)
+        now = time.monotonic()
+
+        # إزالة الضغطات الأقدم من النافذة (مرتبة زمنياً)
+        recent = self._recent_callbacks
+        while recent and now - next(iter(recent.values())) > self.dedup_window:
+            recent.popitem(last=False)
+
+        if key in recent:
+            self.counters['duplicate_callbacks'] += 1
+            return True
+        recent[key] = now
+        return False
+
+    def stats(self):
+        return {**self.counters, 'tracked_messages': len(self._digests), 'recent_callbacks': len(self._recent_callbacks)}
+
+def callback_route(name, *converters):
+    """تسجيل دالة كمعالج لمسار أزرار؛ المعاملات تُحوَّل مرة واحدة بالمحولات المعطاة"""
+    def decorator(func):
+        func.__dict__.setdefault('_callback_routes', []).append((name, converters))
+        return func
+    return decorator
+
+def callback_data(name, *args):
+    """بناء بيانات زر منظمة بالصيغة name:arg1:arg2"""
+    return CallbackRouter.SEPARATOR.join((name, *map(str, args)))
+
+class CallbackRouter:
+    """موجه استجابات الأزرار: جدول ثابت من اسم المسار إلى المعالج
+
+    صيغة البيانات name أو name:arg1:arg2؛ البحث عن المسار عملية قاموس واحدة،
+    وتُحوَّل المعاملات إلى أنواعها قبل استدعاء المعالج.
+    """
+
+    SEPARATOR = ':'
 
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """أمر البداية المطور"""
+    def __init__(self):
+        self._routes = {}
+        self.route_stats = {}
+        self.misses = 0
+
+    def add(self, name, handler, converters=()):
+        if name in self._routes:
+            raise ValueError(f"المسار {name} مسجل مسبقاً")
+        self._routes[name] = (handler, converters)
+        self.route_stats[name] = {'hits': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
+    def bind(self, owner):
+        """تسجيل جميع الدوال المزينة بـ callback_route في كائن المعالجات"""
+        for attr_name in dir(type(owner)):
+            func = getattr(type(owner), attr_name, None)
+            for name, converters in getattr(func, '_callback_routes', ()):
+                self.add(name, getattr(owner, attr_name), converters)
+        return self
+
+    def parse(self, data):
+        """تحليل بيانات الزر إلى (المعالج، المسار، المعاملات) أو None"""
+        name, _, raw_args = (data or '').partition(self.SEPARATOR)
+        route = self._routes.get(name)
+        if route is None:
+            return None
+        handler, converters = route
+        raw = raw_args.split(self.SEPARATOR, len(converters) - 1) if converters and raw_args else []
+        if len(raw) != len(converters):
+            return None
         try:
-            user = update.effective_user
+            args = tuple(convert(value) for convert, value in zip(converters, raw))
+        except (TypeError, ValueError):
+            return None
+        return handler, name, args
+
+    async def dispatch(self, data, *handler_args):
+        """استدعاء معالج المسار وإرجاع False إذا لم يُعرف المسار"""
+        parsed = self.parse(data)
+        if parsed is None:
+            self.misses += 1
+            return False
+        handler, name, args = parsed
+        stats = self.route_stats[name]
+        started = time.perf_counter()
+        try:
+            await handler(*handler_args, *args)
+        except Exception:
+            stats['errors'] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            stats['hits'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        return True
+
+    def stats(self):
+        routes = {
+            name: {**stats, 'avg_ms': round(stats['total_ms'] / stats['hits'], 3)}
+            for name, stats in self.route_stats.items() if stats['hits']
+        }
+        return {'routes': routes, 'misses': self.misses}
 
-            # حفظ بيانات المستخدم
-            self.save_user_data(user)
+class AdvancedMentalHealthBot:
+    """بوت الصحة النفسية المتقدم والشامل"""
+
+    def __init__(self):
+        self.db = AdvancedMentalHealthDatabase()
+        STARTUP_PROFILE.mark('database')
+        self.analysis_service = PsychologicalAnalysisService()
+        self.interaction_log = InteractionLogBuffer(self.db)
+        session_backend = MemorySessionBackend() if SESSION_BACKEND == 'memory' else SQLiteSessionBackend(self.db)
+        self.sessions = SessionStore(session_backend)
+        self.router = CallbackRouter().bind(self)
+        self.progress_codec = StatelessProgressCodec(CALLBACK_SIGNING_KEY.encode() or None)
+        self.render = RenderCache()
+        self.precompute_screens()
+        STARTUP_PROFILE.mark('screens')
+        self.edits = MessageEditGuard()
+        self.search_index = index_knowledge_base(ArabicSearchIndex())
+        STARTUP_PROFILE.mark('search_index')
+        self.intents = IntentRouter()
+        self.crisis = CrisisDetector(self.router, self.progress_codec)
+        self.update_processor = PriorityUpdateProcessor(self.crisis, self.record_crisis)
+        self.quotes = QuotePool(self.db)
+        self.outbox = OutboundQueue()
+        self.broadcasts = BroadcastEngine(self.db, self.outbox)
+        self.webhook_server = None
+        # في وضع العمال المتعددين تعمل المهام الخلفية في العامل 0 فقط، ويستطلع ما سجله غيره
+        self.background_services = True
+        self.peer_poll_seconds = None
+        self.scheduler = JobScheduler(self.db)
+        self.scheduler.register('channel_quote', self.post_channel_quote)
+        self.reminders = FollowUpReminderEngine(self.db, self.send_follow_up_reminder)
+        STARTUP_PROFILE.mark('components')
+
+    def precompute_screens(self):
+        """بناء جميع الشاشات الثابتة والأسئلة والنتائج مرة واحدة عند الإقلاع"""
+        started = time.perf_counter()
+        render = self.render
+        render.precompute('welcome', self._build_welcome_screen)
+        render.precompute('main_menu', self._build_main_menu_screen)
+        render.precompute('text_reply', self._build_text_reply_screen)
+        render.precompute('assessment_menu', self._build_assessment_menu_screen)
+        render.precompute('mbti_intro', self._build_mbti_intro_screen)
+        render.precompute('mbti_info', self._build_mbti_info_screen)
+        render.precompute('psych_intro', self._build_psych_intro_screen)
+        render.precompute('psych_info', self._build_psych_info_screen)
+        render.precompute('service_info', self._build_service_info_screen)
+        for intent in INTENT_FLOWS:
+            render.precompute(('intent', intent), lambda: self._build_intent_screen(intent))
+
+        for assessment_key in SCREENING_INSTRUMENTS:
+            assessment = PSYCHOLOGICAL_ASSESSMENTS[assessment_key]
+            render.precompute(('assessment_intro', assessment_key),
+                              lambda: self._build_assessment_intro_screen(assessment_key))
+            for question_index in range(len(assessment['questions'])):
+                render.precompute(('assessment_question', assessment_key, question_index),
+                                  lambda: self._build_assessment_question_text(assessment_key, question_index))
+                render.precompute(('assessment_keyboard', assessment_key, question_index),
+                                  lambda: self._assessment_keyboard(
+                                      assessment_key,
+                                      lambda score: callback_data("answer", assessment_key, question_index, score)))
+            scale = SCREENING_SCALES[assessment_key]
+            for total_score in range(scale.max_score + 1):
+                render.precompute(('assessment_result', assessment_key, total_score, False),
+                                  lambda: self._build_assessment_result_screen(assessment_key, total_score))
+                if scale.crisis_item is not None:
+                    render.precompute(('assessment_result', assessment_key, total_score, True),
+                                      lambda: self._build_assessment_result_screen(assessment_key, total_score, True))
+        render.precompute('crisis', self._build_crisis_screen)
+        for assessment_key in SCREENING_INSTRUMENTS:
+            render.precompute(('follow_up', assessment_key), lambda: self._build_follow_up_screen(assessment_key))
+        render.precompute('follow_up_off', self._build_follow_up_off_screen)
+
+        for flat_index, (dimension_index, question_index) in enumerate(MBTI_FLAT_QUESTIONS):
+            progress = flat_index / len(MBTI_FLAT_QUESTIONS) * 100
+            render.precompute(('mbti_question', dimension_index, question_index, progress),
+                              lambda: self._build_mbti_question_text(dimension_index, question_index, progress))
+            render.precompute(('mbti_keyboard', dimension_index, question_index),
+                              lambda: self._mbti_keyboard(dimension_index, question_index,
+                                                          lambda i, option: callback_data("mbti_answer", option['weight'])))
+
+        # كل تركيبات إجابات MBTI الممكنة تنتج عدداً صغيراً من الشاشات المختلفة
+        dimension_choices = []
+        for dimension in MBTI_DIMENSION_ORDER:
+            questions = MBTI_ASSESSMENT['dimensions'][dimension]['questions']
+            dimension_choices.append(list(itertools.product(*[[option['weight'] for option in q['options']] for q in questions])))
+        for combination in itertools.product(*dimension_choices):
+            analysis = self.analysis_service.analyze_mbti(
+                {dimension: list(weights) for dimension, weights in zip(MBTI_DIMENSION_ORDER, combination)}
+            )
+            key = ('mbti_result', analysis['personality_type'], round(analysis['confidence_score'], 4))
+            if key not in render:
+                render.precompute(key, lambda: self._build_mbti_result_screen(analysis))
+
+        logger.info(f"✅ تم بناء {render.stats()['static']} شاشة مسبقاً في {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    async def startup(self, application):
+        """تشغيل المهام الخلفية بعد تهيئة التطبيق"""
+        self.interaction_log.start()
+        self.sessions.start()
+        self.outbox.start(application)
+        if self.background_services:
+            # كيس الاقتباسات يملكه من ينشر في القناة وحده حتى لا يكتب العمال الآخرون فوق مؤشره
+            await self.quotes.load()
+            await self.scheduler.start(application)
+            self.reminders.start(self.peer_poll_seconds)
+            await self.broadcasts.start(self.peer_poll_seconds)
+            if CHANNEL_POSTS_ENABLED:
+                await self.schedule_daily_quotes()
+        STARTUP_PROFILE.mark('post_init')
+        STARTUP_PROFILE.report()
+
+    async def shutdown(self, application):
+        """إغلاق الموارد عند إيقاف التطبيق؛ فشل خطوة لا يمنع تفريغ ما بعدها"""
+        steps = (
+            ('scheduler', self.scheduler.close),
+            ('reminders', self.reminders.close),
+            ('broadcasts', self.broadcasts.close),
+            ('outbox', self.outbox.close),
+            ('interaction_log', self.interaction_log.close),
+            ('sessions', self.sessions.close),
+            ('quotes', self.quotes.save if self.background_services else None),
+            ('database', lambda: asyncio.to_thread(self.db.close))
+        )
+        for name, close in steps:
+            if close is None:
+                continue
+            try:
+                await close()
+            except Exception as e:
+                logger.error(f"❌ خطأ في إغلاق {name}: {e}")
+
+    async def schedule_daily_quotes(self):
+        """جدولة إرسال الاقتباسات اليومية كل QUOTE_INTERVAL_HOURS في مخزن المهام"""
+        interval = QUOTE_INTERVAL_HOURS * 3600
+        first_run = (datetime.now() + timedelta(seconds=interval)).replace(minute=0, second=0, microsecond=0)
+        await self.scheduler.ensure_job('channel_quotes', 'channel_quote', interval, first_run.timestamp())
+
+    async def post_channel_quote(self, application, job):
+        """إرسال اقتباس من كيس الاقتباسات إلى القناة عبر طابور الإرسال"""
+        quote = self.get_random_quote()
+        await self.quotes.save()
+        await self.outbox.send_message(CHANNEL_ID, quote, priority=OutboundQueue.PRIORITY_NOTIFY, parse_mode='Markdown')
+        logger.info(f"✅ تم إرسال اقتباس يومي إلى القناة: {CHANNEL_ID}")
 
-            welcome_text = f"""
-🌟 **أهلاً وسهلاً بك {user.first_name}** 🌟
+    def get_random_quote(self):
+        """الاقتباس التالي من كيس الاقتباسات دون تكرار قبل استنفاد المجموعة"""
+        return self.quotes.draw()
+
+    def _build_welcome_screen(self):
+        """شاشة الترحيب؛ {first_name} يُملأ لكل مستخدم"""
+        screen_text = """
+🌟 **أهلاً وسهلاً بك {first_name}** 🌟
 
 🧠 **مركز التحليل النفسي المتكامل** 🧠
 
@@ -835,18 +4042,28 @@ class AdvancedMentalHealthBot:
 ✅ دعم مستمر 24/7
 
 🚀 **ابدأ رحلتك نحو فهم أعمق لذاتك!**
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
-                [InlineKeyboardButton("📊 الاختبارات النفسية", callback_data="start_journey")],
-                [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
-                [InlineKeyboardButton("ℹ️ معلومات الخدمة", callback_data="more_info")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
+            [InlineKeyboardButton("📊 الاختبارات النفسية", callback_data="start_journey")],
+            [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
+            [InlineKeyboardButton("ℹ️ معلومات الخدمة", callback_data="more_info")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
+
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """أمر البداية المطور"""
+        try:
+            user = update.effective_user
+
+            # حفظ بيانات المستخدم
+            await self.save_user_data(user)
 
+            text, markup = self.render.screen('welcome')
             await update.message.reply_text(
-                welcome_text, 
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                text.format(first_name=user.first_name),
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
@@ -859,44 +4076,29 @@ class AdvancedMentalHealthBot:
             query = update.callback_query
             await query.answer()
 
+            # الضغط المزدوج على نفس الزر لا يعيد تنفيذ الخطوة
+            if self.edits.is_duplicate_callback(query):
+                return
+
             data = query.data
 
             # تسجيل التفاعل
             self.log_user_interaction(query.from_user.id, data)
 
-            if data == "start_mbti":
-                await self.start_mbti_assessment(query, context)
-            elif data == "start_journey":
-                await self.show_assessment_menu(query, context)
-            elif data == "start_psychological_evaluation":
-                await self.start_psychological_evaluation(query, context)
-            elif data == "more_info":
-                await self.show_detailed_info(query, context)
-            elif data.startswith("mbti_"):
-                await self.handle_mbti_response(query, context, data)
-            elif data.startswith("assessment_"):
-                await self.start_assessment(query, context, data)
-            elif data.startswith("answer_"):
-                await self.handle_assessment_answer(query, context, data)
-            elif data.startswith("begin_"):
-                assessment_type = data.replace("begin_", "")
-                await self.begin_assessment(query, context, assessment_type)
-            elif data.startswith("psych_"):
-                await self.handle_psychological_response(query, context, data)
-            elif data == "back_to_main":
+            if not await self.router.dispatch(data, query, context):
+                # أزرار قديمة أو غير معروفة تعود للقائمة الرئيسية
+                logger.warning(f"⚠️ مسار غير معروف: {data}")
                 await self.start_command_from_callback(query, context)
-            elif data == "show_religious_support":
-                await self.show_religious_support(query, context)
-            elif data == "show_philosophical_support":
-                await self.show_philosophical_support(query, context)
+
+            # حفظ حالة الجلسة بعد كل خطوة لاستئنافها بعد إعادة التشغيل
+            await self.sessions.save(query.from_user.id)
         except Exception as e:
             logger.error(f"❌ خطأ في معالجة الـ callback: {e}")
-            await query.edit_message_text("حدث خطأ، يرجى المحاولة مرة أخرى.")
+            await self.edits.edit_message_text(query, "حدث خطأ، يرجى المحاولة مرة أخرى.")
 
-    async def start_mbti_assessment(self, query, context):
-        """بدء اختبار تحليل الشخصية MBTI"""
-        try:
-            intro_text = f"""
+    def _build_mbti_intro_screen(self):
+        """شاشة مقدمة اختبار MBTI"""
+        screen_text = """
 🧠 **اختبار تحليل الشخصية مايرز-بريغز (MBTI)**
 
 📖 **عن الاختبار:**
@@ -914,72 +4116,60 @@ class AdvancedMentalHealthBot:
 💡 **نصيحة:** اختر الإجابة التي تعكس تفضيلك الطبيعي، وليس ما تعتقد أنه الصحيح.
 
 🔒 **خصوصيتك محمية بالكامل**
-            """
+        """
 
-            session_id = str(uuid.uuid4())
-            context.user_data['mbti_session'] = session_id
-            context.user_data['mbti_responses'] = {}
-            context.user_data['current_dimension'] = 'EI'
-            context.user_data['current_question'] = 0
+        keyboard = [
+            [InlineKeyboardButton("🚀 ابدأ الاختبار", callback_data="mbti_start_test")],
+            [InlineKeyboardButton("📚 المزيد عن MBTI", callback_data="mbti_more_info")],
+            [InlineKeyboardButton("🔙 العودة للقائمة", callback_data="back_to_main")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
 
-            keyboard = [
-                [InlineKeyboardButton("🚀 ابدأ الاختبار", callback_data="mbti_start_test")],
-                [InlineKeyboardButton("📚 المزيد عن MBTI", callback_data="mbti_more_info")],
-                [InlineKeyboardButton("🔙 العودة للقائمة", callback_data="back_to_main")]
-            ]
+    @callback_route("start_mbti")
+    async def start_mbti_assessment(self, query, context):
+        """بدء اختبار تحليل الشخصية MBTI"""
+        try:
+            session = await self.sessions.get(query.from_user.id)
 
-            await query.edit_message_text(
-                intro_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+            if not STATELESS_ASSESSMENTS:
+                session.mbti = MBTISessionState()
+
+            text, markup = self.render.screen('mbti_intro')
+            await self.edits.edit_message_text(
+                query,
+                text,
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في بدء MBTI: {e}")
-            await query.edit_message_text("حدث خطأ في بدء الاختبار، يرجى المحاولة مرة أخرى.")
+            await self.edits.edit_message_text(query, "حدث خطأ في بدء الاختبار، يرجى المحاولة مرة أخرى.")
 
-    async def handle_mbti_response(self, query, context, data):
+    @callback_route("mbti_answer", str)
+    async def handle_mbti_answer(self, query, context, answer):
         """معالجة إجابات اختبار MBTI"""
         try:
-            if data == "mbti_start_test":
-                await self.send_mbti_question(query, context)
-            elif data == "mbti_more_info":
-                await self.show_mbti_detailed_info(query, context)
-            elif data.startswith("mbti_answer_"):
-                parts = data.split("_")
-                answer = parts[2]  # E, I, S, N, T, F, J, P
-
-                # حفظ الإجابة
-                current_dim = context.user_data.get('current_dimension', 'EI')
-                if 'mbti_responses' not in context.user_data:
-                    context.user_data['mbti_responses'] = {}
-                if current_dim not in context.user_data['mbti_responses']:
-                    context.user_data['mbti_responses'][current_dim] = []
-                context.user_data['mbti_responses'][current_dim].append(answer)
-
-                # الانتقال للسؤال التالي
-                await self.next_mbti_question(query, context)
-        except Exception as e:
-            logger.error(f"❌ خطأ في معالجة إجابة MBTI: {e}")
-            await query.edit_message_text("حدث خطأ، يرجى المحاولة مرة أخرى.")
-
-    async def send_mbti_question(self, query, context):
-        """إرسال سؤال MBTI"""
-        try:
-            current_dim = context.user_data.get('current_dimension', 'EI')
-            current_q = context.user_data.get('current_question', 0)
-
-            dimension_data = MBTI_ASSESSMENT['dimensions'][current_dim]
-
-            if current_q >= len(dimension_data['questions']):
-                await self.next_mbti_dimension(query, context)
+            session = await self.sessions.get(query.from_user.id)
+            if session.mbti is None or answer not in MBTI_LETTERS:
+                await self.start_mbti_assessment(query, context)
                 return
 
-            question = dimension_data['questions'][current_q]
+            # حفظ الإجابة (E, I, S, N, T, F, J, P)
+            session.mbti.record(answer)
 
-            progress = self.calculate_mbti_progress(context.user_data)
-            progress_bar = "▓" * int(progress // 10) + "░" * (10 - int(progress // 10))
+            # الانتقال للسؤال التالي
+            await self.next_mbti_question(query, context)
+        except Exception as e:
+            logger.error(f"❌ خطأ في معالجة إجابة MBTI: {e}")
+            await self.edits.edit_message_text(query, "حدث خطأ، يرجى المحاولة مرة أخرى.")
 
-            question_text = f"""
+    def _build_mbti_question_text(self, dimension_index, question_index, progress):
+        """نص سؤال MBTI مع شريط التقدم"""
+        dimension_data = MBTI_ASSESSMENT['dimensions'][MBTI_DIMENSION_ORDER[dimension_index]]
+        question = dimension_data['questions'][question_index]
+        progress_bar = "▓" * int(progress // 10) + "░" * (10 - int(progress // 10))
+
+        question_text = f"""
 🧠 **تحليل الشخصية MBTI**
 
 📊 **التقدم:** {progress_bar} {progress:.0f}%
@@ -987,31 +4177,78 @@ class AdvancedMentalHealthBot:
 🎯 **المقياس الحالي:** {dimension_data['name']}
 💭 **الوصف:** {dimension_data['description']}
 
-❓ **السؤال {current_q + 1}/3:**
+❓ **السؤال {question_index + 1}/3:**
 
 **{question['text']}**
 
 اختر الإجابة الأقرب لطبيعتك:
             """
+        return question_text
+
+    def _mbti_keyboard(self, dimension_index, question_index, answer_data):
+        """لوحة أزرار سؤال MBTI؛ answer_data يبني بيانات زر كل خيار"""
+        question = MBTI_ASSESSMENT['dimensions'][MBTI_DIMENSION_ORDER[dimension_index]]['questions'][question_index]
+        keyboard = []
+        for i, option in enumerate(question['options']):
+            keyboard.append([InlineKeyboardButton(option['text'], callback_data=answer_data(i, option))])
+        return InlineKeyboardMarkup(keyboard)
+
+    def _mbti_question_view(self, dimension_index, question_index, progress, answer_data=None):
+        """نص سؤال MBTI ولوحة أزراره من الذاكرة؛ answer_data يُمرر فقط للأزرار الخاصة بكل مستخدم"""
+        question_text = self.render.cached(
+            ('mbti_question', dimension_index, question_index, progress),
+            lambda: self._build_mbti_question_text(dimension_index, question_index, progress)
+        )
+        if answer_data is None:
+            markup = self.render.cached(
+                ('mbti_keyboard', dimension_index, question_index),
+                lambda: self._mbti_keyboard(dimension_index, question_index,
+                                            lambda i, option: callback_data("mbti_answer", option['weight']))
+            )
+        else:
+            markup = self._mbti_keyboard(dimension_index, question_index, answer_data)
+        return question_text, markup
 
-            keyboard = []
-            for i, option in enumerate(question['options']):
-                callback_data = f"mbti_answer_{option['weight']}"
-                keyboard.append([InlineKeyboardButton(option['text'], callback_data=callback_data)])
+    @callback_route("mbti_start_test")
+    async def send_mbti_question(self, query, context):
+        """إرسال سؤال MBTI"""
+        try:
+            if STATELESS_ASSESSMENTS:
+                await self.send_stateless_mbti_step(query, [])
+                return
 
-            await query.edit_message_text(
+            session = await self.sessions.get(query.from_user.id)
+            if session.mbti is None:
+                await self.start_mbti_assessment(query, context)
+                return
+
+            state = session.mbti
+            dimension_data = MBTI_ASSESSMENT['dimensions'][state.dimension]
+
+            if state.question_index >= len(dimension_data['questions']):
+                await self.next_mbti_dimension(query, context)
+                return
+
+            question_text, markup = self._mbti_question_view(
+                state.dimension_index, state.question_index,
+                self.calculate_mbti_progress(state)
+            )
+
+            await self.edits.edit_message_text(
+                query,
                 question_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في إرسال سؤال MBTI: {e}")
-            await query.edit_message_text("حدث خطأ في إرسال السؤال، يرجى المحاولة مرة أخرى.")
+            await self.edits.edit_message_text(query, "حدث خطأ في إرسال السؤال، يرجى المحاولة مرة أخرى.")
 
     async def next_mbti_question(self, query, context):
         """الانتقال للسؤال التالي في MBTI"""
         try:
-            context.user_data['current_question'] += 1
+            session = await self.sessions.get(query.from_user.id)
+            session.mbti.question_index += 1
             await self.send_mbti_question(query, context)
         except Exception as e:
             logger.error(f"❌ خطأ في الانتقال للسؤال التالي: {e}")
@@ -1019,50 +4256,42 @@ class AdvancedMentalHealthBot:
     async def next_mbti_dimension(self, query, context):
         """الانتقال للبعد التالي في MBTI"""
         try:
-            dimensions = ['EI', 'SN', 'TF', 'JP']
-            current_dim = context.user_data.get('current_dimension')
-            current_index = dimensions.index(current_dim) if current_dim in dimensions else 0
+            session = await self.sessions.get(query.from_user.id)
+            state = session.mbti
 
-            if current_index + 1 < len(dimensions):
-                context.user_data['current_dimension'] = dimensions[current_index + 1]
-                context.user_data['current_question'] = 0
+            if state.dimension_index + 1 < len(MBTI_DIMENSION_ORDER):
+                state.dimension_index += 1
+                state.question_index = 0
                 await self.send_mbti_question(query, context)
             else:
                 await self.complete_mbti_assessment(query, context)
         except Exception as e:
             logger.error(f"❌ خطأ في الانتقال للبعد التالي: {e}")
 
-    def calculate_mbti_progress(self, user_data):
+    def calculate_mbti_progress(self, state):
         """حساب تقدم اختبار MBTI"""
         total_questions = 12  # 3 أسئلة × 4 أبعاد
-        answered_questions = 0
-
-        for dim, responses in user_data.get('mbti_responses', {}).items():
-            answered_questions += len(responses)
-
-        current_q = user_data.get('current_question', 0)
-        answered_questions += current_q
-
-        return (answered_questions / total_questions) * 100
+        return (len(state.answers) / total_questions) * 100
 
     async def complete_mbti_assessment(self, query, context):
         """إكمال اختبار MBTI وعرض النتائج"""
         try:
-            responses = context.user_data.get('mbti_responses', {})
-            user_id = query.from_user.id
-            session_id = context.user_data.get('mbti_session')
-
-            # تحليل النتائج
-            analysis = self.analysis_service.analyze_mbti(responses)
-
-            # حفظ النتائج
-            self.save_mbti_results(user_id, session_id, analysis)
+            session = await self.sessions.get(query.from_user.id)
+            responses = session.mbti.responses()
+            session_id = session.mbti.session_id
+            session.mbti = None
+            await self._finish_mbti(query, session_id, responses)
+        except Exception as e:
+            logger.error(f"❌ خطأ في إكمال تحليل MBTI: {e}")
+            await self.edits.edit_message_text(query, "حدث خطأ في معالجة النتائج، يرجى المحاولة مرة أخرى.")
 
-            personality_type = analysis['personality_type']
-            details = analysis['details']
-            confidence = analysis['confidence_score']
+    def _build_mbti_result_screen(self, analysis):
+        """شاشة نتيجة MBTI لنمط ومستوى ثقة محددين"""
+        personality_type = analysis['personality_type']
+        details = analysis['details']
+        confidence = analysis['confidence_score']
 
-            results_text = f"""
+        results_text = f"""
 🧠 **نتائج تحليل شخصيتك MBTI**
 
 🎯 **نمط شخصيتك:** {personality_type}
@@ -1086,26 +4315,43 @@ class AdvancedMentalHealthBot:
 📊 **مستوى الثقة في النتيجة:** {confidence:.1%}
 
 🌟 **تذكر:** لا يوجد نمط أفضل من آخر، كل نمط له مميزاته الفريدة!
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🔄 إعادة الاختبار", callback_data="start_mbti")],
-                [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🔄 إعادة الاختبار", callback_data="start_mbti")],
+            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
+        ]
+        return results_text, InlineKeyboardMarkup(keyboard)
 
-            await query.edit_message_text(
+    async def _finish_mbti(self, query, session_id, responses):
+        """تحليل إجابات MBTI وحفظها وعرض النتيجة"""
+        try:
+            user_id = query.from_user.id
+
+            # تحليل النتائج
+            analysis = self.analysis_service.analyze_mbti(responses)
+
+            # حفظ النتائج
+            await self.save_mbti_results(user_id, session_id, analysis)
+
+            results_text, markup = self.render.cached(
+                ('mbti_result', analysis['personality_type'], round(analysis['confidence_score'], 4)),
+                lambda: self._build_mbti_result_screen(analysis)
+            )
+
+            await self.edits.edit_message_text(
+                query,
                 results_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في إكمال تحليل MBTI: {e}")
-            await query.edit_message_text("حدث خطأ في معالجة النتائج، يرجى المحاولة مرة أخرى.")
+            await self.edits.edit_message_text(query, "حدث خطأ في معالجة النتائج، يرجى المحاولة مرة أخرى.")
 
-    async def start_psychological_evaluation(self, query, context):
-        """بدء التقييم النفسي الشامل"""
-        try:
-            intro_text = f"""
+    def _build_psych_intro_screen(self):
+        """شاشة مقدمة التقييم النفسي الشامل"""
+        screen_text = """
 🔍 **التقييم النفسي الشامل المتكامل**
 
 📋 **ما هو التقييم النفسي؟**
@@ -1143,58 +4389,63 @@ class AdvancedMentalHealthBot:
 🔒 **سرية تامة ومحمية بالكامل**
 
 ⚠️ **تنبيه مهم:** هذا التقييم لأغراض التوعية والدعم النفسي، وليس بديلاً عن الاستشارة الطبية المتخصصة.
-            """
+        """
 
-            session_id = str(uuid.uuid4())
-            context.user_data['psych_session'] = session_id
-            context.user_data['psych_responses'] = {}
-            context.user_data['current_category'] = 'medical_history'
-            context.user_data['current_psych_question'] = 0
+        keyboard = [
+            [InlineKeyboardButton("🚀 ابدأ التقييم", callback_data="psych_start_evaluation")],
+            [InlineKeyboardButton("📚 المزيد عن التقييم النفسي", callback_data="psych_more_info")],
+            [InlineKeyboardButton("🔙 العودة للقائمة", callback_data="back_to_main")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
 
-            keyboard = [
-                [InlineKeyboardButton("🚀 ابدأ التقييم", callback_data="psych_start_evaluation")],
-                [InlineKeyboardButton("📚 المزيد عن التقييم النفسي", callback_data="psych_more_info")],
-                [InlineKeyboardButton("🔙 العودة للقائمة", callback_data="back_to_main")]
-            ]
+    @callback_route("start_psychological_evaluation")
+    async def start_psychological_evaluation(self, query, context):
+        """بدء التقييم النفسي الشامل"""
+        try:
+            session = await self.sessions.get(query.from_user.id)
 
-            await query.edit_message_text(
-                intro_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+            session.psych = PsychEvaluationState()
+
+            text, markup = self.render.screen('psych_intro')
+            await self.edits.edit_message_text(
+                query,
+                text,
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في بدء التقييم النفسي: {e}")
-            await query.edit_message_text("حدث خطأ في بدء التقييم، يرجى المحاولة مرة أخرى.")
+            await self.edits.edit_message_text(query, "حدث خطأ في بدء التقييم، يرجى المحاولة مرة أخرى.")
 
-    async def handle_psychological_response(self, query, context, data):
+    @callback_route("psych_answer", int)
+    async def handle_psychological_answer(self, query, context, value):
         """معالجة إجابات التقييم النفسي"""
         try:
-            if data == "psych_start_evaluation":
-                await self.send_psychological_question(query, context)
-            elif data == "psych_more_info":
-                await self.show_psychological_detailed_info(query, context)
-            elif data.startswith("psych_answer_"):
-                answer = data.replace("psych_answer_", "")
-
-                # حفظ الإجابة
-                current_cat = context.user_data.get('current_category')
-                if 'psych_responses' not in context.user_data:
-                    context.user_data['psych_responses'] = {}
-                if current_cat not in context.user_data['psych_responses']:
-                    context.user_data['psych_responses'][current_cat] = []
-                context.user_data['psych_responses'][current_cat].append(answer)
-
-                # الانتقال للسؤال التالي
-                await self.next_psychological_question(query, context)
+            session = await self.sessions.get(query.from_user.id)
+            if session.psych is None:
+                await self.start_psychological_evaluation(query, context)
+                return
+
+            # حفظ الإجابة (فهرس الخيار أو قيمة المقياس)
+            session.psych.record(value)
+
+            # الانتقال للسؤال التالي
+            await self.next_psychological_question(query, context)
         except Exception as e:
             logger.error(f"❌ خطأ في معالجة إجابة التقييم النفسي: {e}")
-            await query.edit_message_text("حدث خطأ، يرجى المحاولة مرة أخرى.")
+            await self.edits.edit_message_text(query, "حدث خطأ، يرجى المحاولة مرة أخرى.")
 
+    @callback_route("psych_start_evaluation")
     async def send_psychological_question(self, query, context):
         """إرسال سؤال التقييم النفسي"""
         try:
-            current_cat = context.user_data.get('current_category')
-            current_q = context.user_data.get('current_psych_question', 0)
+            session = await self.sessions.get(query.from_user.id)
+            if session.psych is None:
+                await self.start_psychological_evaluation(query, context)
+                return
+
+            current_cat = session.psych.category
+            current_q = session.psych.question_index
 
             questions = PSYCHOLOGICAL_QUESTIONS.get(current_cat, [])
 
@@ -1206,7 +4457,7 @@ class AdvancedMentalHealthBot:
 
             # حساب التقدم
             total_questions = sum(len(PSYCHOLOGICAL_QUESTIONS[cat]) for cat in PSYCHOLOGICAL_QUESTIONS)
-            completed_questions = sum(len(context.user_data.get('psych_responses', {}).get(cat, [])) for cat in context.user_data.get('psych_responses', {}))
+            completed_questions = session.psych.answered()
             progress = (completed_questions / total_questions) * 100
             progress_bar = "▓" * int(progress // 10) + "░" * (10 - int(progress // 10))
 
@@ -1231,28 +4482,28 @@ class AdvancedMentalHealthBot:
 
             keyboard = []
             if question['type'] == 'multiple_choice':
-                for option in question['options']:
-                    callback_data = f"psych_answer_{option}"
-                    keyboard.append([InlineKeyboardButton(option, callback_data=callback_data)])
+                for option_index, option in enumerate(question['options']):
+                    keyboard.append([InlineKeyboardButton(option, callback_data=callback_data("psych_answer", option_index))])
             elif question['type'] == 'scale':
                 for i in range(question['scale_min'], question['scale_max'] + 1):
                     label = question['scale_labels'][i-1] if i-1 < len(question['scale_labels']) else str(i)
-                    callback_data = f"psych_answer_{i}"
-                    keyboard.append([InlineKeyboardButton(f"{i} - {label}", callback_data=callback_data)])
+                    keyboard.append([InlineKeyboardButton(f"{i} - {label}", callback_data=callback_data("psych_answer", i))])
 
-            await query.edit_message_text(
+            await self.edits.edit_message_text(
+                query,
                 question_text,
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في إرسال سؤال التقييم النفسي: {e}")
-            await query.edit_message_text("حدث خطأ في إرسال السؤال، يرجى المحاولة مرة أخرى.")
+            await self.edits.edit_message_text(query, "حدث خطأ في إرسال السؤال، يرجى المحاولة مرة أخرى.")
 
     async def next_psychological_question(self, query, context):
         """الانتقال للسؤال التالي في التقييم النفسي"""
         try:
-            context.user_data['current_psych_question'] += 1
+            session = await self.sessions.get(query.from_user.id)
+            session.psych.question_index += 1
             await self.send_psychological_question(query, context)
         except Exception as e:
             logger.error(f"❌ خطأ في الانتقال للسؤال التالي: {e}")
@@ -1260,13 +4511,12 @@ class AdvancedMentalHealthBot:
     async def next_psychological_category(self, query, context):
         """الانتقال للفئة التالية في التقييم النفسي"""
         try:
-            categories = ['medical_history', 'social_environment', 'addiction_behaviors', 'psychological_state']
-            current_cat = context.user_data.get('current_category')
-            current_index = categories.index(current_cat) if current_cat in categories else 0
+            session = await self.sessions.get(query.from_user.id)
+            state = session.psych
 
-            if current_index + 1 < len(categories):
-                context.user_data['current_category'] = categories[current_index + 1]
-                context.user_data['current_psych_question'] = 0
+            if state.category_index + 1 < len(PSYCH_CATEGORY_ORDER):
+                state.category_index += 1
+                state.question_index = 0
                 await self.send_psychological_question(query, context)
             else:
                 await self.complete_psychological_evaluation(query, context)
@@ -1276,9 +4526,10 @@ class AdvancedMentalHealthBot:
     async def complete_psychological_evaluation(self, query, context):
         """إكمال التقييم النفسي وعرض النتائج"""
         try:
-            responses = context.user_data.get('psych_responses', {})
+            session = await self.sessions.get(query.from_user.id)
+            responses = session.psych.responses()
             user_id = query.from_user.id
-            session_id = context.user_data.get('psych_session')
+            session_id = session.psych.session_id
 
             # تحليل النتائج
             analysis = self.analysis_service.analyze_psychological_evaluation(responses)
@@ -1288,7 +4539,7 @@ class AdvancedMentalHealthBot:
             philosophical_support = self.analysis_service.get_philosophical_support(analysis)
 
             # حفظ النتائج
-            self.save_psychological_results(user_id, session_id, {
+            await self.save_psychological_results(user_id, session_id, {
                 'responses': responses,
                 'analysis': analysis,
                 'religious_support': religious_support,
@@ -1320,8 +4571,10 @@ class AdvancedMentalHealthBot:
             """
 
             # حفظ الدعم في context لعرضه لاحقاً
-            context.user_data['religious_support'] = religious_support
-            context.user_data['philosophical_support'] = philosophical_support
+            session.psych = PsychEvaluationState(
+                religious=self._resource_indexes('religious', religious_support),
+                philosophical=self._resource_indexes('philosophical', philosophical_support)
+            )
 
             keyboard = [
                 [InlineKeyboardButton("🕌 الدعم الديني", callback_data="show_religious_support")],
@@ -1330,19 +4583,36 @@ class AdvancedMentalHealthBot:
                 [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
             ]
 
-            await query.edit_message_text(
+            await self.edits.edit_message_text(
+                query,
                 results_text,
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في إكمال التقييم النفسي: {e}")
-            await query.edit_message_text("حدث خطأ في معالجة النتائج، يرجى المحاولة مرة أخرى.")
+            await self.edits.edit_message_text(query, "حدث خطأ في معالجة النتائج، يرجى المحاولة مرة أخرى.")
 
+    @staticmethod
+    def _resource_indexes(kind, resources):
+        """تحويل موارد الدعم المختارة إلى فهارسها في SUPPORT_RESOURCES لتخزينها في الجلسة"""
+        positions = (SUPPORT_INDEX.position(kind, resource) for resource in resources)
+        return tuple(position for position in positions if position is not None)
+
+    @staticmethod
+    def _session_resources(session, kind):
+        """موارد الدعم المحفوظة في جلسة التقييم النفسي"""
+        if session.psych is None:
+            return []
+        indexes = session.psych.religious if kind == 'religious' else session.psych.philosophical
+        return [SUPPORT_RESOURCES[kind][index] for index in indexes]
+
+    @callback_route("show_religious_support")
     async def show_religious_support(self, query, context):
         """عرض الدعم الديني"""
         try:
-            religious_support = context.user_data.get('religious_support', [])
+            session = await self.sessions.get(query.from_user.id)
+            religious_support = self._session_resources(session, 'religious')
 
             if not religious_support:
                 text = "🕌 **الدعم الديني العام**\n\nلا توجد توصيات دينية محددة، ولكن ننصح بالاستمرار في الذكر والدعاء."
@@ -1359,19 +4629,22 @@ class AdvancedMentalHealthBot:
                 [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
             ]
 
-            await query.edit_message_text(
+            await self.edits.edit_message_text(
+                query,
                 text,
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في عرض الدعم الديني: {e}")
-            await query.edit_message_text("حدث خطأ في عرض الدعم الديني.")
+            await self.edits.edit_message_text(query, "حدث خطأ في عرض الدعم الديني.")
 
+    @callback_route("show_philosophical_support")
     async def show_philosophical_support(self, query, context):
         """عرض الدعم الفلسفي"""
         try:
-            philosophical_support = context.user_data.get('philosophical_support', [])
+            session = await self.sessions.get(query.from_user.id)
+            philosophical_support = self._session_resources(session, 'philosophical')
 
             if not philosophical_support:
                 text = "📚 **الدعم الفلسفي العام**\n\nلا توجد توصيات فلسفية محددة، ولكن ننصح بالتأمل في معنى الحياة والسعي للتطوير الذاتي."
@@ -1388,19 +4661,19 @@ class AdvancedMentalHealthBot:
                 [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
             ]
 
-            await query.edit_message_text(
+            await self.edits.edit_message_text(
+                query,
                 text,
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في عرض الدعم الفلسفي: {e}")
-            await query.edit_message_text("حدث خطأ في عرض الدعم الفلسفي.")
+            await self.edits.edit_message_text(query, "حدث خطأ في عرض الدعم الفلسفي.")
 
-    async def show_assessment_menu(self, query, context):
-        """عرض قائمة الاختبارات النفسية التقليدية"""
-        try:
-            menu_text = """
+    def _build_assessment_menu_screen(self):
+        """شاشة قائمة الاختبارات النفسية"""
+        screen_text = """
 📊 **الاختبارات النفسية المعتمدة**
 
 🎯 **الاختبارات المتاحة:**
@@ -1416,35 +4689,35 @@ class AdvancedMentalHealthBot:
 • تقييم دقيق لمستوى القلق
 
 💡 **هذه الاختبارات تكمل التقييمات الشاملة الأخرى**
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("😔 مقياس الاكتئاب PHQ-9", callback_data="assessment_phq9")],
-                [InlineKeyboardButton("😰 مقياس القلق GAD-7", callback_data="assessment_gad7")],
-                [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("😔 مقياس الاكتئاب PHQ-9", callback_data=callback_data("assessment", "phq9"))],
+            [InlineKeyboardButton("😰 مقياس القلق GAD-7", callback_data=callback_data("assessment", "gad7"))],
+            [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data="back_to_main")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
 
-            await query.edit_message_text(
-                menu_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+    @callback_route("start_journey")
+    async def show_assessment_menu(self, query, context):
+        """عرض قائمة الاختبارات النفسية التقليدية"""
+        try:
+            text, markup = self.render.screen('assessment_menu')
+            await self.edits.edit_message_text(
+                query,
+                text,
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في عرض قائمة الاختبارات: {e}")
-            await query.edit_message_text("حدث خطأ في عرض القائمة.")
+            await self.edits.edit_message_text(query, "حدث خطأ في عرض القائمة.")
 
-    async def start_assessment(self, query, context, assessment_type):
-        """بدء التقييم المحدد"""
-        try:
-            assessment_key = assessment_type.replace("assessment_", "")
-            assessment = PSYCHOLOGICAL_ASSESSMENTS[assessment_key]
-
-            context.user_data['current_assessment'] = assessment_key
-            context.user_data['question_index'] = 0
-            context.user_data['answers'] = []
-            context.user_data['start_time'] = datetime.now()
+    def _build_assessment_intro_screen(self, assessment_key):
+        """شاشة مقدمة الاختبار المحدد"""
+        assessment = PSYCHOLOGICAL_ASSESSMENTS[assessment_key]
 
-            intro_text = f"""
+        screen_text = f"""
 {assessment['icon']} **{assessment['name']}**
 
 🎯 **تعليمات مهمة:**
@@ -1461,48 +4734,56 @@ class AdvancedMentalHealthBot:
 💪 **أنت تخطو خطوة شجاعة نحو التحسن!**
 
 هل أنت مستعد للبداية؟
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🚀 نعم، ابدأ الآن", callback_data=f"begin_{assessment_key}")],
-                [InlineKeyboardButton("🔙 العودة للقائمة", callback_data="start_journey")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🚀 نعم، ابدأ الآن", callback_data=callback_data("begin", assessment_key))],
+            [InlineKeyboardButton("🔙 العودة للقائمة", callback_data="start_journey")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
 
-            await query.edit_message_text(
-                intro_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+    @callback_route("assessment", str)
+    async def start_assessment(self, query, context, assessment_key):
+        """بدء التقييم المحدد"""
+        try:
+            session = await self.sessions.get(query.from_user.id)
+
+            if not STATELESS_ASSESSMENTS:
+                session.screening = ScreeningSessionState(assessment_key)
+
+            text, markup = self.render.screen(('assessment_intro', assessment_key))
+            await self.edits.edit_message_text(
+                query,
+                text,
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في بدء التقييم: {e}")
-            await query.edit_message_text("حدث خطأ في بدء التقييم.")
+            await self.edits.edit_message_text(query, "حدث خطأ في بدء التقييم.")
 
+    @callback_route("begin", str)
     async def begin_assessment(self, query, context, assessment_type):
         """بداية الاختبار الفعلي"""
         try:
-            context.user_data['current_assessment'] = assessment_type
-            context.user_data['question_index'] = 0
-            context.user_data['answers'] = []
+            if STATELESS_ASSESSMENTS:
+                await self.send_stateless_assessment_step(query, assessment_type, [])
+                return
+
+            session = await self.sessions.get(query.from_user.id)
+            session.screening = ScreeningSessionState(assessment_type)
             await self.send_assessment_question(query, context)
         except Exception as e:
             logger.error(f"❌ خطأ في بداية الاختبار: {e}")
-            await query.edit_message_text("حدث خطأ في بداية الاختبار.")
+            await self.edits.edit_message_text(query, "حدث خطأ في بداية الاختبار.")
 
-    async def send_assessment_question(self, query, context):
-        """إرسال سؤال الاختبار"""
-        try:
-            assessment_type = context.user_data['current_assessment']
-            question_index = context.user_data['question_index']
-            assessment = PSYCHOLOGICAL_ASSESSMENTS[assessment_type]
-
-            if question_index >= len(assessment['questions']):
-                await self.complete_assessment(query, context)
-                return
+    def _build_assessment_question_text(self, assessment_type, question_index):
+        """نص سؤال الاختبار مع التقدم"""
+        assessment = PSYCHOLOGICAL_ASSESSMENTS[assessment_type]
+        question = assessment['questions'][question_index]
+        progress = ((question_index + 1) / len(assessment['questions'])) * 100
 
-            question = assessment['questions'][question_index]
-            progress = ((question_index + 1) / len(assessment['questions'])) * 100
-
-            question_text = f"""
+        question_text = f"""
 {assessment['icon']} **{assessment['name']}**
 
 📊 **التقدم:** {progress:.0f}%
@@ -1514,159 +4795,272 @@ class AdvancedMentalHealthBot:
 
 اختر إجابتك:
             """
+        return question_text
+
+    def _assessment_keyboard(self, assessment_type, answer_data):
+        """لوحة أزرار سؤال الاختبار؛ answer_data يبني بيانات زر كل درجة"""
+        keyboard = []
+        for option_text, score in PSYCHOLOGICAL_ASSESSMENTS[assessment_type]['options']:
+            keyboard.append([InlineKeyboardButton(option_text, callback_data=answer_data(score))])
+        return InlineKeyboardMarkup(keyboard)
+
+    def _assessment_question_view(self, assessment_type, question_index, answer_data=None):
+        """نص سؤال الاختبار ولوحة أزراره من الذاكرة؛ answer_data يُمرر فقط للأزرار الخاصة بكل مستخدم"""
+        question_text = self.render.cached(
+            ('assessment_question', assessment_type, question_index),
+            lambda: self._build_assessment_question_text(assessment_type, question_index)
+        )
+        if answer_data is None:
+            markup = self.render.cached(
+                ('assessment_keyboard', assessment_type, question_index),
+                lambda: self._assessment_keyboard(
+                    assessment_type, lambda score: callback_data("answer", assessment_type, question_index, score))
+            )
+        else:
+            markup = self._assessment_keyboard(assessment_type, answer_data)
+        return question_text, markup
 
-            keyboard = []
-            for option_text, score in assessment['options']:
-                callback_data = f"answer_{score}"
-                keyboard.append([InlineKeyboardButton(option_text, callback_data=callback_data)])
+    async def send_assessment_question(self, query, context):
+        """إرسال سؤال الاختبار"""
+        try:
+            session = await self.sessions.get(query.from_user.id)
+            if session.screening is None:
+                await self.show_assessment_menu(query, context)
+                return
 
-            await query.edit_message_text(
+            assessment_type = session.screening.instrument
+            question_index = session.screening.question_index
+
+            if question_index >= len(PSYCHOLOGICAL_ASSESSMENTS[assessment_type]['questions']):
+                await self.complete_assessment(query, context)
+                return
+
+            question_text, markup = self._assessment_question_view(assessment_type, question_index)
+
+            await self.edits.edit_message_text(
+                query,
                 question_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في إرسال سؤال الاختبار: {e}")
-            await query.edit_message_text("حدث خطأ في إرسال السؤال.")
+            await self.edits.edit_message_text(query, "حدث خطأ في إرسال السؤال.")
 
-    async def handle_assessment_answer(self, query, context, data):
-        """معالجة إجابة الاختبار"""
+    @callback_route("answer", str, int, int)
+    async def handle_assessment_answer(self, query, context, instrument, question_index, score):
+        """معالجة إجابة الاختبار؛ الزر يحمل المقياس ورقم السؤال لرفض الأزرار القديمة"""
         try:
-            score = int(data.replace("answer_", ""))
-            context.user_data['answers'].append(score)
-            context.user_data['question_index'] += 1
+            session = await self.sessions.get(query.from_user.id)
+            if session.screening is None:
+                await self.show_assessment_menu(query, context)
+                return
+
+            state = session.screening
+            if instrument != state.instrument or question_index != state.question_index:
+                await self.send_assessment_question(query, context)
+                return
+
+            session.screening.answers.append(score)
+            session.screening.question_index += 1
             await self.send_assessment_question(query, context)
         except Exception as e:
             logger.error(f"❌ خطأ في معالجة الإجابة: {e}")
-            await query.edit_message_text("حدث خطأ في معالجة الإجابة.")
+            await self.edits.edit_message_text(query, "حدث خطأ في معالجة الإجابة.")
 
     async def complete_assessment(self, query, context):
         """إكمال الاختبار وعرض النتائج"""
         try:
-            assessment_type = context.user_data['current_assessment']
-            answers = context.user_data['answers']
-            total_score = sum(answers)
-
-            # تحديد مستوى الشدة
-            if assessment_type == 'phq9':
-                if total_score <= 4:
-                    severity = "طبيعي"
-                    severity_desc = "لا توجد علامات اكتئاب"
-                    color = "🟢"
-                elif total_score <= 9:
-                    severity = "خفيف"
-                    severity_desc = "اكتئاب خفيف"
-                    color = "🟡"
-                elif total_score <= 14:
-                    severity = "متوسط"
-                    severity_desc = "اكتئاب متوسط"
-                    color = "🟠"
-                elif total_score <= 19:
-                    severity = "متوسط إلى شديد"
-                    severity_desc = "اكتئاب متوسط إلى شديد"
-                    color = "🔴"
-                else:
-                    severity = "شديد"
-                    severity_desc = "اكتئاب شديد"
-                    color = "🔴"
-            else:  # GAD-7
-                if total_score <= 4:
-                    severity = "طبيعي"
-                    severity_desc = "لا توجد علامات قلق"
-                    color = "🟢"
-                elif total_score <= 9:
-                    severity = "خفيف"
-                    severity_desc = "قلق خفيف"
-                    color = "🟡"
-                elif total_score <= 14:
-                    severity = "متوسط"
-                    severity_desc = "قلق متوسط"
-                    color = "🟠"
-                else:
-                    severity = "شديد"
-                    severity_desc = "قلق شديد"
-                    color = "🔴"
-
-            # حفظ النتائج
-            self.save_assessment_results(query.from_user.id, assessment_type, answers, total_score, severity)
-
-            # إعداد النص
-            assessment = PSYCHOLOGICAL_ASSESSMENTS[assessment_type]
-            results_text = f"""
+            session = await self.sessions.get(query.from_user.id)
+            assessment_type = session.screening.instrument
+            answers = list(session.screening.answers)
+            session.screening = None
+            await self._finish_assessment(query, assessment_type, answers)
+        except Exception as e:
+            logger.error(f"❌ خطأ في إكمال الاختبار: {e}")
+            await self.edits.edit_message_text(query, "حدث خطأ في معالجة النتائج.")
+
+    def _build_assessment_result_screen(self, assessment_type, total_score, crisis=False):
+        """شاشة نتيجة الاختبار لدرجة محددة؛ crisis يضيف تنبيه الأمان عند إشارة بند الأزمة"""
+        band = SCREENING_SCALES[assessment_type].band(total_score)
+        crisis_note = f"""
+🆘 **سلامتك أولاً:** أشرت إلى أفكار تتعلق بإيذاء النفس أو الموت. لست وحدك، والمساعدة متاحة الآن.
+{CRISIS_CONTACT_TEXT}
+""" if crisis else ""
+
+        # إعداد النص
+        assessment = PSYCHOLOGICAL_ASSESSMENTS[assessment_type]
+        results_text = f"""
 {assessment['icon']} **نتائج {assessment['name']}**
 
 📊 **النتيجة الإجمالية:** {total_score}
-{color} **التقييم:** {severity_desc}
+{band['color']} **التقييم:** {band['description']}
 
 📋 **التفسير:**
-{self.get_assessment_interpretation(assessment_type, severity)}
+{band['interpretation']}
 
 💡 **التوصيات:**
-{self.get_assessment_recommendations(assessment_type, severity)}
-
+{band['recommendations']}
+{crisis_note}
 ⚠️ **ملاحظة مهمة:** هذا الاختبار لأغراض التوعية فقط وليس بديلاً عن التشخيص الطبي المتخصص.
 
 🔒 **بياناتك محمية ومشفرة بالكامل**
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
-                [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
-                [InlineKeyboardButton("🔄 إعادة الاختبار", callback_data=f"assessment_{assessment_type}")],
-                [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
+            [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
+            [InlineKeyboardButton("🔄 إعادة الاختبار", callback_data=callback_data("assessment", assessment_type))],
+            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
+        ]
+        return results_text, InlineKeyboardMarkup(keyboard)
+
+    async def _finish_assessment(self, query, assessment_type, answers):
+        """حساب نتيجة الاختبار وحفظها وعرضها"""
+        try:
+            scale = SCREENING_SCALES[assessment_type]
+            total_score, band = scale.score(answers)
+
+            # حفظ النتائج
+            await self.save_assessment_results(query.from_user.id, assessment_type, answers, total_score, band['severity'])
 
-            await query.edit_message_text(
+            crisis = scale.has_crisis_answer(answers)
+            results_text, markup = self.render.cached(
+                ('assessment_result', assessment_type, total_score, crisis),
+                lambda: self._build_assessment_result_screen(assessment_type, total_score, crisis)
+            )
+
+            await self.edits.edit_message_text(
+                query,
                 results_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في إكمال الاختبار: {e}")
-            await query.edit_message_text("حدث خطأ في معالجة النتائج.")
+            await self.edits.edit_message_text(query, "حدث خطأ في معالجة النتائج.")
+
+    def _build_follow_up_screen(self, assessment_type):
+        """رسالة تذكير إعادة الاختبار"""
+        assessment = PSYCHOLOGICAL_ASSESSMENTS[assessment_type]
+        text = f"""
+🔔 **تذكير بالمتابعة**
+
+مرّ بعض الوقت منذ أجريت {assessment['icon']} **{assessment['name']}**.
+إعادة الاختبار كل أسبوعين إلى أربعة أسابيع تساعدك على ملاحظة التغير في حالتك.
+
+💚 نتمنى أن تكون بخير.
+        """
+        keyboard = [
+            [InlineKeyboardButton("🔄 إعادة الاختبار الآن", callback_data=callback_data("assessment", assessment_type))],
+            [InlineKeyboardButton("🔕 إيقاف التذكيرات", callback_data="follow_up_off")],
+            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
+        ]
+        return text, InlineKeyboardMarkup(keyboard)
+
+    def _build_follow_up_off_screen(self):
+        """تأكيد إيقاف تذكيرات المتابعة"""
+        text = """
+🔕 **تم إيقاف تذكيرات المتابعة**
+
+يمكنك إعادة أي اختبار في أي وقت من قائمة الاختبارات النفسية.
+        """
+        keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]]
+        return text, InlineKeyboardMarkup(keyboard)
+
+    async def send_follow_up_reminder(self, user_id, assessment_type, severity):
+        """إرسال تذكير إعادة الاختبار إلى محادثة المستخدم الخاصة"""
+        text, markup = self.render.screen(('follow_up', assessment_type))
+        await self.outbox.send_message(
+            user_id, text, priority=OutboundQueue.PRIORITY_NOTIFY, reply_markup=markup, parse_mode='Markdown'
+        )
+
+    @callback_route("follow_up_off")
+    async def disable_follow_up(self, query, context):
+        """إيقاف تذكيرات المتابعة للمستخدم"""
+        try:
+            await self.reminders.cancel_user(query.from_user.id)
+            text, markup = self.render.screen('follow_up_off')
+            await self.edits.edit_message_text(query, text, reply_markup=markup, parse_mode='Markdown')
+        except Exception as e:
+            logger.error(f"❌ خطأ في إيقاف التذكيرات: {e}")
+
+    @callback_route("s", str)
+    async def handle_stateless_step(self, query, context, token):
+        """خطوة في وضع الاختبار عديم الحالة: التقدم والإجابات محمولة داخل بيانات الزر"""
+        try:
+            decoded = self.progress_codec.decode(query.from_user.id, token)
+            if decoded is None:
+                logger.warning(f"⚠️ توقيع تقدم غير صالح من المستخدم: {query.from_user.id}")
+                await self.start_command_from_callback(query, context)
+                return
+
+            kind, answers = decoded
+            if kind == 'mbti':
+                await self.send_stateless_mbti_step(query, answers)
+            else:
+                await self.send_stateless_assessment_step(query, kind, answers)
+        except Exception as e:
+            logger.error(f"❌ خطأ في معالجة خطوة الاختبار: {e}")
+            await self.edits.edit_message_text(query, "حدث خطأ في معالجة الإجابة.")
+
+    async def send_stateless_assessment_step(self, query, assessment_type, answers):
+        """عرض السؤال التالي أو النتيجة لاختبار PHQ-9/GAD-7 دون حالة على الخادم"""
+        if len(answers) >= len(PSYCHOLOGICAL_ASSESSMENTS[assessment_type]['questions']):
+            await self._finish_assessment(query, assessment_type, answers)
+            return
+
+        user_id = query.from_user.id
+        question_text, markup = self._assessment_question_view(
+            assessment_type, len(answers),
+            lambda score: callback_data("s", self.progress_codec.encode(user_id, assessment_type, answers + [score]))
+        )
+        await self.edits.edit_message_text(
+            query,
+            question_text,
+            reply_markup=markup,
+            parse_mode='Markdown'
+        )
+
+    async def send_stateless_mbti_step(self, query, answers):
+        """عرض سؤال MBTI التالي أو النتيجة دون حالة على الخادم"""
+        if len(answers) >= len(MBTI_FLAT_QUESTIONS):
+            responses = {}
+            for (dimension_index, question_index), option_index in zip(MBTI_FLAT_QUESTIONS, answers):
+                dimension = MBTI_DIMENSION_ORDER[dimension_index]
+                option = MBTI_ASSESSMENT['dimensions'][dimension]['questions'][question_index]['options'][option_index]
+                responses.setdefault(dimension, []).append(option['weight'])
+            await self._finish_mbti(query, str(uuid.uuid4()), responses)
+            return
+
+        user_id = query.from_user.id
+        dimension_index, question_index = MBTI_FLAT_QUESTIONS[len(answers)]
+        question_text, markup = self._mbti_question_view(
+            dimension_index, question_index, len(answers) / len(MBTI_FLAT_QUESTIONS) * 100,
+            lambda i, option: callback_data("s", self.progress_codec.encode(user_id, 'mbti', answers + [i]))
+        )
+        await self.edits.edit_message_text(
+            query,
+            question_text,
+            reply_markup=markup,
+            parse_mode='Markdown'
+        )
 
     def get_assessment_interpretation(self, assessment_type, severity):
         """الحصول على تفسير النتيجة"""
-        interpretations = {
-            'phq9': {
-                'طبيعي': 'نتيجة ممتازة! لا توجد علامات للاكتئاب. استمر في العناية بصحتك النفسية.',
-                'خفيف': 'قد تواجه بعض أعراض الاكتئاب الخفيف. يمكن التحسن بالرعاية الذاتية والدعم.',
-                'متوسط': 'توجد أعراض اكتئاب متوسطة تتطلب انتباهاً. فكر في طلب المساعدة المهنية.',
-                'متوسط إلى شديد': 'أعراض اكتئاب كبيرة تؤثر على حياتك. ننصح بقوة بطلب المساعدة المتخصصة.',
-                'شديد': 'أعراض اكتئاب شديدة تتطلب تدخلاً عاجلاً. يرجى طلب المساعدة الطبية فوراً.'
-            },
-            'gad7': {
-                'طبيعي': 'نتيجة ممتازة! لا توجد علامات للقلق المفرط. استمر في ممارساتك الصحية.',
-                'خفيف': 'قد تواجه بعض القلق الخفيف. تقنيات الاسترخاء يمكن أن تساعد.',
-                'متوسط': 'توجد أعراض قلق متوسطة. فكر في تعلم استراتيجيات إدارة القلق.',
-                'شديد': 'أعراض قلق شديدة تؤثر على حياتك اليومية. ننصح بطلب المساعدة المتخصصة.'
-            }
-        }
-        return interpretations.get(assessment_type, {}).get(severity, "لا يوجد تفسير متاح")
+        scale = SCREENING_SCALES.get(assessment_type)
+        band = scale.by_severity.get(severity) if scale else None
+        return band['interpretation'] if band else "لا يوجد تفسير متاح"
 
     def get_assessment_recommendations(self, assessment_type, severity):
         """الحصول على التوصيات"""
-        recommendations = {
-            'phq9': {
-                'طبيعي': '• حافظ على نمط حياة صحي\n• مارس الرياضة بانتظام\n• حافظ على علاقات اجتماعية إيجابية',
-                'خفيف': '• اهتم بالنوم الكافي\n• مارس أنشطة تجلب السعادة\n• تحدث مع أشخاص تثق بهم',
-                'متوسط': '• فكر في العلاج النفسي\n• تجنب الكحول والمواد المضرة\n• حافظ على روتين يومي منتظم',
-                'متوسط إلى شديد': '• اطلب المساعدة المهنية فوراً\n• تواصل مع خط المساعدة النفسية\n• لا تتردد في طلب الدعم',
-                'شديد': '• اتصل بخدمات الطوارئ النفسية\n• تواصل مع طبيب نفسي\n• تجنب البقاء وحيداً'
-            },
-            'gad7': {
-                'طبيعي': '• استمر في ممارسة تقنيات الاسترخاء\n• حافظ على التوازن في الحياة\n• مارس الأنشطة الممتعة',
-                'خفيف': '• تعلم تقنيات التنفس العميق\n• مارس التأمل أو اليوغا\n• قلل من الكافيين',
-                'متوسط': '• فكر في العلاج المعرفي السلوكي\n• مارس الرياضة بانتظام\n• تجنب المواقف المثيرة للقلق',
-                'شديد': '• اطلب المساعدة المهنية\n• فكر في العلاج الدوائي تحت إشراف طبي\n• اطلب الدعم من الأهل والأصدقاء'
-            }
-        }
-        return recommendations.get(assessment_type, {}).get(severity, "لا توجد توصيات متاحة")
+        scale = SCREENING_SCALES.get(assessment_type)
+        band = scale.by_severity.get(severity) if scale else None
+        return band['recommendations'] if band else "لا توجد توصيات متاحة"
 
-    async def show_mbti_detailed_info(self, query, context):
-        """عرض معلومات تفصيلية عن MBTI"""
-        try:
-            info_text = """
+    def _build_mbti_info_screen(self):
+        """شاشة المعلومات التفصيلية عن MBTI"""
+        screen_text = """
 🧠 **معلومات تفصيلية عن اختبار MBTI**
 
 📚 **نبذة تاريخية:**
@@ -1692,25 +5086,31 @@ class AdvancedMentalHealthBot:
 
 🌟 **16 نمط شخصية مختلف**
 كل مزيج من هذه الأبعاد ينتج نمطاً فريداً بخصائصه المميزة.
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🚀 ابدأ الاختبار", callback_data="mbti_start_test")],
-                [InlineKeyboardButton("🔙 العودة", callback_data="start_mbti")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🚀 ابدأ الاختبار", callback_data="mbti_start_test")],
+            [InlineKeyboardButton("🔙 العودة", callback_data="start_mbti")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
 
-            await query.edit_message_text(
-                info_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+    @callback_route("mbti_more_info")
+    async def show_mbti_detailed_info(self, query, context):
+        """عرض معلومات تفصيلية عن MBTI"""
+        try:
+            text, markup = self.render.screen('mbti_info')
+            await self.edits.edit_message_text(
+                query,
+                text,
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في عرض معلومات MBTI: {e}")
 
-    async def show_psychological_detailed_info(self, query, context):
-        """عرض معلومات تفصيلية عن التقييم النفسي"""
-        try:
-            info_text = """
+    def _build_psych_info_screen(self):
+        """شاشة المعلومات التفصيلية عن التقييم النفسي"""
+        screen_text = """
 🔍 **معلومات تفصيلية عن التقييم النفسي الشامل**
 
 📋 **ما هو التقييم النفسي؟**
@@ -1746,25 +5146,31 @@ class AdvancedMentalHealthBot:
 
 🔒 **السرية والخصوصية:**
 جميع المعلومات مشفرة ومحمية، ولا يتم مشاركتها مع أي طرف ثالث.
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🚀 ابدأ التقييم", callback_data="psych_start_evaluation")],
-                [InlineKeyboardButton("🔙 العودة", callback_data="start_psychological_evaluation")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🚀 ابدأ التقييم", callback_data="psych_start_evaluation")],
+            [InlineKeyboardButton("🔙 العودة", callback_data="start_psychological_evaluation")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
 
-            await query.edit_message_text(
-                info_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+    @callback_route("psych_more_info")
+    async def show_psychological_detailed_info(self, query, context):
+        """عرض معلومات تفصيلية عن التقييم النفسي"""
+        try:
+            text, markup = self.render.screen('psych_info')
+            await self.edits.edit_message_text(
+                query,
+                text,
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في عرض معلومات التقييم النفسي: {e}")
 
-    async def show_detailed_info(self, query, context):
-        """عرض معلومات مفصلة عن الخدمة"""
-        try:
-            info_text = """
+    def _build_service_info_screen(self):
+        """شاشة المعلومات المفصلة عن الخدمة"""
+        screen_text = """
 ℹ️ **معلومات مفصلة عن مركز التحليل النفسي المتكامل**
 
 🎯 **رسالتنا:**
@@ -1804,30 +5210,34 @@ class AdvancedMentalHealthBot:
 
 🌟 **فريق العمل:**
 نحن فريق من المتخصصين في علم النفس والإرشاد الديني، نعمل على تقديم أفضل خدمة ممكنة.
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
-                [InlineKeyboardButton("📊 الاختبارات النفسية", callback_data="start_journey")],
-                [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
-                [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
+            [InlineKeyboardButton("📊 الاختبارات النفسية", callback_data="start_journey")],
+            [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
+            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
 
-            await query.edit_message_text(
-                info_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+    @callback_route("more_info")
+    async def show_detailed_info(self, query, context):
+        """عرض معلومات مفصلة عن الخدمة"""
+        try:
+            text, markup = self.render.screen('service_info')
+            await self.edits.edit_message_text(
+                query,
+                text,
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في عرض المعلومات المفصلة: {e}")
 
-    async def start_command_from_callback(self, query, context):
-        """تشغيل أمر البداية من callback"""
-        try:
-            user = query.from_user
-
-            welcome_text = f"""
-🌟 **أهلاً وسهلاً بك {user.first_name}** 🌟
+    def _build_main_menu_screen(self):
+        """شاشة القائمة الرئيسية؛ {first_name} يُملأ لكل مستخدم"""
+        screen_text = """
+🌟 **أهلاً وسهلاً بك {first_name}** 🌟
 
 🧠 **مركز التحليل النفسي المتكامل** 🧠
 
@@ -1845,32 +5255,35 @@ class AdvancedMentalHealthBot:
 • دعم ديني وفلسفي مخصص
 
 🚀 **ابدأ رحلتك نحو فهم أعمق لذاتك!**
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
-                [InlineKeyboardButton("📊 الاختبارات النفسية", callback_data="start_journey")],
-                [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
-                [InlineKeyboardButton("ℹ️ معلومات الخدمة", callback_data="more_info")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
+            [InlineKeyboardButton("📊 الاختبارات النفسية", callback_data="start_journey")],
+            [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
+            [InlineKeyboardButton("ℹ️ معلومات الخدمة", callback_data="more_info")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
 
-            await query.edit_message_text(
-                welcome_text, 
-                reply_markup=InlineKeyboardMarkup(keyboard),
+    @callback_route("back_to_main")
+    async def start_command_from_callback(self, query, context):
+        """تشغيل أمر البداية من callback"""
+        try:
+            user = query.from_user
+
+            text, markup = self.render.screen('main_menu')
+            await self.edits.edit_message_text(
+                query,
+                text.format(first_name=user.first_name),
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في عرض القائمة الرئيسية: {e}")
 
-    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """معالج الرسائل النصية"""
-        try:
-            # يمكن إضافة معالجة للرسائل النصية حسب الحاجة
-            # مثلاً، معالجة الشكاوى أو الاستفسارات
-            user_text = update.message.text
-
-            # هنا يمكن إضافة ذكاء اصطناعي لتحليل النص واقتراح الاختبارات المناسبة
-            response_text = """
+    def _build_text_reply_screen(self):
+        """شاشة الرد على الرسائل النصية"""
+        screen_text = """
 💬 **شكراً لرسالتك**
 
 لتقديم أفضل مساعدة لك، يرجى استخدام الأزرار التفاعلية للوصول إلى خدماتنا:
@@ -1880,187 +5293,802 @@ class AdvancedMentalHealthBot:
 🔍 **التقييم النفسي الشامل** - لتحليل متكامل
 
 يمكنك البدء بأي خدمة تشاء من خلال الأزرار أدناه:
-            """
+        """
 
-            keyboard = [
-                [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
-                [InlineKeyboardButton("📊 الاختبارات النفسية", callback_data="start_journey")],
-                [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
-                [InlineKeyboardButton("ℹ️ معلومات الخدمة", callback_data="more_info")]
-            ]
+        keyboard = [
+            [InlineKeyboardButton("🧠 تحليل الشخصية MBTI", callback_data="start_mbti")],
+            [InlineKeyboardButton("📊 الاختبارات النفسية", callback_data="start_journey")],
+            [InlineKeyboardButton("🔍 التقييم النفسي الشامل", callback_data="start_psychological_evaluation")],
+            [InlineKeyboardButton("ℹ️ معلومات الخدمة", callback_data="more_info")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
+
+    def _build_crisis_screen(self):
+        """شاشة الدعم الفوري عند رسالة تدل على خطر إيذاء النفس"""
+        screen_text = f"""
+🆘 **سلامتك أهم شيء الآن**
+
+نحن نسمعك، وما تشعر به حقيقي ومؤلم. لست وحدك، والمساعدة متاحة.
+
+📞 **إذا كنت في خطر الآن:**
+{CRISIS_CONTACT_TEXT}
+
+🤲 **خذ نفساً عميقاً:** ابقَ في مكان آمن، وابتعد عن أي وسيلة قد تؤذيك.
+
+💬 تحدث مع شخص تثق به اليوم، أو مع مختص نفسي في أقرب وقت.
+        """
+
+        keyboard = [
+            [InlineKeyboardButton("😔 مقياس الاكتئاب PHQ-9", callback_data=callback_data("assessment", "phq9"))],
+            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
+
+    async def record_crisis(self, update, source, detail):
+        """حفظ إشارة الأزمة فوراً وتسجيلها في السجلات"""
+        user = update.effective_user
+        user_id = user.id if user else None
+        await self.db.save_crisis_flag(user_id, source, detail)
+        logger.warning(f"🚨 إشارة أزمة من المستخدم {user_id}: {source} ({detail})")
+
+    def _build_intent_screen(self, intent):
+        """شاشة التوجيه المباشر لنية مصنفة"""
+        text, button_text, button_data = INTENT_FLOWS[intent]
+        screen_text = f"""
+💬 **شكراً لمشاركتك**
+
+{text}
+
+🔒 **خصوصيتك محمية بالكامل**
+        """
+
+        keyboard = [
+            [InlineKeyboardButton(button_text, callback_data=button_data)],
+            [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="back_to_main")]
+        ]
+        return screen_text, InlineKeyboardMarkup(keyboard)
+
+    @staticmethod
+    def _format_search_results(matches):
+        """نص الرد بالمحتوى الأقرب لرسالة المستخدم"""
+        parts = ["📚 **محتوى قد يفيدك:**"]
+        for _, entry in matches:
+            part = f"{entry['icon']} {entry['text']}"
+            if entry['note']:
+                part += f"\n💡 {entry['note']}"
+            if entry['source']:
+                part += f"\n📚 *{entry['source']}*"
+            parts.append(part)
+        parts.append("يمكنك أيضاً البدء بأي خدمة من خلال الأزرار أدناه:")
+        return "\n\n".join(parts)
+
+    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """معالج الرسائل النصية"""
+        try:
+            # يمكن إضافة معالجة للرسائل النصية حسب الحاجة
+            # مثلاً، معالجة الشكاوى أو الاستفسارات
+            user_text = update.message.text
+
+            if self.crisis.detect_text(user_text):
+                text, markup = self.render.screen('crisis')
+                await update.message.reply_text(text, reply_markup=markup, parse_mode='Markdown')
+                return
+
+            intent, _ = self.intents.classify(user_text)
+            if intent in INTENT_FLOWS:
+                text, markup = self.render.screen(('intent', intent))
+            else:
+                # طلب محتوى معرفي أو رسالة غير مصنفة: أقرب محتوى من قاعدة المعرفة إن وجد
+                text, markup = self.render.screen('text_reply')
+                matches = self.search_index.search(user_text, SEARCH_RESULTS_LIMIT, SEARCH_MIN_SCORE)
+                if matches:
+                    text = self._format_search_results(matches)
 
             await update.message.reply_text(
-                response_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                text,
+                reply_markup=markup,
                 parse_mode='Markdown'
             )
         except Exception as e:
             logger.error(f"❌ خطأ في معالجة الرسالة النصية: {e}")
 
-    def save_user_data(self, user):
+    async def save_user_data(self, user):
         """حفظ بيانات المستخدم"""
         try:
-            conn = sqlite3.connect(self.db.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-            INSERT OR REPLACE INTO users 
-            (user_id, username, first_name, last_interaction)
-            VALUES (?, ?, ?, ?)
-            ''', (user.id, user.username, user.first_name, datetime.now()))
-
-            conn.commit()
-            conn.close()
+            await self.db.save_user(user.id, user.username, user.first_name)
             logger.info(f"✅ تم حفظ بيانات المستخدم: {user.id}")
         except Exception as e:
             logger.error(f"❌ خطأ في حفظ بيانات المستخدم: {e}")
 
-    def save_mbti_results(self, user_id, session_id, analysis):
+    async def save_mbti_results(self, user_id, session_id, analysis):
         """حفظ نتائج MBTI"""
         try:
-            conn = sqlite3.connect(self.db.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-            INSERT INTO mbti_results 
-            (user_id, session_id, personality_type, dimension_scores, detailed_analysis)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (
-                user_id, session_id, analysis['personality_type'],
-                json.dumps(analysis['dimension_scores']),
-                json.dumps(analysis['details'])
-            ))
-
-            conn.commit()
-            conn.close()
+            await self.db.save_mbti_result(user_id, session_id, analysis)
             logger.info(f"✅ تم حفظ نتائج MBTI للمستخدم: {user_id}")
         except Exception as e:
             logger.error(f"❌ خطأ في حفظ نتائج MBTI: {e}")
 
-    def save_psychological_results(self, user_id, session_id, results):
+    async def save_psychological_results(self, user_id, session_id, results):
         """حفظ نتائج التقييم النفسي"""
         try:
-            conn = sqlite3.connect(self.db.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-            INSERT INTO psychological_evaluations 
-            (user_id, session_id, evaluation_data, analysis_results, support_resources)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (
-                user_id, session_id,
-                json.dumps(results['responses']),
-                json.dumps(results['analysis']),
-                json.dumps({
-                    'religious': results['religious_support'],
-                    'philosophical': results['philosophical_support']
-                })
-            ))
-
-            conn.commit()
-            conn.close()
+            await self.db.save_psychological_evaluation(user_id, session_id, results)
             logger.info(f"✅ تم حفظ نتائج التقييم النفسي للمستخدم: {user_id}")
         except Exception as e:
             logger.error(f"❌ خطأ في حفظ نتائج التقييم النفسي: {e}")
 
-    def save_assessment_results(self, user_id, assessment_type, answers, total_score, severity):
-        """حفظ نتائج الاختبارات النفسية"""
+    async def save_assessment_results(self, user_id, assessment_type, answers, total_score, severity):
+        """حفظ نتائج الاختبارات النفسية وجدولة تذكير إعادة الاختبار"""
         try:
-            conn = sqlite3.connect(self.db.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-            INSERT INTO assessments 
-            (user_id, assessment_type, questions_answers, total_score, severity, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id, assessment_type, json.dumps(answers), 
-                total_score, severity, datetime.now()
-            ))
-
-            conn.commit()
-            conn.close()
+            follow_up_at = self.reminders.due_at(assessment_type, severity)
+            await self.db.save_assessment(user_id, assessment_type, answers, total_score, severity, follow_up_at)
+            if follow_up_at is not None:
+                self.reminders.notify(follow_up_at)
             logger.info(f"✅ تم حفظ نتائج التقييم للمستخدم: {user_id}")
         except Exception as e:
             logger.error(f"❌ خطأ في حفظ نتائج التقييم: {e}")
 
     def log_user_interaction(self, user_id, action):
-        """تسجيل تفاعل المستخدم"""
+        """تسجيل تفاعل المستخدم عبر مخزن الكتابة المؤجلة"""
         try:
-            conn = sqlite3.connect(self.db.db_path)
-            cursor = conn.cursor()
+            self.interaction_log.touch(user_id)
+        except Exception as e:
+            logger.error(f"❌ خطأ في تسجيل التفاعل: {e}")
 
-            cursor.execute('''
-            UPDATE users SET last_interaction = ? WHERE user_id = ?
-            ''', (datetime.now(), user_id))
+    def get_runtime_stats(self):
+        """إحصائيات التشغيل الداخلية"""
+        return {
+            'interaction_log': self.interaction_log.stats(),
+            'sessions': self.sessions.stats(),
+            'router': self.router.stats(),
+            'render': self.render.stats(),
+            'edits': self.edits.stats(),
+            'search': self.search_index.stats(),
+            'intents': self.intents.stats(),
+            'crisis': self.crisis.stats(),
+            'update_lanes': self.update_processor.stats(),
+            'quotes': self.quotes.stats(),
+            'scheduler': self.scheduler.stats(),
+            'follow_up': self.reminders.stats(),
+            'outbox': self.outbox.stats(),
+            'broadcasts': self.broadcasts.stats(),
+            'webhook': self.webhook_server.stats() if self.webhook_server else None,
+            'startup': STARTUP_PROFILE.stats()
+        }
 
-            conn.commit()
-            conn.close()
+    async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """أمر عرض إحصائيات التشغيل للمشرفين"""
+        try:
+            if update.effective_user.id not in ADMIN_USER_IDS:
+                return
+            stats_text = json.dumps(self.get_runtime_stats(), ensure_ascii=False, indent=2, default=str)
+            await update.message.reply_text(f"📈 إحصائيات التشغيل:\n{stats_text}")
         except Exception as e:
-            logger.error(f"❌ خطأ في تسجيل التفاعل: {e}")
+            logger.error(f"❌ خطأ في عرض الإحصائيات: {e}")
 
-def clear_webhook():
-    """مسح webhook لحل تعارض النسخ المتعددة"""
-    try:
-        import requests
-        url = f"https://api.telegram.org/bot{TOKEN}/deleteWebhook"
-        response = requests.post(url, timeout=10)
-        if response.status_code == 200:
-            logger.info("🔧 تم مسح webhook القديم")
-        else:
-            logger.warning(f"⚠️ استجابة غير متوقعة من webhook: {response.status_code}")
-    except Exception as e:
-        logger.warning(f"⚠️ تعذر مسح webhook: {e}")
+    async def broadcast_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """أمر المشرفين لبث رسالة إلى جميع المستخدمين: /broadcast النص"""
+        try:
+            if update.effective_user.id not in ADMIN_USER_IDS:
+                return
+            parts = update.message.text.split(maxsplit=1)
+            if len(parts) < 2:
+                await update.message.reply_text("الاستخدام: /broadcast نص الرسالة")
+                return
+            text = parts[1]
+            # معاينة للمشرف أولاً: تنسيق Markdown غير صالح يُرفض قبل أن يفشل لكل المستخدمين
+            try:
+                await update.message.reply_text(text, parse_mode='Markdown')
+            except BadRequest as e:
+                await update.message.reply_text(f"❌ تنسيق الرسالة غير صالح: {e}")
+                return
+            broadcast_id = await self.broadcasts.create(text, 'Markdown', update.effective_user.id)
+            await update.message.reply_text(
+                f"📣 بدأ البث رقم {broadcast_id}. تابع التقدم بـ /broadcast_status أو ألغه بـ /broadcast_cancel {broadcast_id}"
+            )
+        except Exception as e:
+            logger.error(f"❌ خطأ في بدء البث: {e}")
 
-def run_bot():
-    """تشغيل البوت مع حل مشكلة event loop نهائياً"""
-    try:
-        # مسح webhook القديم
-        clear_webhook()
+    async def broadcast_status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """أمر المشرفين لعرض تقدم البث والوقت المتبقي"""
+        try:
+            if update.effective_user.id not in ADMIN_USER_IDS:
+                return
+            lines = []
+            for progress in self.broadcasts.progress():
+                eta = timedelta(seconds=progress['eta_seconds']) if progress['eta_seconds'] is not None else '—'
+                lines.append(
+                    f"📣 #{progress['id']}: {progress['done']}/{progress['total']} ({progress['percent']}%) "
+                    f"• {progress['rate_per_second']} رسالة/ث • المتبقي {eta}\n"
+                    f"   ✅ {progress['sent']} 🚫 {progress['blocked']} ❌ {progress['failed']}"
+                )
+            for broadcast_id, status, total, sent, failed, blocked, _, _ in await self.broadcasts.recent():
+                if broadcast_id not in self.broadcasts.active:
+                    lines.append(f"#{broadcast_id} [{status}]: ✅ {sent} 🚫 {blocked} ❌ {failed} من {total}")
+            await update.message.reply_text("\n".join(lines) or "لا يوجد بث.")
+        except Exception as e:
+            logger.error(f"❌ خطأ في عرض حالة البث: {e}")
 
-        # إنشاء البوت
-        bot = AdvancedMentalHealthBot()
+    async def broadcast_cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """أمر المشرفين لإلغاء بث: /broadcast_cancel رقم"""
+        try:
+            if update.effective_user.id not in ADMIN_USER_IDS:
+                return
+            if not context.args or not context.args[0].isdigit():
+                await update.message.reply_text("الاستخدام: /broadcast_cancel رقم_البث")
+                return
+            cancelled = await self.broadcasts.cancel(int(context.args[0]))
+            await update.message.reply_text("🛑 تم إلغاء البث." if cancelled else "لا يوجد بث بهذا الرقم.")
+        except Exception as e:
+            logger.error(f"❌ خطأ في إلغاء البث: {e}")
+
+class WebhookServer:
+    """خادم HTTP/1.1 مدمج على asyncio لاستقبال تحديثات تيليجرام
+
+    يتحقق من ترويسة X-Telegram-Bot-Api-Secret-Token، ويبقي الاتصالات مفتوحة بين
+    الطلبات، ويحد عدد الطلبات المعالجة في وقت واحد من قراءة الترويسات حتى الرد،
+    فيرد 503 عند الامتلاء ليعيد تيليجرام المحاولة. التحديث يُوضع في طابور التطبيق
+    ويُرد بـ 200 فوراً؛ المعالجة نفسها يتولاها معالج التحديثات كما في polling.
+    """
+
+    SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+    MAX_HEADERS = 100
+    REASONS = {
+        200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+        411: 'Length Required', 413: 'Payload Too Large', 431: 'Request Header Fields Too Large',
+        503: 'Service Unavailable'
+    }
+
+    def __init__(self, application, listen=None, port=None, path=None, secret=None,
+                 max_concurrency=None, keepalive_seconds=None):
+        self.application = application
+        self.listen = listen or WEBHOOK_LISTEN
+        self.port = WEBHOOK_PORT if port is None else port
+        self.path = path or WEBHOOK_PATH
+        self.secret = (secret or WEBHOOK_SECRET).encode()
+        self.keepalive = keepalive_seconds or WEBHOOK_KEEPALIVE_SECONDS
+        self._limit = asyncio.Semaphore(max_concurrency or WEBHOOK_MAX_CONCURRENCY)
+        self._server = None
+        # الكاتب -> مهمة خدمة الاتصال، لانتظار إنهائها عند الإغلاق
+        self._connections = {}
+        self.counters = {'requests': 0, 'updates': 0, 'rejected': 0, 'errors': 0, 'busy': 0, 'connections_total': 0}
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"✅ خادم webhook يستمع على {self.listen}:{self.port}{self.path}")
+
+    async def _serve_connection(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        self.counters['connections_total'] += 1
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), self.keepalive)
+                if not request_line.strip():
+                    break
+                if self._limit.locked():
+                    # كل المقاعد مشغولة: رفض فوري دون قراءة بقية الطلب ثم إغلاق الاتصال
+                    self.counters['busy'] += 1
+                    await self._respond(writer, 503, False)
+                    break
+                async with self._limit:
+                    keep_alive = await self._serve_request(reader, writer, request_line)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _serve_request(self, reader, writer, request_line):
+        """قراءة طلب واحد والرد عليه؛ يعيد هل يبقى الاتصال مفتوحاً لطلب تالٍ"""
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            await self._respond(writer, 400, False)
+            return False
+        method, target, version = parts
+
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.keepalive)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= self.MAX_HEADERS:
+                await self._respond(writer, 431, False)
+                return False
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+        if 'transfer-encoding' in headers:
+            await self._respond(writer, 411, False)
+            return False
+        length = int(headers.get('content-length') or 0)
+        if length > WEBHOOK_MAX_BODY:
+            await self._respond(writer, 413, False)
+            return False
+
+        # المسار والطريقة والسر تُفحص قبل قراءة الجسم؛ الطلب المرفوض بجسم يُغلق اتصاله
+        status = self._authorize(method, target.split('?', 1)[0], headers)
+        if status is not None:
+            keep_alive = keep_alive and not length
+            await self._respond(writer, status, keep_alive)
+            return keep_alive
+        body = await asyncio.wait_for(reader.readexactly(length), self.keepalive) if length else b''
+
+        status = await self._handle(body)
+        await self._respond(writer, status, keep_alive)
+        return keep_alive
+
+    def _authorize(self, method, path, headers):
+        """الحالة المرتجعة لطلب لا يُقرأ جسمه، أو None إن كان تحديثاً مقبولاً"""
+        self.counters['requests'] += 1
+        if path == '/healthz':
+            return 200
+        if path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if not hmac.compare_digest(headers.get(self.SECRET_HEADER, '').encode(), self.secret):
+            self.counters['rejected'] += 1
+            return 403
+        return None
+
+    async def _handle(self, body):
+        """الحالة المرتجعة لتحديث مقبول بعد قراءة جسمه"""
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception:
+            self.counters['errors'] += 1
+            return 400
+        await self.application.update_queue.put(update)
+        self.counters['updates'] += 1
+        return 200
+
+    async def _respond(self, writer, status, keep_alive):
+        writer.write(
+            f"HTTP/1.1 {status} {self.REASONS[status]}\r\nContent-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+        )
+        await writer.drain()
+
+    async def close(self):
+        """إيقاف قبول الاتصالات وإغلاق الاتصالات المفتوحة"""
+        if self._server is None:
+            return
+        self._server.close()
+        handlers = list(self._connections.values())
+        for writer in list(self._connections):
+            writer.close()
+        if handlers:
+            await asyncio.wait(handlers, timeout=self.keepalive)
+        await self._server.wait_closed()
+
+    def stats(self):
+        return {**self.counters, 'open_connections': len(self._connections)}
+
+def install_stop_signals(on_signal):
+    """ربط SIGINT وSIGTERM بدالة الإيقاف في حلقة الأحداث الحالية"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, on_signal)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+class LifecycleManager:
+    """دورة حياة العملية: تشغيل الاستقبال ثم إيقاف آمن عند SIGTERM أو SIGINT
+
+    ترتيب الإيقاف: إيقاف استقبال التحديثات، ثم انتظار طابور التحديثات والمعالجات الجارية
+    حتى SHUTDOWN_DRAIN_SECONDS وإلغاء ما يتبقى، ثم إيقاف التطبيق، ثم إغلاق خدمات البوت
+    (تفريغ الكتابات المؤجلة والجلسات وطابور الإرسال وقاعدة البيانات)، وأخيراً اتصالات HTTP.
+    الإشارة الثانية تنهي مهلة التصريف فوراً.
+    """
+
+    def __init__(self, bot, application, drain_seconds=None):
+        self.bot = bot
+        self.application = application
+        self.drain_seconds = SHUTDOWN_DRAIN_SECONDS if drain_seconds is None else drain_seconds
+        self.stopping = asyncio.Event()
+        self.forced = asyncio.Event()
+        self.phases = {}
+
+    def _on_signal(self):
+        if self.stopping.is_set():
+            logger.warning("⚠️ إشارة إيقاف ثانية: إنهاء التصريف فوراً")
+            self.forced.set()
+        self.stopping.set()
+
+    async def run(self, start_intake, stop_intake):
+        """تشغيل التطبيق حتى إشارة الإيقاف ثم تنفيذ الإيقاف الآمن"""
+        install_stop_signals(self._on_signal)
+        await self.application.initialize()
+        try:
+            await self.bot.startup(self.application)
+            await self.application.start()
+            await start_intake()
+            await self.stopping.wait()
+            logger.info("🔴 إشارة إيقاف: بدء تصريف العمل الجاري")
+        finally:
+            await self._shutdown(stop_intake)
+
+    async def _shutdown(self, stop_intake):
+        started = last = time.monotonic()
+        deadline = started + self.drain_seconds
+
+        def phase(name):
+            nonlocal last
+            now = time.monotonic()
+            self.phases[name] = round((now - last) * 1000)
+            last = now
+
+        try:
+            await stop_intake()
+        except Exception as e:
+            logger.error(f"❌ خطأ في إيقاف الاستقبال: {e}")
+        phase('intake')
+
+        queue_ = self.application.update_queue
+        while not queue_.empty() and time.monotonic() < deadline and not self.forced.is_set():
+            await asyncio.sleep(0.05)
+        abandoned = await self.bot.update_processor.drain(max(0.0, deadline - time.monotonic()), self.forced)
+        phase('handlers')
+
+        if self.application.running:
+            await self.application.stop()
+        phase('application')
+        await self.bot.shutdown(self.application)
+        phase('services')
+        await self.application.shutdown()
+        phase('http')
+
+        breakdown = ' • '.join(f"{name} {elapsed}ms" for name, elapsed in self.phases.items())
+        logger.info(
+            f"✅ اكتمل الإيقاف الآمن في {(time.monotonic() - started) * 1000:.0f}ms "
+            f"(تحديثات ملغاة: {abandoned}): {breakdown}"
+        )
+
+async def serve_polling(bot, application):
+    """تشغيل التطبيق بوضع polling تحت مدير دورة الحياة"""
+    async def start_intake():
+        await application.updater.start_polling(drop_pending_updates=POLLING_DROP_PENDING)
+        logger.info("✅ البوت جاهز للعمل بوضع polling")
+
+    async def stop_intake():
+        if application.updater.running:
+            await application.updater.stop()
+
+    await LifecycleManager(bot, application).run(start_intake, stop_intake)
+
+async def serve_webhook(bot, application):
+    """تشغيل التطبيق بوضع webhook: تسجيل العنوان وتشغيل الخادم المدمج تحت مدير دورة الحياة"""
+    server = WebhookServer(application)
+
+    async def start_intake():
+        if WEBHOOK_REGISTER:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+        await server.start()
+        bot.webhook_server = server
+        logger.info("✅ البوت جاهز للعمل بوضع webhook")
+
+    await LifecycleManager(bot, application).run(start_intake, server.close)
 
-        async def main_async():
-            """الدالة الرئيسية غير المتزامنة"""
+class ConsistentHashRing:
+    """حلقة تجزئة متسقة بعقد افتراضية: المستخدم يبقى على عامله نفسه، وتغيير عدد العمال ينقل نحو 1/N فقط"""
+
+    def __init__(self, nodes, vnodes=None):
+        vnodes = vnodes or WORKER_VNODES
+        points = sorted((self._hash(f"{node}#{replica}"), node) for node in nodes for replica in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+    def node(self, key):
+        return self._nodes[bisect.bisect(self._hashes, self._hash(key)) % len(self._nodes)]
+
+IPC_FRAME_HEADER = struct.Struct('>I')
+
+def write_frame(writer, message):
+    """كتابة رسالة JSON مسبوقة بطولها"""
+    payload = json.dumps(message, separators=(',', ':')).encode('utf-8')
+    writer.write(IPC_FRAME_HEADER.pack(len(payload)) + payload)
+
+async def read_frame(reader):
+    """قراءة رسالة JSON مسبوقة بطولها؛ يرفع IncompleteReadError عند إغلاق الطرف الآخر"""
+    (length,) = IPC_FRAME_HEADER.unpack(await reader.readexactly(IPC_FRAME_HEADER.size))
+    return json.loads(await reader.readexactly(length))
+
+def worker_socket_path(index):
+    return os.path.join(WORKER_SOCKET_DIR, f"worker-{index}.sock")
+
+class WorkerLink:
+    """قناة عملية الاستقبال إلى عامل واحد عبر مقبس Unix
+
+    كل تحديث يبقى في unacked حتى يؤكد العامل انتهاء معالجته، وعند انقطاع الاتصال
+    (إعادة تشغيل العامل) يُعاد إرسال غير المؤكد بترتيبه بعد إعادة الاتصال.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.path = worker_socket_path(index)
+        self.unacked = OrderedDict()
+        self._seq = itertools.count(1)
+        self._writer = None
+        self._task = None
+        self.counters = {'forwarded': 0, 'acked': 0, 'resent': 0, 'reconnects': 0}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, update_data):
+        seq = next(self._seq)
+        self.unacked[seq] = update_data
+        self.counters['forwarded'] += 1
+        if self._writer is not None:
+            write_frame(self._writer, {'seq': seq, 'update': update_data})
             try:
-                # إنشاء التطبيق
-                application = Application.builder().token(TOKEN).build()
+                await self._writer.drain()
+            except ConnectionError:
+                pass
 
-                # إضافة معالج الأخطاء
-                async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-                    logger.error(f"Exception while handling an update: {context.error}")
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (OSError, ConnectionError):
+                await asyncio.sleep(0.2)
+                continue
+            self.counters['reconnects'] += 1
+            for seq, update_data in list(self.unacked.items()):
+                write_frame(writer, {'seq': seq, 'update': update_data})
+                self.counters['resent'] += 1
+            self._writer = writer
+            try:
+                await writer.drain()
+                while True:
+                    message = await read_frame(reader)
+                    if self.unacked.pop(message['ack'], None) is not None:
+                        self.counters['acked'] += 1
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.warning(f"⚠️ انقطع الاتصال بالعامل {self.index}؛ {len(self.unacked)} تحديث بانتظار الإعادة")
+            finally:
+                self._writer = None
+                writer.close()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def stats(self):
+        return {**self.counters, 'unacked': len(self.unacked), 'connected': self._writer is not None}
+
+async def supervise_worker(index, stop, processes):
+    """تشغيل عملية العامل وإعادة تشغيلها عند خروجها حتى إشارة الإيقاف
+
+    العامل يعمل في جلسة مستقلة فلا تصله إشارات الطرفية أو المنصة الموجهة لمجموعة العمليات؛
+    إيقافه يتولاه الاستقبال بعد التصريف، ونصف مهلة الإيقاف متاح لتصريفه الخاص.
+    """
+    env = {**os.environ, 'SHUTDOWN_DRAIN_SECONDS': str(SHUTDOWN_DRAIN_SECONDS / 2)}
+    while not stop.is_set():
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--worker', str(index), env=env, start_new_session=True
+        )
+        processes[index] = process
+        waiter = asyncio.create_task(process.wait())
+        stopper = asyncio.create_task(stop.wait())
+        await asyncio.wait((waiter, stopper), return_when=asyncio.FIRST_COMPLETED)
+        if stop.is_set():
+            waiter.cancel()
+            return
+        stopper.cancel()
+        logger.error(f"❌ خرج العامل {index} بالرمز {process.returncode}؛ إعادة التشغيل")
+        await asyncio.sleep(WORKER_RESTART_SECONDS)
+
+async def run_ingress(workers=None):
+    """عملية الاستقبال: تستقبل التحديثات (polling أو webhook) وتوزعها على العمال بالتجزئة المتسقة"""
+    workers = workers or WORKER_PROCESSES
+    os.makedirs(WORKER_SOCKET_DIR, exist_ok=True)
+    stop = asyncio.Event()
+    install_stop_signals(stop.set)
+    # العمال يُوقفون بحدث منفصل لا يُضبط إلا بعد تصريف ما استُقبل إليهم
+    workers_stop = asyncio.Event()
+
+    ring = ConsistentHashRing(range(workers))
+    links = [WorkerLink(index) for index in range(workers)]
+    processes = {}
+    supervisors = [asyncio.create_task(supervise_worker(index, workers_stop, processes)) for index in range(workers)]
+    for link in links:
+        link.start()
+
+    application = Application.builder().token(TOKEN).build()
+    await application.initialize()
+    server = None
+    if BOT_MODE == 'webhook':
+        server = WebhookServer(application)
+        if WEBHOOK_REGISTER:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+        await server.start()
+    else:
+        await application.updater.start_polling(drop_pending_updates=POLLING_DROP_PENDING)
+    logger.info(f"✅ عملية الاستقبال تعمل بوضع {BOT_MODE} وتوزع على {workers} عمال")
+
+    async def forward():
+        while True:
+            update = await application.update_queue.get()
+            key = PriorityUpdateProcessor._ordering_key(update)
+            await links[ring.node(key if key is not None else update.update_id)].submit(update.to_dict())
+
+    forwarder = asyncio.create_task(forward())
+    try:
+        await stop.wait()
+    finally:
+        if server is not None:
+            await server.close()
+        elif application.updater.running:
+            await application.updater.stop()
+        # مهلة واحدة للإيقاف كله: نصفها لتسليم ما استُقبل للعمال، والباقي لتصريفهم ثم الإنهاء القسري
+        deadline = time.monotonic() + SHUTDOWN_DRAIN_SECONDS
+        forward_deadline = deadline - SHUTDOWN_DRAIN_SECONDS / 2
+        while not application.update_queue.empty() and time.monotonic() < forward_deadline:
+            await asyncio.sleep(0.05)
+        while any(link.unacked for link in links) and time.monotonic() < forward_deadline:
+            await asyncio.sleep(0.05)
+        forwarder.cancel()
+        workers_stop.set()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+        running = [process for process in processes.values() if process.returncode is None]
+        for process in running:
+            process.terminate()
+        if running:
+            _, pending = await asyncio.wait(
+                [asyncio.create_task(process.wait()) for process in running],
+                timeout=max(0.0, deadline - time.monotonic())
+            )
+            for process in running:
+                if process.returncode is None:
+                    logger.warning(f"⚠️ انتهت مهلة الإيقاف؛ إنهاء العامل {process.pid} قسراً")
+                    process.kill()
+            await asyncio.gather(*pending, return_exceptions=True)
+        for link in links:
+            await link.close()
+        await application.shutdown()
+
+async def run_worker(index):
+    """عملية عامل: تشغيل البوت كاملاً وتغذيته بالتحديثات الواردة من عملية الاستقبال"""
+    bot = AdvancedMentalHealthBot()
+    bot.background_services = index == 0
+    bot.peer_poll_seconds = WORKER_POLL_SECONDS
+    application = build_application(bot, updater=False)
+    processor = bot.update_processor
+    path = worker_socket_path(index)
+    server = None
+    accepting = True
+    connections = set()
+
+    async def serve_ingress(reader, writer):
+        def acknowledge(seq, update_id):
+            def done(task):
+                # أخطاء المعالجات يلتقطها التطبيق؛ الفشل في البنية أو الإلغاء عند الإيقاف لا يُؤكد
+                # فيعيد الاستقبال إرسال التحديث للعامل بعد إعادة تشغيله
+                if (not task.cancelled() and task.exception() is None
+                        and update_id not in processor.abandoned and not writer.is_closing()):
+                    write_frame(writer, {'ack': seq})
+            return done
+
+        connections.add(writer)
+        try:
+            while accepting:
+                message = await read_frame(reader)
+                if not accepting:
+                    break
+                update = Update.de_json(message['update'], application.bot)
+                # نفس مسار polling: معالج التحديثات يرتب تحديثات المستخدم ويحد التزامن
+                task = asyncio.create_task(processor.process_update(update, application.process_update(update)))
+                task.add_done_callback(acknowledge(message['seq'], update.update_id))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            connections.discard(writer)
+
+    async def start_intake():
+        nonlocal server
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(serve_ingress, path)
+        logger.info(f"✅ العامل {index} جاهز على {path}")
+
+    async def stop_intake():
+        nonlocal accepting
+        accepting = False
+        if server is not None:
+            server.close()
 
-                application.add_error_handler(error_handler)
+    try:
+        await LifecycleManager(bot, application).run(start_intake, stop_intake)
+    finally:
+        # الإغلاق بعد التصريف حتى تصل تأكيدات التحديثات المكتملة
+        for writer in list(connections):
+            writer.close()
+
+def build_application(bot, updater=True):
+    """بناء التطبيق وتسجيل معالجات البوت"""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(bot.update_processor)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # إضافة معالج الأخطاء
+    async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        logger.error(f"Exception while handling an update: {context.error}")
+
+    application.add_error_handler(error_handler)
+
+    # إضافة المعالجات
+    application.add_handler(CommandHandler("start", bot.start_command))
+    application.add_handler(CommandHandler("stats", bot.stats_command))
+    application.add_handler(CommandHandler("broadcast", bot.broadcast_command))
+    application.add_handler(CommandHandler("broadcast_status", bot.broadcast_status_command))
+    application.add_handler(CommandHandler("broadcast_cancel", bot.broadcast_cancel_command))
+    application.add_handler(CallbackQueryHandler(bot.handle_callback))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_text_message))
+    return application
 
-                # إضافة المعالجات
-                application.add_handler(CommandHandler("start", bot.start_command))
-                application.add_handler(CallbackQueryHandler(bot.handle_callback))
-                application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_text_message))
+def run_bot():
+    """تشغيل البوت بالوضع المحدد في الإعدادات"""
+    try:
+        if WORKER_PROCESSES > 0:
+            asyncio.run(run_ingress())
+            return
 
-                # رسائل البداية
-                logger.info("🚀 مركز التحليل النفسي المتكامل يبدأ التشغيل...")
-                logger.info("🧠 تم تحميل نظام تحليل الشخصية MBTI")
-                logger.info("📊 تم تحميل الاختبارات النفسية المعتمدة")
-                logger.info("🔍 تم تحميل نظام التقييم النفسي الشامل")
-                logger.info("💾 تم إنشاء قاعدة البيانات المتقدمة")
-                logger.info("✅ البوت جاهز للعمل 24/7!")
+        # إنشاء البوت
+        bot = AdvancedMentalHealthBot()
 
-                # تشغيل البوت
-                await application.run_polling(drop_pending_updates=True)
+        # إنشاء التطبيق
+        application = build_application(bot)
+        STARTUP_PROFILE.mark('application')
 
-            except Exception as e:
-                logger.error(f"❌ خطأ في الدالة الرئيسية: {e}")
+        # رسائل البداية
+        logger.info("🚀 مركز التحليل النفسي المتكامل يبدأ التشغيل...")
+        logger.info("✅ البوت جاهز للعمل 24/7!")
 
-        # تشغيل البوت
-        asyncio.run(main_async())
+        # تشغيل البوت؛ start_polling يحذف أي webhook قديم قبل البدء
+        if BOT_MODE == 'webhook':
+            asyncio.run(serve_webhook(bot, application))
+        else:
+            asyncio.run(serve_polling(bot, application))
 
     except Exception as e:
         logger.error(f"❌ خطأ في تشغيل البوت: {e}")
 
 if __name__ == '__main__':
     try:
-        run_bot()
+        if '--rescore' in sys.argv[1:]:
+            asyncio.run(rescore_history())
+        elif '--benchmark-intents' in sys.argv[1:]:
+            run_intent_benchmark()
+        elif '--worker' in sys.argv[1:]:
+            asyncio.run(run_worker(int(sys.argv[sys.argv.index('--worker') + 1])))
+        else:
+            run_bot()
     except KeyboardInterrupt:
         logger.info("🔴 تم إيقاف البوت بواسطة المستخدم")
     except Exception as e:
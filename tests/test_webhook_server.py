@@ -0,0 +1,164 @@
+"""اختبارات خادم webhook المدمج عبر مقبس حقيقي يؤدي فيه العميل دور تيليجرام"""
+import asyncio
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+SECRET = 's3cr3t'
+
+
+class FakeApplication:
+    def __init__(self):
+        self.update_queue = asyncio.Queue()
+        self.bot = None
+
+
+def update_payload(update_id):
+    return {
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': 0, 'chat': {'id': 5, 'type': 'private'}, 'text': 'مرحبا'}
+    }
+
+
+class FakeTelegram:
+    """عميل HTTP/1.1 بسيط يرسل التحديثات كما يرسلها تيليجرام"""
+
+    def __init__(self, port):
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        return self
+
+    async def request(self, body=b'', secret=SECRET, path='/telegram', method='POST', headers=None):
+        lines = [f"{method} {path} HTTP/1.1", "Host: localhost", f"Content-Length: {len(body)}"]
+        if secret is not None:
+            lines.append(f"X-Telegram-Bot-Api-Secret-Token: {secret}")
+        lines.extend(headers or [])
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await self.writer.drain()
+        return await self.response()
+
+    async def post_update(self, update_id, **kwargs):
+        return await self.request(json.dumps(update_payload(update_id)).encode(), **kwargs)
+
+    async def response(self):
+        status_line = await asyncio.wait_for(self.reader.readline(), 5)
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), 5)
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        return int(status_line.split()[1]), response_headers
+
+    async def closed_by_server(self):
+        return await asyncio.wait_for(self.reader.read(), 5) == b''
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+class WebhookServerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.application = FakeApplication()
+        self.server = main.WebhookServer(
+            self.application, listen='127.0.0.1', port=0, path='/telegram', secret=SECRET,
+            max_concurrency=2, keepalive_seconds=1
+        )
+        await self.server.start()
+        self.clients = []
+
+    async def asyncTearDown(self):
+        for client in self.clients:
+            await client.close()
+        await self.server.close()
+
+    async def telegram(self):
+        client = await FakeTelegram(self.server.port).connect()
+        self.clients.append(client)
+        return client
+
+    async def test_keep_alive_reuses_connection(self):
+        client = await self.telegram()
+        for update_id in range(1, 4):
+            status, headers = await client.post_update(update_id)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['connection'], 'keep-alive')
+        self.assertEqual(self.application.update_queue.qsize(), 3)
+        self.assertEqual(self.server.counters['connections_total'], 1)
+        update = await self.application.update_queue.get()
+        self.assertEqual((update.update_id, update.message.text), (1, 'مرحبا'))
+
+    async def test_bad_secret_is_rejected_without_reading_body(self):
+        client = await self.telegram()
+        status, headers = await client.post_update(1, secret='wrong')
+        self.assertEqual(status, 403)
+        self.assertEqual(headers['connection'], 'close')
+        self.assertTrue(await client.closed_by_server())
+        self.assertTrue(self.application.update_queue.empty())
+        self.assertEqual(self.server.counters['rejected'], 1)
+
+    async def test_missing_secret_is_rejected(self):
+        client = await self.telegram()
+        status, _ = await client.post_update(1, secret=None)
+        self.assertEqual(status, 403)
+
+    async def test_connection_close_is_honoured(self):
+        client = await self.telegram()
+        status, headers = await client.post_update(1, headers=['Connection: close'])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['connection'], 'close')
+        self.assertTrue(await client.closed_by_server())
+        self.assertEqual(self.application.update_queue.qsize(), 1)
+
+    async def test_oversized_body_is_refused(self):
+        client = await self.telegram()
+        client.writer.write(
+            f"POST /telegram HTTP/1.1\r\nContent-Length: {main.WEBHOOK_MAX_BODY + 1}\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n\r\n".encode('latin-1')
+        )
+        status, _ = await client.response()
+        self.assertEqual(status, 413)
+        self.assertTrue(await client.closed_by_server())
+
+    async def test_unknown_path_and_method(self):
+        client = await self.telegram()
+        self.assertEqual((await client.request(path='/other'))[0], 404)
+        self.assertEqual((await client.request(method='GET'))[0], 405)
+        self.assertEqual((await client.request(method='GET', path='/healthz', secret=None))[0], 200)
+
+    async def test_busy_server_answers_503(self):
+        # اتصالان يحجزان المقعدين بترويسات لم تكتمل، فيُرفض الطلب الثالث فوراً
+        for _ in range(2):
+            stalled = await self.telegram()
+            stalled.writer.write(b"POST /telegram HTTP/1.1\r\nHost: localhost\r\n")
+            await stalled.writer.drain()
+        await asyncio.sleep(0.1)
+        client = await self.telegram()
+        status, _ = await client.post_update(1)
+        self.assertEqual(status, 503)
+        self.assertTrue(await client.closed_by_server())
+        self.assertEqual(self.server.counters['busy'], 1)
+
+    async def test_stalled_body_times_out(self):
+        client = await self.telegram()
+        client.writer.write(
+            f"POST /telegram HTTP/1.1\r\nContent-Length: 100\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n\r\n{{".encode('latin-1')
+        )
+        self.assertTrue(await client.closed_by_server())
+        self.assertTrue(self.application.update_queue.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()